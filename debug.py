@@ -1,6 +1,8 @@
 import sys
 from stvm import VM
 from stvm import STVMDebugger
+from stvm.profiler import profile_from_environment
+from stvm.display import display_from_environment
 
 
 if __name__ == "__main__":
@@ -8,4 +10,7 @@ if __name__ == "__main__":
         print("Missing argument: image file")
         exit(1)
 
-    STVMDebugger(VM.new(sys.argv[1])).cmdloop()
+    vm = VM.new(sys.argv[1])
+    vm.display = display_from_environment(vm)
+    vm.sampler = profile_from_environment(vm)
+    STVMDebugger(vm).cmdloop()
@@ -0,0 +1,356 @@
+import argparse
+import json
+import math
+import platform
+import struct
+import sys
+import time
+from .image64 import Image
+from .synthetic import SyntheticImage, Assembler as A, smallint
+from .utils import from_python, to_python
+from .vm import VM, VMContext
+
+
+def string_hash(text, species_hash):
+    """Reference implementation of MiscPrimitivePlugin>>primitiveStringHash"""
+    hash_val = species_hash & 0xFFFFFFF
+    for char in text:
+        hash_val += ord(char)
+        low = hash_val & 16383
+        hash_val = (0x260D * low + ((0x260D * (hash_val >> 14) + (0x0065 * low) & 16383) * 16384)) & 0x0FFFFFFF
+    return hash_val
+
+
+def find_substring(key, body, start, table):
+    """Reference implementation of MiscPrimitivePlugin>>primitiveFindSubstring"""
+    if not key:
+        return 0
+    for index in range(max(start, 1), len(body) - len(key) + 2):
+        if all(table[body[index + i - 1]] == table[key[i]] for i in range(len(key))):
+            return index
+    return 0
+
+
+def compare_string(s1, s2, order):
+    """Reference implementation of MiscPrimitivePlugin>>primitiveCompareString"""
+    for c1, c2 in zip(s1, s2):
+        if order[c1] != order[c2]:
+            return 1 if order[c1] < order[c2] else 3
+    if len(s1) == len(s2):
+        return 2
+    return 1 if len(s1) < len(s2) else 3
+
+
+def alpha_blend(source, dest):
+    """Reference implementation of the BitBlt combination rule 24 (alpha blend)"""
+    alpha = source >> 24
+    result = 0
+    for shift in (0, 8, 16, 24):
+        component = (source >> shift) & 0xFF if shift < 24 else 0xFF
+        blend = component * alpha + ((dest >> shift) & 0xFF) * (255 - alpha) + 255
+        result |= (((blend + ((blend - 1) >> 8)) >> 8) & 0xFF) << shift
+    return result
+
+
+def blended(dest, source, times):
+    for _ in range(times):
+        dest = alpha_blend(source, dest)
+    return dest
+
+
+def sum_of_roots(n):
+    total = 0.0
+    for i in range(1, n + 1):
+        total += math.sqrt(i)
+    return total
+
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+
+def factorial(n):
+    result = 1
+    for i in range(2, n + 1):
+        result *= i
+    return result
+
+
+def define_kernel(s):
+    """Primitive methods used by the workloads"""
+    ret = A().push_nil().return_top().build()
+    for selector, number in (("+", 1), ("-", 2), ("<", 3), (">", 4), ("<=", 5), (">=", 6), ("=", 7),
+                             ("//", 12), ("\\\\", 11), ("bitAnd:", 14)):
+        s.method("SmallInteger", selector, ret, nb_args=1, primitive=number)
+    # on overflow, SmallInteger>>* falls back to the LargeIntegers multiplication
+    s.method("SmallInteger", "*", A().push_self().push_temp(0).send(0, 1).return_top().build(),
+             literals=[s.symbol("largeMultiply:")], nb_args=1, primitive=9)
+    s.method("Integer", "largeMultiply:", ret, nb_args=1, primitive=29)
+    s.method("LargePositiveInteger", "*", ret, nb_args=1, primitive=29)
+    s.method("Array", "at:", ret, nb_args=1, primitive=60)
+    s.method("Array", "at:put:", ret, nb_args=2, primitive=61)
+    s.method("Array", "size", ret, primitive=62)
+    s.method("Array", "new:", ret, nb_args=1, primitive=71, meta=True)
+    s.method("Bitmap", "at:", ret, nb_args=1, primitive=60)
+    s.method("SmallInteger", "asFloat", ret, primitive=40)
+    s.method("Float", "+", ret, nb_args=1, primitive=41)
+    s.method("Float", "sqrt", ret, primitive=55)
+    # Integer>>sqrt  ^self asFloat sqrt
+    s.method("SmallInteger", "sqrt", A().push_self().send(0, 0).send(1, 0).return_top().build(),
+             literals=[s.symbol("asFloat"), s.symbol("sqrt")])
+    s.method("BlockClosure", "value", ret, primitive=201)
+    s.method("BlockClosure", "value:", ret, nb_args=1, primitive=202)
+    for selector, function in (("stringHash:initialHash:", "primitiveStringHash"),
+                               ("findSubstring:in:startingAt:matchTable:", "primitiveFindSubstring"),
+                               ("compare:with:collated:", "primitiveCompareString")):
+        s.method("ByteString", selector, ret, nb_args=selector.count(":"), primitive=117, meta=True,
+                 literals=[s.array([s.symbol("MiscPrimitivePlugin"), s.symbol(function), 0, 0])])
+    # do: aBlock  | i |  i := 1. [i <= self size] whileTrue: [aBlock value: (self at: i). i := i + 1]
+    s.method("Array", "do:", A().push_int(1).pop_temp(1)
+             .label("loop").push_temp(1).push_self().special_send("size").special_send("<=").jump_false("end")
+             .push_temp(0).push_self().push_temp(1).special_send("at:").special_send("value:").pop()
+             .push_temp(1).push_int(1).special_send("+").pop_temp(1).jump("loop")
+             .label("end").return_self().build(), nb_args=1, nb_temps=1)
+
+
+def define_loop(s):
+    # benchLoop  | i sum |  i := sum := 0. [i < self] whileTrue: [sum := sum + (i bitAnd: 2). i := i + 1]. ^sum
+    s.method("SmallInteger", "benchLoop", A().push_int(0).pop_temp(0).push_int(0).pop_temp(1)
+             .label("loop").push_temp(0).push_self().special_send("<").jump_false("end")
+             .push_temp(1).push_temp(0).push_int(2).special_send("bitAnd:").special_send("+").pop_temp(1)
+             .push_temp(0).push_int(1).special_send("+").pop_temp(0).jump("loop")
+             .label("end").push_temp(1).return_top().build(), nb_temps=2)
+
+
+def define_fib(s):
+    # benchFib  self < 2 ifTrue: [^self]. ^(self - 1) benchFib + (self - 2) benchFib
+    s.method("SmallInteger", "benchFib", A().push_self().push_int(2).special_send("<").jump_false("rec")
+             .push_self().return_top().label("rec")
+             .push_self().push_int(1).special_send("-").send(0, 0)
+             .push_self().push_int(2).special_send("-").send(0, 0)
+             .special_send("+").return_top().build(), literals=[s.symbol("benchFib")])
+
+
+def define_closures(s):
+    # benchClosures  | array i sum |
+    #     array := Array new: self. i := 1.
+    #     [i <= self] whileTrue: [array at: i put: i. i := i + 1].
+    #     sum := 0. array do: [:x | sum := sum + x]. ^sum
+    block = A().emit(140, 0, 1).push_temp(0).special_send("+").emit(141, 0, 1).block_return().build()
+    s.method("SmallInteger", "benchClosures", A()
+             .push_literal_var(0).push_self().special_send("new:").pop_temp(0)
+             .push_int(1).pop_temp(1)
+             .label("fill").push_temp(1).push_self().special_send("<=").jump_false("filled")
+             .push_temp(0).push_temp(1).push_temp(1).special_send("at:put:").pop()
+             .push_temp(1).push_int(1).special_send("+").pop_temp(1).jump("fill")
+             .label("filled").emit(138, 1).pop_temp(2).push_int(0).emit(142, 0, 2)
+             .push_temp(0).push_temp(2).closure(1, 1, block).special_send("do:").pop()
+             .emit(140, 0, 2).return_top().build(), literals=[s.binding("Array")], nb_temps=3)
+
+
+def define_factorial(s):
+    # benchFactorial  self = 0 ifTrue: [^1]. ^self * (self - 1) benchFactorial
+    s.method("SmallInteger", "benchFactorial", A().push_self().push_int(0).special_send("=").jump_false("rec")
+             .push_int(1).return_top().label("rec")
+             .push_self().push_self().push_int(1).special_send("-").send(0, 0)
+             .special_send("*").return_top().build(), literals=[s.symbol("benchFactorial")])
+
+
+def define_string_hash(s):
+    # benchHash: n  | i hash |  i := 0.
+    #     [i < n] whileTrue: [hash := ByteString stringHash: self initialHash: i. i := i + 1]. ^hash
+    s.method("ByteString", "benchHash:", A().push_int(0).pop_temp(1)
+             .label("loop").push_temp(1).push_temp(0).special_send("<").jump_false("end")
+             .push_literal_var(1).push_self().push_temp(1).send(0, 2).pop_temp(2)
+             .push_temp(1).push_int(1).special_send("+").pop_temp(1).jump("loop")
+             .label("end").push_temp(2).return_top().build(),
+             literals=[s.symbol("stringHash:initialHash:"), s.binding("ByteString")], nb_args=1, nb_temps=2)
+
+
+def define_string_search(s):
+    # benchSearch: n table: table  | i sum |  i := sum := 0.
+    #     [i < n] whileTrue: [
+    #         sum := sum + (ByteString findSubstring: 'LAZY' in: self startingAt: 1 matchTable: table)
+    #                    + (ByteString compare: self with: 'THE QUICK' collated: table).
+    #         i := i + 1].
+    #     ^sum
+    s.method("ByteString", "benchSearch:table:", A().push_int(0).pop_temp(2).push_int(0).pop_temp(3)
+             .label("loop").push_temp(2).push_temp(0).special_send("<").jump_false("end")
+             .push_temp(3)
+             .push_literal_var(2).push_literal(3).push_self().push_int(1).push_temp(1).send(0, 4)
+             .special_send("+")
+             .push_literal_var(2).push_self().push_literal(4).push_temp(1).send(1, 3)
+             .special_send("+").pop_temp(3)
+             .push_temp(2).push_int(1).special_send("+").pop_temp(2).jump("loop")
+             .label("end").push_temp(3).return_top().build(),
+             literals=[s.symbol("findSubstring:in:startingAt:matchTable:"), s.symbol("compare:with:collated:"),
+                       s.binding("ByteString"), s.string("LAZY"), s.string("THE QUICK")],
+             nb_args=2, nb_temps=2)
+
+
+def define_floats(s):
+    # benchFloats  | i sum |  i := 1. sum := 0 asFloat.
+    #     [i <= self] whileTrue: [sum := sum + i sqrt. i := i + 1]. ^sum
+    s.method("SmallInteger", "benchFloats", A().push_int(1).pop_temp(0).push_int(0).send(0, 0).pop_temp(1)
+             .label("loop").push_temp(0).push_self().special_send("<=").jump_false("end")
+             .push_temp(1).push_temp(0).send(1, 0).special_send("+").pop_temp(1)
+             .push_temp(0).push_int(1).special_send("+").pop_temp(0).jump("loop")
+             .label("end").push_temp(1).return_top().build(),
+             literals=[s.symbol("asFloat"), s.symbol("sqrt")], nb_temps=2)
+
+
+DISPLAY_WIDTH, DISPLAY_HEIGHT = 1024, 768
+DISPLAY_PIXEL = 0xFF0000FF
+BLEND_PIXEL = 0x80FF0000
+
+
+def define_bitblt(s):
+    # benchBlit  | i |  i := 0. [i < self] whileTrue: [Blitter copyBits. i := i + 1]. ^DisplayBits at: 1
+    # where Blitter alpha blends a 1024x768 translucent form on the whole 32 bits display
+    s.define_class("Form", "Object", 1, 5)
+    s.define_class("BitBlt", "Object", 1, 15)
+    size = DISPLAY_WIDTH * DISPLAY_HEIGHT
+
+    def form(bits):
+        form = s.new("Form")
+        form[0] = bits
+        for i, value in enumerate((DISPLAY_WIDTH, DISPLAY_HEIGHT, 32), 1):
+            form[i] = smallint(value)
+        return form
+    display_bits = s.new("Bitmap", data=struct.pack("<I", DISPLAY_PIXEL) * size)
+    blitter = s.new("BitBlt")
+    blitter[0] = form(display_bits)
+    blitter[1] = form(s.new("Bitmap", data=struct.pack("<I", BLEND_PIXEL) * size))
+    for i, value in enumerate((24, 0, 0, DISPLAY_WIDTH, DISPLAY_HEIGHT, 0, 0, 0, 0,
+                               DISPLAY_WIDTH, DISPLAY_HEIGHT), 3):
+        blitter[i] = smallint(value)
+    s.method("BitBlt", "copyBits", A().push_nil().return_top().build(), primitive=117,
+             literals=[s.array([s.symbol("BitBltPlugin"), s.symbol("primitiveCopyBits"), 0, 0])])
+    s.method("SmallInteger", "benchBlit", A().push_int(0).pop_temp(0)
+             .label("loop").push_temp(0).push_self().special_send("<").jump_false("end")
+             .push_literal_var(1).send(0, 0).pop()
+             .push_temp(0).push_int(1).special_send("+").pop_temp(0).jump("loop")
+             .label("end").push_literal_var(2).push_int(1).special_send("at:").return_top().build(),
+             literals=[s.symbol("copyBits"), s.association(s.symbol("Blitter"), blitter),
+                       s.association(s.symbol("DisplayBits"), display_bits)],
+             nb_temps=1)
+
+
+class Workload(object):
+    def __init__(self, name, receiver, selector, args=(), expected=None):
+        self.name = name
+        self.receiver = receiver
+        self.selector = selector
+        self.args = args
+        self.expected = expected
+
+
+TEXT = "the quick brown fox " * 200 + "jumps over the lazy dog"
+# case insensitive matching and collation
+UPPERCASE = bytes(c - 32 if 97 <= c <= 122 else c for c in range(256))
+
+WORKLOADS = [
+    Workload("bytecodes", 20000, "benchLoop", expected=sum(i & 2 for i in range(20000))),
+    Workload("fib", 20, "benchFib", expected=fib(20)),
+    Workload("closures", 5000, "benchClosures", expected=sum(range(5001))),
+    Workload("factorial", 300, "benchFactorial", expected=factorial(300)),
+    Workload("string_hash", "the quick brown fox jumps over the lazy dog", "benchHash:", args=(500,),
+             expected=string_hash("the quick brown fox jumps over the lazy dog", 499)),
+    Workload("string_search", TEXT, "benchSearch:table:", args=(200, UPPERCASE),
+             expected=200 * (find_substring(b"LAZY", TEXT.encode(), 1, UPPERCASE)
+                             + compare_string(TEXT.encode(), b"THE QUICK", UPPERCASE))),
+    Workload("floats", 20000, "benchFloats", expected=sum_of_roots(20000)),
+    Workload("bitblt", 10, "benchBlit", expected=blended(DISPLAY_PIXEL, BLEND_PIXEL, 10)),
+]
+
+
+def build_image():
+    """Synthetic image with the methods of all the workloads"""
+    s = SyntheticImage()
+    define_kernel(s)
+    for define in (define_loop, define_fib, define_closures, define_factorial, define_string_hash,
+                   define_string_search, define_floats, define_bitblt):
+        define(s)
+    return s.build()
+
+
+def run(vm, workload):
+    memory = vm.memory
+    receiver = from_python(workload.receiver, vm)
+    args = [from_python(arg, vm) for arg in workload.args]
+    method = vm.lookup(receiver.class_, vm.find_selector(receiver.class_, workload.selector))
+    base = VMContext(memory.nil, method, memory)
+    base.stack = []
+    base._previous = memory.nil
+    context = VMContext(receiver, method, memory)
+    context.stack[:len(args)] = args
+    context._previous = base
+    vm.current_context = context
+    allocator = vm.allocator
+    allocations, allocated = allocator.allocations, allocator.current
+    bytecodes = sends = 0
+    start = time.perf_counter()
+    while vm.current_context is not base:
+        context = vm.current_context
+        vm.decode_execute(vm.fetch())
+        bytecodes += 1
+        if vm.current_context.previous is context:
+            sends += 1
+    elapsed = time.perf_counter() - start
+    result = to_python(base.pop(), vm)
+    return {
+        "name": workload.name,
+        "ok": result == workload.expected,
+        "seconds": elapsed,
+        "bytecodes": bytecodes,
+        "sends": sends,
+        "allocations": allocator.allocations - allocations,
+        "allocated_bytes": allocator.current - allocated,
+        "bytecodes_per_second": bytecodes / elapsed,
+        "sends_per_second": sends / elapsed,
+    }
+
+
+def run_all(names=None, repeat=1):
+    data = build_image()
+    results = []
+    for workload in WORKLOADS:
+        if names and workload.name not in names:
+            continue
+        runs = []
+        for _ in range(repeat):
+            # a fresh VM for each run, the allocation segment is never collected
+            vm = VM(Image.from_bytes(data, "benchmark.image"))
+            try:
+                runs.append(run(vm, workload))
+            finally:
+                vm.close()
+        results.append(min(runs, key=lambda r: r["seconds"]))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the interpreter benchmarks on a synthetic image")
+    parser.add_argument("workloads", nargs="*", help=f"workloads to run ({', '.join(w.name for w in WORKLOADS)})")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per workload, the fastest is kept")
+    parser.add_argument("--json", help="writes the results in this file")
+    options = parser.parse_args(argv)
+    results = run_all(options.workloads, options.repeat)
+    print(f"{'workload':<14} {'ok':<4} {'seconds':>9} {'bytecodes':>10} {'bc/s':>10} {'sends/s':>10} {'allocations':>12}")
+    for r in results:
+        print(f"{r['name']:<14} {str(r['ok']):<4} {r['seconds']:>9.3f} {r['bytecodes']:>10} "
+              f"{r['bytecodes_per_second']:>10.0f} {r['sends_per_second']:>10.0f} {r['allocations']:>12}")
+    if options.json:
+        report = {
+            "time": time.time(),
+            "python": sys.version,
+            "platform": platform.platform(),
+            "results": results,
+        }
+        with open(options.json, mode="w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if all(r["ok"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
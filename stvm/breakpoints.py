@@ -0,0 +1,80 @@
+METHOD, PC, SELECTOR, PRIMITIVE = "method", "pc", "selector", "primitive"
+
+
+class Breakpoint(object):
+    """
+    Stops the execution when a method is activated (METHOD), when a method
+    reaches a pc (PC), when a selector is sent (SELECTOR) or when a method
+    with a primitive is activated (PRIMITIVE), before its first bytecode.
+    The condition, if any, is called with the VM and the active context.
+    """
+    def __init__(self, kind, key, condition=None, description=None):
+        self.kind = kind
+        self.key = key
+        self.condition = condition
+        self.description = description or f"{kind} {key}"
+        self.enabled = True
+        self.hits = 0
+
+    def check(self, vm, context):
+        if not self.enabled:
+            return False
+        if self.condition is not None and not self.condition(vm, context):
+            return False
+        self.hits += 1
+        return True
+
+    def __repr__(self):
+        return f"<Breakpoint {self.description} hits={self.hits}>"
+
+
+class Breakpoints(object):
+    """Breakpoints indexed by the key they are checked with"""
+    def __init__(self):
+        self.all = []
+        self.methods = {}
+        self.pcs = {}
+        self.selectors = {}
+        self.primitives = {}
+        self.tables = {METHOD: self.methods, PC: self.pcs, SELECTOR: self.selectors, PRIMITIVE: self.primitives}
+
+    def __len__(self):
+        return len(self.all)
+
+    @property
+    def on_send(self):
+        """Are there breakpoints checked when a method is looked up"""
+        return bool(self.methods or self.selectors or self.primitives)
+
+    def add(self, breakpoint):
+        self.all.append(breakpoint)
+        self.tables[breakpoint.kind].setdefault(breakpoint.key, []).append(breakpoint)
+        return breakpoint
+
+    def remove(self, breakpoint):
+        self.all.remove(breakpoint)
+        table = self.tables[breakpoint.kind]
+        table[breakpoint.key].remove(breakpoint)
+        if not table[breakpoint.key]:
+            del table[breakpoint.key]
+
+    def sent(self, selector, method):
+        """Breakpoints concerned by the activation of method for selector"""
+        candidates = []
+        for table, key in ((self.methods, method.address), (self.selectors, selector.address),
+                           (self.primitives, method.primitive)):
+            breakpoints = table.get(key)
+            if breakpoints:
+                candidates.extend(breakpoints)
+        return candidates
+
+    def reached(self, context):
+        return self.pcs.get((context.compiled_method.address, context.pc))
+
+    @staticmethod
+    def first_hit(vm, candidates):
+        context = vm.current_context
+        for breakpoint in candidates:
+            if breakpoint.check(vm, context):
+                return breakpoint
+        return None
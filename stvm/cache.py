@@ -0,0 +1,137 @@
+import hashlib
+import marshal
+import os
+import struct
+from .heap import walk
+from .spurobjects.objects import CompiledMethod
+
+
+MAGIC = b"STVMCACHE"
+VERSION = 2
+# magic, version, image size, image mtime (ns), digest of the image
+KEY = struct.Struct("<9sHQQ16s")
+
+
+def cache_file(image):
+    return image.file.with_name(image.file.name + ".stvmcache")
+
+
+def image_key(image):
+    """
+    Identifies an image file by its size, its modification time and a hash of
+    its header and of the first and last chunks of the object space.
+    """
+    stat = os.stat(image.file)
+    digest = hashlib.blake2b(digest_size=16)
+    header_size = image.header_size
+    digest.update(image.map[:header_size])
+    digest.update(image.map[header_size:header_size + 65536])
+    digest.update(image.map[-65536:])
+    return KEY.pack(MAGIC, VERSION, stat.st_size, stat.st_mtime_ns, digest.digest())
+
+
+class ImageCache(object):
+    """
+    Pre-parsed indexes of an image, saved in the <image>.stvmcache sidecar:
+    class_table:  addresses of the class table pages
+    class_names:  class name -> class index
+    symbols:      text of the symbols -> address
+    methods:      class address -> (method dictionary address,
+                                    {selector address: (slot index, method address)})
+    trailers:     compiled method address -> trailer size
+    """
+    def __init__(self, class_table, class_names, symbols, methods, trailers):
+        self.class_table = class_table
+        self.class_names = class_names
+        self.symbols = symbols
+        self.methods = methods
+        self.trailers = trailers
+
+    @classmethod
+    def build(cls, memory):
+        nil = memory.nil
+        table = memory.class_table
+        pages = [page.address for page in table.slots if page is not nil]
+        symbol_index = memory.special_symbols[0].class_index
+        method_index = memory.compiled_method_class.identity_hash
+        symbol_oops, method_oops = [], []
+        for address, class_index, format, num_slots in walk(memory):
+            if class_index == symbol_index:
+                symbol_oops.append((address, format, num_slots))
+            elif class_index == method_index:
+                method_oops.append((address, format))
+        symbols = {}
+        for address, format, num_slots in symbol_oops:
+            size = num_slots * 8 - (format - 16)
+            symbols[str(memory[address + 8:address + 8 + size], "latin-1")] = address
+        class_names = {}
+        methods = {}
+        for page_number, page in enumerate(pages):
+            page_slots = memory[page + 8:page + 8 + 1024 * 8].cast("Q")
+            for row, address in enumerate(page_slots):
+                if address == nil.address or address & 0x7:
+                    continue
+                stclass = memory.object_at(address)
+                if len(stclass) < 3:
+                    continue
+                try:
+                    class_names.setdefault(stclass[6].as_text(), page_number * 1024 + row)
+                except Exception:
+                    ...
+                method_dict = stclass[1]
+                if method_dict is nil or method_dict.kind != 3:
+                    continue
+                entries = {}
+                values = method_dict.instvars[1]
+                for i, selector in enumerate(method_dict.array):
+                    if selector is not nil:
+                        entries[selector.address] = (i, values[i].address)
+                methods[address] = (method_dict.address, entries)
+        trailers = {}
+        for address, format in method_oops:
+            # not registered in the object cache, only decoded once
+            trailers[address] = CompiledMethod(address, memory, format).trailer.size
+        return cls(pages, class_names, symbols, methods, trailers)
+
+    @classmethod
+    def load(cls, image):
+        """Returns the cache of the image, or None if it is missing or stale"""
+        path = cache_file(image)
+        try:
+            f = open(path, mode="br")
+        except OSError:
+            return None
+        with f:
+            data = f.read()
+        if data[:KEY.size] != image_key(image):
+            return None
+        try:
+            return cls(*marshal.loads(data[KEY.size:]))
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def save(self, image):
+        path = cache_file(image)
+        payload = marshal.dumps((self.class_table, self.class_names, self.symbols,
+                                 self.methods, self.trailers))
+        tmp = path.with_name(path.name + f".{os.getpid()}")
+        with open(tmp, mode="bw") as f:
+            f.write(image_key(image))
+            f.write(payload)
+        os.replace(tmp, path)
+
+    @classmethod
+    def for_image(cls, image, memory):
+        cache = cls.load(image)
+        if cache is None:
+            cache = cls.build(memory)
+            try:
+                cache.save(image)
+            except OSError:
+                # read-only location, the cache is only used in memory
+                ...
+        return cache
+
+    def install(self, memory):
+        memory.method_trailers = self.trailers
+        memory.handler.texts.update((address, text) for text, address in self.symbols.items())
@@ -0,0 +1,145 @@
+import time
+from .image64 import PAGE_SIZE
+
+
+class Checkpoint(object):
+    """
+    State of a VM at a given point of the execution.
+    The heap is kept as the content of the pages written since the memory
+    was loaded. Only the pages written since the previous checkpoint (the
+    last one taken or restored) are copied, the other ones share their
+    content with it. Native contexts are saved by value and restored in
+    place, so the objects referencing them stay valid.
+    """
+    def __init__(self, label=None, previous=None):
+        self.label = label
+        self.time = time.time()
+        self.pages = {}
+        self.contexts = []
+        self.current_context = None
+        self.new_process_waiting = False
+        self.new_process = None
+        self.allocation_top = 0
+        self.last_hash = 0
+        self.previous = previous
+
+    def __repr__(self):
+        return f"<Checkpoint {self.label} pages={len(self.pages)} contexts={len(self.contexts)}>"
+
+
+def native_contexts(vm):
+    """Yields the native contexts of the current chain and of the heap contexts"""
+    from .vm import VMContext
+    seen = set()
+    roots = [vm.current_context]
+    roots.extend(getattr(obj, "vm_context", None) for obj in list(vm.memory.cache.values()))
+    for context in roots:
+        while isinstance(context, VMContext) and id(context) not in seen:
+            seen.add(id(context))
+            yield context
+            context = context._previous
+
+
+def take(vm, label=None, previous=None, since=0):
+    """
+    previous is the checkpoint the memory started from at the generation
+    since, the pages written after it are copied
+    """
+    memory = vm.memory
+    checkpoint = Checkpoint(label, previous)
+    previous_pages = previous.pages if previous else {}
+    checkpoint.pages.update(previous_pages)
+    for address in memory.dirty_pages_since(since):
+        segment = memory.segment_at(address)
+        offset = address - segment.start
+        content = bytes(segment.mem[offset:offset + PAGE_SIZE])
+        old = previous_pages.get(address)
+        checkpoint.pages[address] = old if old == content else content
+    for context in native_contexts(vm):
+        state = dict(context.__dict__)
+        state["stack"] = list(context.stack)
+        checkpoint.contexts.append((context, state))
+    checkpoint.current_context = vm.current_context
+    checkpoint.new_process_waiting = vm.new_process_waiting
+    checkpoint.new_process = vm.new_process
+    checkpoint.allocation_top = vm.allocator.current
+    checkpoint.last_hash = vm.last_hash
+    return checkpoint
+
+
+def original_page(vm, segment, offset):
+    if segment.segment is None:
+        return bytes(min(PAGE_SIZE, len(segment.mem) - offset))
+    start = segment.segment.file_offset + offset
+    return vm.image.map[start:start + min(PAGE_SIZE, len(segment.mem) - offset)]
+
+
+def header_changed(obj):
+    """Reads the header of a proxy again, answers True if the proxy has to be dropped"""
+    object_format, nb_slots, class_index = obj.decode_basicinfo(obj.header)
+    if nb_slots > 254:
+        nb_slots = obj.memory[obj.address - 8:obj.address - 4].cast("I")[0]
+    if (object_format != obj.object_format or class_index != obj.class_index
+            or nb_slots != obj.number_of_slots):
+        return True
+    obj.h1 = obj.header1.cast("I")[0]
+    obj.h2 = obj.header2.cast("I")[0]
+    obj.is_immutable = (obj.h1 & 0x600000) > 0
+    obj.is_remembered = (obj.h1 & 0x20000000) > 0
+    obj.is_pinned = (obj.h1 & 0x40000000) > 0
+    obj.identity_hash = obj.h2 & 0x3FFFFF
+    return False
+
+
+def restore(vm, checkpoint):
+    memory = vm.memory
+    for address in memory.dirty_pages(since_load=True):
+        segment = memory.segment_at(address)
+        offset = address - segment.start
+        content = checkpoint.pages.get(address)
+        if content is None:
+            content = original_page(vm, segment, offset)
+        segment.mem[offset:offset + len(content)] = content
+
+    # proxies of objects allocated after the checkpoint, or whose class or
+    # size changed, are dropped, the headers of the other ones are read
+    # again (identity hash, immutability)
+    allocator = vm.allocator
+    top = checkpoint.allocation_top
+    cache = memory.cache
+    texts = memory.handler.texts
+    for address, obj in list(cache.items()):
+        if top <= address < allocator.limit:
+            stale = True
+        elif hasattr(obj, "header2"):
+            stale = header_changed(obj)
+        else:
+            continue
+        if stale:
+            del cache[address]
+            texts.pop(address, None)
+    for address in [address for address in texts if top <= address < allocator.limit]:
+        del texts[address]
+    allocator.current = allocator.segment.top = top
+    allocator._heap_index = None
+    vm._names = None
+
+    saved = set()
+    for context, state in checkpoint.contexts:
+        context.__dict__.clear()
+        context.__dict__.update(state)
+        context.stack = list(state["stack"])
+        saved.add(id(context))
+    for obj in cache.values():
+        native = getattr(obj, "vm_context", None)
+        if native is not None and id(native) not in saved:
+            obj.vm_context = None
+
+    vm.current_context = checkpoint.current_context
+    vm.new_process_waiting = checkpoint.new_process_waiting
+    vm.new_process = checkpoint.new_process
+    vm.last_hash = checkpoint.last_hash
+    vm.method_cache.clear()
+    vm.process_scheduler.queues.clear()
+    vm.process_scheduler.rescan()
+    vm.force_interrupt_check()
@@ -15,6 +15,40 @@ class STVMDebugger(Cmd):
         self.prompt = '? > '
         self.vm = vm
         self.cmdqueue = ['stack', 'list']
+        # number of bytecodes executed from the debugger
+        self.steps = 0
+        self.checkpoint_every = 0
+        self.recorder = None
+        self.profiler = None
+
+    def periodic_checkpoint(self):
+        vm = self.vm
+        if self.checkpoint_every and self.steps % self.checkpoint_every == 0:
+            if not vm.checkpoints or vm.checkpoints[-1].label != self.steps:
+                vm.checkpoint(self.steps)
+
+    def execute(self):
+        vm = self.vm
+        self.periodic_checkpoint()
+        vm.decode_execute(vm.fetch())
+        self.steps += 1
+
+    def run(self, limit=None):
+        """Runs the VM up to a breakpoint, or for limit bytecodes"""
+        vm = self.vm
+        while limit is None or limit > 0:
+            chunk = limit
+            if self.checkpoint_every:
+                self.periodic_checkpoint()
+                next_checkpoint = self.checkpoint_every - self.steps % self.checkpoint_every
+                chunk = next_checkpoint if chunk is None else min(chunk, next_checkpoint)
+            hit, count = vm.run(chunk)
+            self.steps += count
+            if limit is not None:
+                limit -= count
+            if hit is not None:
+                return hit
+        return None
 
     def do_load_main(self, arg):
         print("!! Loading main from main instance in the special object array")
@@ -27,7 +61,7 @@ class STVMDebugger(Cmd):
         """
         process = self.vm.active_process
         while process is self.vm.active_process:
-            self.vm.decode_execute(self.vm.fetch())
+            self.execute()
         self.do_stack("")
         self.do_list("")
         print(f"<*> Process {self.vm.active_process.display()}")
@@ -38,7 +72,7 @@ class STVMDebugger(Cmd):
         """
         try:
             while True:
-                self.vm.decode_execute(self.vm.fetch())
+                self.execute()
         except DebugException as e:
             print(f"{colors.fg.red}Stopped on exception >> {e} in {self.vm.current_context.compiled_method.selector.as_text()}")
             print(colors.reset)
@@ -84,7 +118,7 @@ class STVMDebugger(Cmd):
         """
         Performs a step-into
         """
-        self.vm.decode_execute(self.vm.fetch())
+        self.execute()
         self.do_stack("")
         self.do_list("")
 
@@ -98,21 +132,82 @@ class STVMDebugger(Cmd):
         current = self.vm.fetch()
         while current != bc:
             self.vm.decode_execute(current)
+            self.steps += 1
             current = self.vm.fetch()
         self.do_stack("")
         self.do_list("")
 
     def do_break(self, arg):
         """
-        Break on a method execution
-        arg:     the selector
-        example: break +
+        Adds a breakpoint, the execution stops on it with "continue"
+        arg:     a selector, a method (Class>>selector) with an optional pc,
+                 or a primitive number, followed by an optional condition
+                 "if <python expression>" on vm, context, receiver and args
+        example: break printOn:
+                 break OrderedCollection>>add: 45
+                 break prim 60 if to_python(args[0], vm) > 10
+        """
+        from .breakpoints import Breakpoint, METHOD, PC, SELECTOR, PRIMITIVE
+        vm = self.vm
+        arg, _, condition = arg.partition(" if ")
+        words = arg.split()
+        if not words:
+            return self.do_breakpoints("")
+        try:
+            if words[0] == "prim":
+                breakpoint = Breakpoint(PRIMITIVE, int(words[1]), description=arg.strip())
+            elif ">>" in words[0]:
+                class_name, selector = words[0].split(">>")
+                cls = vm.lookup_global(class_name.strip())
+                if len(words) > 1 and words[1] == "class":
+                    cls = cls.class_
+                method = vm.lookup(cls, vm.find_selector(cls, selector))
+                if len(words) > 1 and words[-1].isdigit():
+                    breakpoint = Breakpoint(PC, (method.address, int(words[-1])), description=arg.strip())
+                else:
+                    breakpoint = Breakpoint(METHOD, method.address, description=arg.strip())
+            else:
+                selector = vm.names.symbol(words[0])
+                if selector is None:
+                    raise KeyError(words[0])
+                breakpoint = Breakpoint(SELECTOR, selector.address, description=arg.strip())
+        except Exception as e:
+            print(f"{colors.fg.red}Cannot resolve the breakpoint {arg.strip()} ({e!r}){colors.reset}")
+            return
+        if condition.strip():
+            breakpoint.condition = self.condition(condition.strip())
+            breakpoint.description += f" if {condition.strip()}"
+        vm.add_breakpoint(breakpoint)
+        print(f"{colors.fg.purple}Breakpoint {len(vm.breakpoints) - 1}: {breakpoint.description}{colors.reset}")
+
+    @staticmethod
+    def condition(expression):
+        from .utils import to_python
+        code = compile(expression, "<breakpoint>", "eval")
+
+        def check(vm, context):
+            names = {"vm": vm, "context": context, "receiver": context.receiver,
+                     "args": context.args, "to_python": to_python}
+            return eval(code, names)
+        return check
+
+    def do_breakpoints(self, arg):
         """
-        name = arg.strip()
-        while self.vm.current_context.compiled_method.selector.as_text() != name:
-            self.vm.decode_execute(self.vm.fetch())
-        self.do_stack("")
-        self.do_list("")
+        Lists the breakpoints
+        """
+        for i, breakpoint in enumerate(self.vm.breakpoints.all):
+            state = "" if breakpoint.enabled else " (disabled)"
+            print(f"{colors.fg.purple}{i}{colors.reset}: {breakpoint.description}{state} hits={breakpoint.hits}")
+
+    def do_delete(self, arg):
+        """
+        Removes a breakpoint, or all of them
+        arg:     the breakpoint number (from "breakpoints"), none for all
+        example: delete 0
+        """
+        breakpoints = self.vm.breakpoints.all
+        for breakpoint in ([breakpoints[int(arg)]] if arg.strip() else list(breakpoints)):
+            self.vm.remove_breakpoint(breakpoint)
 
     def do_time(self, arg):
         """
@@ -126,7 +221,7 @@ class STVMDebugger(Cmd):
         count = 0
         while end > datetime.datetime.now():
             count += 1
-            self.vm.decode_execute(self.vm.fetch())
+            self.execute()
 
         purple = colors.fg.purple
         yellow = colors.fg.yellow
@@ -141,14 +236,14 @@ class STVMDebugger(Cmd):
         """
         limit = 5000000 if not arg else int(arg)
         try:
-            count = 0
             a = datetime.datetime.now()
-            while True:
-                self.vm.decode_execute(self.vm.fetch())
-                count += 1
-                if count > limit:
-                    b = datetime.datetime.now()
-                    raise StopIteration(f"Looping too long {b-a}")
+            breakpoint = self.run(limit)
+            if breakpoint is None:
+                b = datetime.datetime.now()
+                raise StopIteration(f"Looping too long {b-a}")
+            print(f"{colors.fg.purple}Breakpoint {breakpoint.description} (hits={breakpoint.hits}){colors.reset}")
+            self.do_stack("")
+            self.do_list("")
         except Exception as e:
             try:
                 self.do_list("full")
@@ -165,17 +260,144 @@ class STVMDebugger(Cmd):
         Performs a "step over"
         """
         context = self.vm.current_context
-        past_ctx = []
+        past_ctx = set()
         while context:
-            past_ctx.append(context)
+            past_ctx.add(id(context))
             context = context.sender
         while "not same context":
-            self.vm.decode_execute(self.vm.fetch())
-            if self.vm.current_context in past_ctx:
+            self.execute()
+            if id(self.vm.current_context) in past_ctx:
                 break
         self.do_stack("")
         self.do_list("")
 
+    def do_checkpoint(self, arg):
+        """
+        Takes a checkpoint of the VM state
+        arg:     if a number, takes a checkpoint automatically every "arg"
+                 bytecodes (0 to disable)
+        example: checkpoint 1000000
+        """
+        if arg.strip():
+            self.checkpoint_every = int(arg)
+            return
+        self.vm.checkpoint(self.steps)
+        print(f"{colors.fg.purple}Checkpoint {len(self.vm.checkpoints) - 1} at step {self.steps}{colors.reset}")
+
+    def do_checkpoints(self, arg):
+        """
+        Lists the checkpoints
+        """
+        for i, cp in enumerate(self.vm.checkpoints):
+            print(f"{colors.fg.purple}{i:>4}{colors.fg.yellow}  step {str(cp.label):<12}{colors.fg.darkgrey} {len(cp.pages)} pages{colors.reset}")
+
+    def do_restore(self, arg):
+        """
+        Restores a checkpoint
+        arg:     the checkpoint number (the last one by default)
+        example: restore 2
+        """
+        checkpoints = self.vm.checkpoints
+        if not checkpoints:
+            print(f"{colors.fg.red}No checkpoint{colors.reset}")
+            return
+        cp = checkpoints[int(arg)] if arg.strip() else checkpoints[-1]
+        self.vm.restore(cp)
+        # the checkpoints taken from the debugger are labeled with their step
+        if isinstance(cp.label, int):
+            self.steps = cp.label
+        else:
+            print(f"{colors.fg.red}Checkpoint {cp.label!r} has no step, the step counter is kept{colors.reset}")
+        self.do_stack("")
+        self.do_list("")
+
+    def do_goto(self, arg):
+        """
+        Goes to a step, restoring the nearest checkpoint before it and
+        executing the bytecodes from there
+        arg:     the step number
+        example: goto 4500000
+        """
+        step = int(arg)
+        candidates = [cp for cp in self.vm.checkpoints
+                      if isinstance(cp.label, int) and cp.label <= step]
+        if candidates:
+            cp = max(candidates, key=lambda cp: cp.label)
+            if step < self.steps or cp.label > self.steps:
+                self.vm.restore(cp)
+                self.steps = cp.label
+        if step < self.steps:
+            print(f"{colors.fg.red}No checkpoint before step {step}{colors.reset}")
+            return
+        while self.steps < step:
+            self.execute()
+        self.do_stack("")
+        self.do_list("")
+
+    def do_trace(self, arg):
+        """
+        Records the executed bytecodes in a trace file (see stvm.trace)
+        arg:     the trace file, or 'stop' to stop the recording
+        example: trace run1.trace
+        """
+        from .trace import TraceRecorder
+        recorder = self.recorder
+        if recorder is not None:
+            self.vm.remove_execute_hook(recorder)
+            recorder.close()
+            self.recorder = None
+            print(f"{colors.fg.purple}{recorder.total} bytecodes recorded in {recorder.path}{colors.reset}")
+        if arg.strip() and arg.strip() != "stop":
+            self.recorder = TraceRecorder(arg.strip())
+            self.vm.add_execute_hook(self.recorder)
+
+    def do_profile(self, arg):
+        """
+        Profiles the executed bytecodes, prints the report when stopped
+        arg:     the sampling period in bytecodes of the Smalltalk stacks, or
+                 'stop [file]' to stop and write the sampled stacks (folded format)
+        example: profile 1000
+                 profile stop fib.folded
+        """
+        from .profiler import BytecodeProfiler
+        args = arg.split()
+        profiler = self.profiler
+        if profiler is not None:
+            self.vm.remove_execute_hook(profiler)
+            profiler.finish()
+            self.profiler = None
+            print(f"{colors.fg.purple}{profiler.report(self.vm)}{colors.reset}")
+            if len(args) > 1:
+                profiler.write_folded(args[1])
+        if not args or args[0] != "stop":
+            self.profiler = BytecodeProfiler(int(args[0]) if args else 1000)
+            self.vm.add_execute_hook(self.profiler)
+
+    def do_sample(self, arg):
+        """
+        Samples the Smalltalk stack from a background thread while the VM runs
+        arg:     the sampling period in milliseconds, or 'stop file' to stop
+                 and write the samples (speedscope for .json, folded otherwise)
+        example: sample 5
+                 sample stop run.json
+        """
+        from .profiler import SamplingProfiler
+        args = arg.split()
+        sampler = self.vm.sampler
+        if args and args[0] == "stop":
+            if sampler is None:
+                return
+            sampler.stop()
+            self.vm.sampler = None
+            print(f"{colors.fg.purple}{sampler.total} samples, {sampler.dropped} dropped{colors.reset}")
+            if len(args) > 1:
+                sampler.write(args[1])
+            return
+        if sampler is None:
+            interval = float(args[0]) / 1000 if args else 0.005
+            self.vm.sampler = SamplingProfiler(self.vm, interval)
+        self.vm.sampler.start()
+
     def do_metadebug(self, arg):
         """
         Launch the python debugger (IPDB) here
@@ -296,6 +518,41 @@ class STVMDebugger(Cmd):
         print("temps    [", *[s.display() for s in context.temps], ']')
         print("pc       ", context.pc)
 
+    def do_segments(self, arg):
+        """
+        Displays the memory segments (image segments and allocation segment)
+        """
+        memory = self.vm.memory
+        for segment in memory.segments:
+            print(f"{colors.fg.purple}{segment}{colors.reset}")
+        allocator = self.vm.allocator
+        used = allocator.current - allocator.start
+        print(f"{colors.fg.yellow}allocated {used} bytes, {allocator.limit - allocator.current} free{colors.reset}")
+
+    def do_dirty(self, arg):
+        """
+        Displays the memory pages written since the last 'dirty clear'
+        arg: 'clear' to forget the pages written so far
+        """
+        memory = self.vm.memory
+        if arg.strip() == "clear":
+            memory.clear_dirty()
+            return
+        pages = list(memory.dirty_pages())
+        print(f"{colors.fg.purple}{len(pages)} dirty pages{colors.reset}")
+        for address in pages:
+            print(f"    {colors.fg.yellow}0x{address:x}{colors.reset}")
+
+    def do_heap(self, arg):
+        """
+        Displays the classes using the most memory
+        arg: the number of classes to display (default 20)
+        """
+        from .heap import HeapIndex
+        limit = int(arg) if arg.strip() else 20
+        for class_index, name, count, size in HeapIndex(self.vm.memory).report(limit):
+            print(f"{colors.fg.purple}{name:<40}{colors.fg.yellow}{count:>10} instances {size:>12} bytes{colors.reset}")
+
     def do_active_process(self, arg):
         """
         Displays the active process
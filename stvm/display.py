@@ -0,0 +1,290 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+class Damage(object):
+    """
+    Rectangles (left, top, right, bottom) modified since the last flush.
+    A new rectangle is merged with the ones it overlaps or touches, past
+    `max_rects` rectangles they are all merged in their bounding box.
+    """
+    def __init__(self, max_rects=32):
+        self.max_rects = max_rects
+        self.rects = []
+
+    def __bool__(self):
+        return bool(self.rects)
+
+    def add(self, left, top, right, bottom):
+        if left >= right or top >= bottom:
+            return
+        rects = self.rects
+        i = 0
+        while i < len(rects):
+            l, t, r, b = rects[i]
+            if left <= r and l <= right and top <= b and t <= bottom:
+                left, top, right, bottom = min(left, l), min(top, t), max(right, r), max(bottom, b)
+                # the merged rectangle can now touch the previous ones
+                del rects[i]
+                i = 0
+            else:
+                i += 1
+        rects.append((left, top, right, bottom))
+        if len(rects) > self.max_rects:
+            self.rects = [self.bounds()]
+
+    def bounds(self):
+        rects = self.rects
+        return (min(r[0] for r in rects), min(r[1] for r in rects),
+                max(r[2] for r in rects), max(r[3] for r in rects))
+
+    def take(self):
+        rects = self.rects
+        self.rects = []
+        return rects
+
+
+def indexed_colors():
+    """RGB of the Squeak indexed colors, used for the depths up to 8"""
+    colors = [(255, 255, 255), (0, 0, 0), (255, 255, 255), (128, 128, 128),
+              (255, 0, 0), (0, 255, 0), (0, 0, 255), (0, 255, 255), (255, 255, 0), (255, 0, 255)]
+    colors += [(round(v * 255),) * 3 for v in (0.125, 0.25, 0.375, 0.625, 0.75, 0.875)]
+    colors += [(round(i * 255 / 32),) * 3 for i in range(1, 32) if i % 4]
+    colors += [None] * 216
+    for r in range(6):
+        for g in range(6):
+            for b in range(6):
+                colors[40 + 36 * r + 6 * b + g] = (r * 51, g * 51, b * 51)
+    return colors
+
+
+def rgb_of(form, rect):
+    """RGB bytes of the pixels of a Form in rect, as a (height, width, 3) array"""
+    import numpy as np
+    from .plugins.BitBltPlugin import Form
+    left, top, right, bottom = rect
+    form = Form(form)
+    pixels = form.read(left, top, right - left, bottom - top)
+    if form.depth == 32:
+        channels = (pixels >> 16, pixels >> 8, pixels)
+    elif form.depth == 16:
+        channels = (((pixels >> shift) & 0x1F) * 255 // 31 for shift in (10, 5, 0))
+    else:
+        palette = np.array(indexed_colors(), dtype=np.uint8)
+        return palette[pixels]
+    return np.stack([(c & 0xFF).astype(np.uint8) for c in channels], axis=-1)
+
+
+def png_bytes(rgb):
+    """PNG image of a (height, width, 3) array of bytes"""
+    import numpy as np
+    height, width, _ = rgb.shape
+    # filter type 0 in front of each row
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgb.reshape(height, width * 3)
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows.tobytes(), 6))
+            + chunk(b"IEND", b""))
+
+
+class HeadlessDisplay(object):
+    """
+    Display without a window: the Display form of the image is the
+    framebuffer. The rectangles shown by primitive 127 and the BitBlt
+    writes on the Display are recorded as damage, and presented on each
+    flush (primitives 127 when updates are not deferred, and 231).
+    When `frames` is a directory, a PNG of the display is written there
+    at most every `frame_interval` seconds, if it changed.
+    """
+    def __init__(self, vm, size=(1024, 768), depth=32, frames=None, frame_interval=1.0):
+        self.vm = vm
+        self.size = size
+        self.depth = depth
+        self.damage = Damage()
+        self.frames = Path(frames) if frames else None
+        self.frame_interval = frame_interval
+        self.last_frame = 0.0
+        self.changed = False
+        self.version = 0
+        self.viewer = None
+        self.stats = {"flushes": 0, "rects": 0, "pixels": 0, "frames": 0, "encode_seconds": 0.0}
+
+    @property
+    def form(self):
+        form = self.vm.memory.special_object_array[14]
+        return None if form is self.vm.memory.nil else form
+
+    def be_display(self, form):
+        self.size = (form[1].value, form[2].value)
+        self.depth = abs(form[3].value)
+        self.damage.add(0, 0, *self.size)
+
+    def show(self, left, top, right, bottom):
+        width, height = self.size
+        self.damage.add(max(left, 0), max(top, 0), min(right, width), min(bottom, height))
+
+    def blitted(self, bits, rect):
+        """Called by BitBlt with the rectangle (x, y, width, height) it wrote in bits"""
+        form = self.form
+        if form is None or self.vm.defer_screen_update or bits.address != form[0].address:
+            return
+        x, y, w, h = rect
+        self.show(x, y, x + w, y + h)
+
+    def flush(self):
+        """Presents the damaged rectangles, answers them"""
+        rects = self.damage.take()
+        if not rects:
+            return rects
+        stats = self.stats
+        stats["flushes"] += 1
+        stats["rects"] += len(rects)
+        stats["pixels"] += sum((r - l) * (b - t) for l, t, r, b in rects)
+        self.version += 1
+        self.changed = True
+        self.present(rects)
+        if self.frames and time.monotonic() - self.last_frame >= self.frame_interval:
+            self.write_frame()
+        return rects
+
+    def present(self, rects):
+        ...
+
+    def frame(self, rect=None):
+        """PNG of the display, or of a rectangle of it"""
+        start = time.perf_counter()
+        data = png_bytes(rgb_of(self.form, rect or (0, 0, *self.size)))
+        self.stats["encode_seconds"] += time.perf_counter() - start
+        return data
+
+    def write_frame(self):
+        if not self.changed or self.form is None:
+            return None
+        self.frames.mkdir(parents=True, exist_ok=True)
+        path = self.frames / f"frame-{self.stats['frames']:06d}.png"
+        path.write_bytes(self.frame())
+        self.stats["frames"] += 1
+        self.last_frame = time.monotonic()
+        self.changed = False
+        return path
+
+    def serve(self, port=8000, host="127.0.0.1"):
+        """Serves the display to a browser, on a thread"""
+        self.viewer = Viewer(self, (host, port))
+        threading.Thread(target=self.viewer.serve_forever, daemon=True).start()
+        return self.viewer
+
+    def close(self):
+        if self.viewer is not None:
+            self.viewer.shutdown()
+            self.viewer.server_close()
+            self.viewer = None
+
+
+class PygameDisplay(HeadlessDisplay):
+    """Presents the damaged rectangles in a pygame window"""
+    def be_display(self, form):
+        import pygame
+        super().be_display(form)
+        pygame.init()
+        self.screen = pygame.display.set_mode(self.size)
+
+    def present(self, rects):
+        import pygame
+        for left, top, right, bottom in rects:
+            rgb = rgb_of(self.form, (left, top, right, bottom))
+            surface = pygame.image.frombuffer(rgb.tobytes(), (right - left, bottom - top), "RGB")
+            self.screen.blit(surface, (left, top))
+        pygame.display.update([pygame.Rect(l, t, r - l, b - t) for l, t, r, b in rects])
+        pygame.event.pump()
+
+
+VIEWER_PAGE = b"""<!DOCTYPE html>
+<html><body style="margin:0;background:#444">
+<img id="display" src="frame.png">
+<script>
+  let version = null;
+  setInterval(async () => {
+    const current = await (await fetch("version")).text();
+    if (current !== version) {
+      version = current;
+      document.getElementById("display").src = "frame.png?" + current;
+    }
+  }, 200);
+</script>
+</body></html>
+"""
+
+
+class ViewerHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        display = self.server.display
+        path = self.path.split("?")[0]
+        if path == "/":
+            self.reply(VIEWER_PAGE, "text/html")
+        elif path == "/version":
+            self.reply(str(display.version).encode(), "text/plain")
+        elif path == "/frame.png" and display.form is not None:
+            self.reply(self.server.frame(), "image/png")
+        else:
+            self.send_error(404)
+
+    def reply(self, data, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        ...
+
+
+class Viewer(ThreadingHTTPServer):
+    """Local web page showing the display, refreshed when it changes"""
+    daemon_threads = True
+
+    def __init__(self, display, address):
+        super().__init__(address, ViewerHandler)
+        self.display = display
+        self.lock = threading.Lock()
+        self.cached = (None, None)
+
+    def frame(self):
+        # encoded once per version of the display
+        with self.lock:
+            version, data = self.cached
+            if version != self.display.version:
+                version = self.display.version
+                data = self.display.frame()
+                self.cached = (version, data)
+            return data
+
+
+def display_from_environment(vm):
+    """
+    Creates the display of the VM run by debug.py. STVM_DISPLAY selects the backend,
+    "headless" (the default) or "pygame". For the headless display,
+    STVM_DISPLAY_SIZE gives the screen size (1024x768), STVM_FRAMES a
+    directory where PNG frames are written every STVM_FRAME_INTERVAL
+    seconds, and STVM_VIEWER_PORT the port of the local viewer.
+    """
+    env = os.environ
+    width, height = (int(v) for v in env.get("STVM_DISPLAY_SIZE", "1024x768").split("x"))
+    cls = PygameDisplay if env.get("STVM_DISPLAY") == "pygame" else HeadlessDisplay
+    display = cls(vm, size=(width, height), frames=env.get("STVM_FRAMES"),
+                  frame_interval=float(env.get("STVM_FRAME_INTERVAL", 1.0)))
+    if env.get("STVM_VIEWER_PORT"):
+        display.serve(int(env["STVM_VIEWER_PORT"]))
+    return display
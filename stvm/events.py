@@ -0,0 +1,199 @@
+import heapq
+import itertools
+import os
+import selectors
+import time
+from collections import deque
+
+# Smalltalk clocks count from 1901-01-01, python ones from 1970-01-01
+SMALLTALK_EPOCH_OFFSET = 2177452800
+
+
+def utc_microseconds():
+    return int(round((time.time() + SMALLTALK_EPOCH_OFFSET) * 1000000))
+
+
+class Timer(object):
+    def __init__(self, deadline, sequence, semaphore):
+        self.deadline = deadline
+        self.sequence = sequence
+        self.semaphore = semaphore
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.sequence) < (other.deadline, other.sequence)
+
+
+class EventQueue(object):
+    """
+    Timers and asynchronous signals for the VM.
+    Timer deadlines are kept in a heap ordered on the monotonic clock.
+    Signals coming from other threads are posted in a deque (appends and
+    pops are atomic) and consumed by the interpreter when it checks for
+    interrupts, every `check_every` bytecodes or as soon as it is forced.
+    """
+    def __init__(self, vm, check_every=1000):
+        self.vm = vm
+        self.check_every = check_every
+        self.timers = []
+        self.sequence = itertools.count()
+        self.signals = deque()
+        self.image_timer = None
+        self.low_space_threshold = 0
+        self.low_space_signaled = False
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+        self.started = time.monotonic()
+        self.idle_time = 0.0
+        self.idle_calls = 0
+
+    def add_timer(self, delay, semaphore):
+        deadline = time.monotonic() + delay
+        timer = Timer(deadline, next(self.sequence), semaphore)
+        heapq.heappush(self.timers, timer)
+        self.vm.force_interrupt_check()
+        return timer
+
+    def cancel_timer(self, timer):
+        if timer is not None:
+            timer.cancelled = True
+
+    def signal_at_utc_microseconds(self, semaphore, usecs):
+        # the image has a single timer semaphore, a new request replaces the old one
+        self.cancel_timer(self.image_timer)
+        self.image_timer = None
+        if semaphore is None:
+            return
+        delay = max(usecs - utc_microseconds(), 0) / 1000000
+        self.image_timer = self.add_timer(delay, semaphore)
+
+    def next_deadline(self):
+        timers = self.timers
+        while timers and timers[0].cancelled:
+            heapq.heappop(timers)
+        if not timers:
+            return None
+        return timers[0].deadline
+
+    def signal(self, semaphore):
+        """Thread safe, can be called from outside of the interpreter"""
+        self.signals.append(semaphore)
+        self.vm.force_interrupt_check()
+        try:
+            os.write(self.wakeup_write, b"!")
+        except BlockingIOError:
+            # the pipe is full, the interpreter is already going to wake up
+            ...
+
+    def signal_external(self, index):
+        """Signals the semaphore registered at index in the external objects array"""
+        self.signal(index)
+
+    def external_semaphore(self, index):
+        externals = self.vm.memory.special_object_array[38]
+        return externals[index - 1]
+
+    def check(self):
+        vm = self.vm
+        timers = self.timers
+        if timers:
+            now = time.monotonic()
+            while timers and timers[0].deadline <= now:
+                timer = heapq.heappop(timers)
+                if timer.cancelled:
+                    continue
+                if timer is self.image_timer:
+                    self.image_timer = None
+                vm.synchronous_signal(timer.semaphore)
+        signals = self.signals
+        while signals:
+            semaphore = signals.popleft()
+            if isinstance(semaphore, int):
+                semaphore = self.external_semaphore(semaphore)
+            vm.synchronous_signal(semaphore)
+        if self.low_space_threshold:
+            self.check_low_space()
+
+    def check_low_space(self):
+        vm = self.vm
+        free = vm.allocator.limit - vm.allocator.current
+        if free >= self.low_space_threshold:
+            self.low_space_signaled = False
+            return
+        if self.low_space_signaled:
+            return
+        self.low_space_signaled = True
+        semaphore = vm.memory.low_space_semaphore
+        if semaphore is not vm.memory.nil:
+            vm.synchronous_signal(semaphore)
+
+    def register_descriptor(self, fd, semaphore, events=selectors.EVENT_READ):
+        """
+        Signals semaphore when fd is ready. As for the aio functions of the
+        C VM, the registration is one-shot and has to be renewed by the
+        plugin once the semaphore has been signaled.
+        """
+        try:
+            self.selector.register(fd, events, semaphore)
+        except KeyError:
+            self.selector.modify(fd, events, semaphore)
+
+    def unregister_descriptor(self, fd):
+        try:
+            self.selector.unregister(fd)
+        except KeyError:
+            ...
+
+    def idle(self, max_delay=None):
+        """
+        Blocks until the next timer deadline, an asynchronous signal, a
+        registered descriptor being ready, or max_delay seconds, whichever
+        comes first.
+        """
+        delay = max_delay
+        deadline = self.next_deadline()
+        if deadline is not None:
+            until_deadline = max(deadline - time.monotonic(), 0)
+            delay = until_deadline if delay is None else min(delay, until_deadline)
+        if self.signals:
+            return
+        start = time.monotonic()
+        for key, _ in self.selector.select(delay):
+            if key.fd == self.wakeup_read:
+                self.drain_wakeup()
+                continue
+            self.unregister_descriptor(key.fd)
+            self.signals.append(key.data)
+        self.idle_time += time.monotonic() - start
+        self.idle_calls += 1
+        self.vm.force_interrupt_check()
+
+    def close(self):
+        """Releases the wakeup pipe and the selector, the queue is no longer usable"""
+        if self.selector is None:
+            return
+        self.unregister_descriptor(self.wakeup_read)
+        self.selector.close()
+        self.selector = None
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_read, 512):
+                ...
+        except BlockingIOError:
+            ...
+
+    def metrics(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "elapsed": elapsed,
+            "idle_time": self.idle_time,
+            "busy_time": elapsed - self.idle_time,
+            "idle_calls": self.idle_calls,
+            "idle_ratio": self.idle_time / elapsed if elapsed else 0.0,
+        }
@@ -0,0 +1,113 @@
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+
+
+# Class indexes up to 31 are puns used by Spur for free chunks, forwarders
+# and class table pages, objects using them are hidden from the image
+LAST_CLASS_INDEX_PUN = 31
+
+
+def walk(memory):
+    """
+    Walks over all the objects of the memory segments without creating any
+    proxy. Yields (address, class_index, format, num_slots) tuples, address
+    is the address of the header (the oop), not of the overflow word.
+    """
+    for segment in memory.segments:
+        words = segment.mem.cast("Q")
+        base = segment.start
+        i = 0
+        end = (segment.top - base) // 8
+        while i < end:
+            word = words[i]
+            num_slots = word >> 56
+            if num_slots == 0xFF:
+                # overflow word, the header follows
+                num_slots = word & 0x00FFFFFFFFFFFFFF
+                i += 1
+                word = words[i]
+            yield (base + i * 8, word & 0x3FFFFF, (word >> 24) & 0x1F, num_slots)
+            i += 1 + (num_slots or 1)
+
+
+def object_size(address, num_slots):
+    """Returns the start (with the overflow word) and the size of an object"""
+    if num_slots >= 255:
+        return address - 8, 16 + num_slots * 8
+    return address, 8 + (num_slots or 1) * 8
+
+
+def num_slots_at(memory, address):
+    num_slots = memory[address + 7]
+    if num_slots == 0xFF:
+        return memory[address - 8:address].cast("Q")[0] & 0x00FFFFFFFFFFFFFF
+    return num_slots
+
+
+class HeapIndex(object):
+    """
+    Index of the heap built in a single pass of the walker.
+    Keeps the instances of each class index, the start of each object to
+    resolve interior pointers, and counts/bytes per class index. Objects
+    allocated later on are registered with add().
+    """
+    def __init__(self, memory, build=True):
+        self.memory = memory
+        self.instances = defaultdict(lambda: array("Q"))
+        self.counts = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.starts = array("Q")
+        self.oops = array("Q")
+        if build:
+            self.build()
+
+    def build(self):
+        self.instances.clear()
+        self.counts.clear()
+        self.bytes.clear()
+        self.starts = array("Q")
+        self.oops = array("Q")
+        for address, class_index, _, num_slots in walk(self.memory):
+            self.add(address, class_index, num_slots)
+
+    def add(self, address, class_index, num_slots):
+        start, size = object_size(address, num_slots)
+        self.starts.append(start)
+        self.oops.append(address)
+        if class_index <= LAST_CLASS_INDEX_PUN:
+            return
+        self.instances[class_index].append(address)
+        self.counts[class_index] += 1
+        self.bytes[class_index] += size
+
+    def instances_of(self, class_index):
+        return self.instances.get(class_index, ())
+
+    def all_objects(self):
+        for class_index, addresses in self.instances.items():
+            yield from addresses
+
+    def object_containing(self, address):
+        """Returns the oop of the object containing address or None"""
+        i = bisect_right(self.starts, address) - 1
+        if i < 0:
+            return None
+        oop = self.oops[i]
+        start, size = object_size(oop, num_slots_at(self.memory, oop))
+        if address >= start + size:
+            return None
+        return oop
+
+    def report(self, limit=None):
+        """Returns (class_index, class name, count, bytes) sorted by bytes"""
+        class_table = self.memory.class_table
+        rows = []
+        for class_index, count in self.counts.items():
+            try:
+                name = class_table[class_index].name
+            except Exception:
+                name = f"<class index {class_index}>"
+            rows.append((class_index, name, count, self.bytes[class_index]))
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows[:limit]
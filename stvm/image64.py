@@ -1,5 +1,7 @@
 import mmap
 import struct
+from array import array
+from bisect import bisect_right
 from pathlib import Path
 from .spurobjects import SpurObject, ImmediateInteger, ImmediateFloat, ImmediateChar
 
@@ -14,6 +16,12 @@ class ByteChunk(object):
     def __get__(self, obj, objtype=None):
         return int.from_bytes(obj.header[self.start: self.start + self.size], byteorder="little")
 
+    def __set__(self, obj, value):
+        obj.header[self.start: self.start + self.size] = value.to_bytes(self.size, byteorder="little")
+
+
+FLOAT_CACHE_SIZE = 1024
+
 
 class SpurMemoryHandler(object):
     special_array = {
@@ -30,11 +38,13 @@ class SpurMemoryHandler(object):
         "largepositiveint": 13,
         "message": 15,
         "compiled_method_class": 16,
+        "low_space_semaphore": 17,
         "semaphore": 18,
         "character": 19,
         "dnuSelector": 20,
         "timer_semaphore": 29,
         "special_symbols": 23,
+        "bytearray": 26,
         "process": 27,
         "interrupt_semaphore": 30,
         "block_closure_class": 36,
@@ -44,6 +54,11 @@ class SpurMemoryHandler(object):
         self.memory = memory
         self.cache = {}
         self.integers = []
+        # decoded text of the symbols, address -> str
+        self.texts = {}
+        # recent SmallFloat64, they are not kept in the cache with the other objects
+        self.floats = {}
+        self._symbol_index = None
 
     def init_const(self):
         for name, pos in self.special_array.items():
@@ -75,11 +90,36 @@ class SpurMemoryHandler(object):
         elif address_kind == 3:
             import ipdb; ipdb.set_trace()
         elif address_kind == 4:
-            obj = ImmediateFloat(address, self.memory)
+            return self.float_at(address)
 
         self.cache[address] = obj
         return obj
 
+    def float_at(self, address):
+        """
+        Proxy of a SmallFloat64. Only the last FLOAT_CACHE_SIZE proxies are
+        kept, so two proxies of the same float can be different objects:
+        they compare equal (==, hash) on their oop, identity in the image
+        is the comparison of the addresses (primitives 110 and 169), and
+        float proxies must never be compared with `is`.
+        """
+        floats = self.floats
+        try:
+            return floats[address]
+        except KeyError:
+            if len(floats) >= FLOAT_CACHE_SIZE:
+                # the oldest entry goes
+                del floats[next(iter(floats))]
+            obj = floats[address] = ImmediateFloat(address, self.memory)
+            return obj
+
+    @property
+    def symbol_index(self):
+        """Class index of ByteSymbol"""
+        if self._symbol_index is None:
+            self._symbol_index = self.special_object_array[self.special_array["special_symbols"]][0].class_index
+        return self._symbol_index
+
     @property
     def free_list(self):
         # self.true.next_object
@@ -91,23 +131,158 @@ class SpurMemoryHandler(object):
         return self.object_at(self.free_list.end_address + 8, class_table=True)
 
 
+class Segment(object):
+    """
+    A segment of the old space as saved in the image file.
+    start is the address of the segment in the object space, size includes
+    the bridge (the two last words) which gives the gap up to the next
+    segment and the size of the next segment (0 for the last one).
+    """
+    bridge_size = 16
+
+    def __init__(self, index, start, size, file_offset, bridge_span=0, next_size=0):
+        self.index = index
+        self.start = start
+        self.size = size
+        self.file_offset = file_offset
+        self.bridge_span = bridge_span
+        self.next_size = next_size
+
+    @property
+    def end(self):
+        return self.start + self.size
+
+    @property
+    def objects_end(self):
+        return self.end - self.bridge_size
+
+    def __repr__(self):
+        return (f"<Segment {self.index} 0x{self.start:x}-0x{self.end:x} size={self.size} "
+                f"file_offset={self.file_offset} bridge_span={self.bridge_span}>")
+
+
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+
+
+class MemorySegment(object):
+    def __init__(self, start, mem, segment=None):
+        self.start = start
+        self.end = start + len(mem)
+        self.mem = mem
+        self.segment = segment
+        # end of the objects, moved by the allocator for the allocation segment
+        self.top = segment.objects_end if segment else start
+        # generation of the last write of each page, 0 for the pages not
+        # written since the segment was loaded (see VMMemory.new_generation)
+        nb_pages = (len(mem) + PAGE_SIZE - 1) >> PAGE_SHIFT
+        self.written = array("I", bytes(4 * nb_pages))
+        self.generation = 1
+
+    def mark_dirty(self, address, size=1):
+        start = (address - self.start) >> PAGE_SHIFT
+        end = (address - self.start + size - 1) >> PAGE_SHIFT
+        written = self.written
+        generation = self.generation
+        for page in range(start, end + 1):
+            written[page] = generation
+
+    def dirty_pages(self, since=0):
+        """Yields the offsets in the segment of the pages written after the generation since"""
+        for page, generation in enumerate(self.written):
+            if generation > since:
+                yield page << PAGE_SHIFT
+
+    def __repr__(self):
+        kind = "image" if self.segment else "allocation"
+        return f"<MemorySegment {kind} 0x{self.start:x}-0x{self.end:x}>"
+
+
 class VMMemory(object):
-    def __init__(self, image):
+    allocation_alignment = 1024 * 1024
+    default_allocation_size = 256 * 1024 * 1024
+
+    def __init__(self, image, allocation_size=None):
         self.image = image
-        old = image.old_base_address
-        header_end = image.header_size
-        objects = image.map[header_end:]
-        self.mem = memoryview(bytearray(b'0' * (old + len(objects))))
-        self.mem[old:] = objects
+        self.segments = image.map_segments()
+        last = self.segments[-1]
+        alignment = self.allocation_alignment
+        start = (last.end + alignment - 1) // alignment * alignment
+        size = allocation_size or self.default_allocation_size
+        # anonymous mapping, pages are only really allocated when touched
+        self.allocation_segment = MemorySegment(start, memoryview(mmap.mmap(-1, size)))
+        self.segments.append(self.allocation_segment)
+        # generations of the writes, see new_generation()
+        self.generation = 1
+        self.cleared = 0
+        self.starts = [segment.start for segment in self.segments]
+        self.last_segment = self.segments[0]
+        # filled by the image cache, address -> trailer size
+        self.method_trailers = {}
         self.handler = SpurMemoryHandler(self)
         self.handler.init_const()
         self.handler.init_smallints()
 
+    def segment_at(self, address):
+        segment = self.last_segment
+        if segment.start <= address < segment.end:
+            return segment
+        segment = self.segments[bisect_right(self.starts, address) - 1]
+        if not segment.start <= address < segment.end:
+            raise IndexError(f"Address 0x{address:x} is not in a segment")
+        self.last_segment = segment
+        return segment
+
     def __getitem__(self, i):
-        return self.mem[i]
+        if isinstance(i, slice):
+            segment = self.segment_at(i.start)
+            start = segment.start
+            return segment.mem[i.start - start:i.stop - start]
+        segment = self.segment_at(i)
+        return segment.mem[i - segment.start]
 
     def __setitem__(self, i, value):
-        self.mem[i] = value
+        if isinstance(i, slice):
+            segment = self.segment_at(i.start)
+            start = segment.start
+            segment.mem[i.start - start:i.stop - start] = value
+            segment.mark_dirty(i.start, i.stop - i.start)
+            return
+        segment = self.segment_at(i)
+        segment.mem[i - segment.start] = value
+        segment.mark_dirty(i)
+
+    def mark_dirty(self, address, size=8):
+        """Has to be called by the writers going directly through memoryviews"""
+        self.segment_at(address).mark_dirty(address, size)
+
+    def dirty_pages(self, since_load=False):
+        """
+        Yields the addresses of the pages written since the last
+        clear_dirty(), or since the memory was loaded.
+        """
+        return self.dirty_pages_since(0 if since_load else self.cleared)
+
+    def dirty_pages_since(self, generation):
+        """Yields the addresses of the pages written after a generation"""
+        for segment in self.segments:
+            for offset in segment.dirty_pages(generation):
+                yield segment.start + offset
+
+    def new_generation(self):
+        """
+        Starts a new generation of writes and answers the one that ends.
+        Each user of the dirty pages (clear_dirty, the checkpoints) keeps
+        the generation it saw last, so they do not reset each other.
+        """
+        generation = self.generation
+        self.generation += 1
+        for segment in self.segments:
+            segment.generation = self.generation
+        return generation
+
+    def clear_dirty(self):
+        self.cleared = self.new_generation()
 
     @property
     def special_object_oop(self):
@@ -129,7 +304,7 @@ class VMMemory(object):
         return self.handler.object_at(address)
 
 
-class Image(object):
+class ImageHeader(object):
     image_version = ByteChunk(size=4)
     header_size = ByteChunk(size=4, after=image_version)
     data_size = ByteChunk(size=8, after=header_size)
@@ -140,33 +315,97 @@ class Image(object):
     header_flags = ByteChunk(size=8, after=saved_window_size)
     extra_VM_memory = ByteChunk(size=4, after=header_flags)
     hdr_num_stack_pages = ByteChunk(size=2, after=extra_VM_memory)
-    hdr_eden_bytes = ByteChunk(size=4, after=hdr_num_stack_pages)
+    hdr_cog_code_size = ByteChunk(size=2, after=hdr_num_stack_pages)
+    hdr_eden_bytes = ByteChunk(size=4, after=hdr_cog_code_size)
     hdr_max_ext_sem_tab_size = ByteChunk(size=2, after=hdr_eden_bytes)
-    second_unknown_short = ByteChunk(size=4, after=hdr_max_ext_sem_tab_size)  # TODO: check
+    second_unknown_short = ByteChunk(size=2, after=hdr_max_ext_sem_tab_size)  # unused
     first_seg_size = ByteChunk(size=8, after=second_unknown_short)
+    free_old_space = ByteChunk(size=8, after=first_seg_size)
+
+    def __init__(self, header):
+        self.header = header
+
 
+class Image(ImageHeader):
     def __init__(self, filename, load=True):
         self.file = Path(filename).resolve()
+        self.data = None
         self.map = None
         self.header = None
         self.object_space = None
+        self.segments = []
         self.handler = SpurMemoryHandler(self)
         if load:
             self.load()
 
+    @classmethod
+    def from_bytes(cls, data, filename="memory.image"):
+        """Image from its content instead of a file (e.g: a synthetic image)"""
+        image = cls(filename, load=False)
+        image.data = bytes(data)
+        image.load()
+        return image
+
     def load(self):
-        with open(self.file, mode="br") as f:
-            memory = mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ)
-            self.map = memoryview(memory)
-            self.header = self.map[:80]
-            self.object_space = self.map[self.header_size:]
+        if self.data is not None:
+            self.map = memoryview(self.data)
+        else:
+            with open(self.file, mode="br") as f:
+                self.map = memoryview(mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ))
+        self.header = self.map[:self.map[4:8].cast("I")[0]]
+        self.object_space = self.map[self.header_size:]
+        self.segments = self.read_segments()
+
+    def read_segments(self):
+        header_size = self.header_size
+        data_end = header_size + self.data_size
+        size = self.first_seg_size
+        if size == 0:
+            # no segment information, everything is a single segment
+            return [Segment(0, self.old_base_address, self.data_size, header_size)]
+        segments = []
+        offset = header_size
+        start = self.old_base_address
+        while size and offset + size <= data_end:
+            bridge = self.map[offset + size - Segment.bridge_size:offset + size].cast("Q")
+            span = (bridge[0] & 0x00FFFFFFFFFFFFFF) * 8
+            next_size = bridge[1]
+            segments.append(Segment(len(segments), start, size, offset, span, next_size))
+            offset += size
+            start += size + span
+            size = next_size
+        return segments
+
+    def map_segments(self):
+        """
+        Maps every segment in a private copy-on-write view of the file.
+        Pages are shared with the file cache (and between forked VMs) until
+        they are written.
+        """
+        if self.data is not None:
+            private = memoryview(bytearray(self.data))
+        else:
+            with open(self.file, mode="br") as f:
+                private = memoryview(mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_COPY))
+        segments = []
+        for segment in self.segments:
+            mem = private[segment.file_offset:segment.file_offset + segment.size]
+            segments.append(MemorySegment(segment.start, mem, segment))
+        return segments
+
+    def segment_at(self, address):
+        for segment in self.segments:
+            if segment.start <= address < segment.end:
+                return segment
+        raise IndexError(f"Address 0x{address:x} is not in a segment")
 
     def __getitem__(self, i):
-        offset = self.old_base_address
-        objects = self.object_space
         if isinstance(i, slice):
-            return objects[i.start - offset : i.stop - offset : i.step]
-        return objects[i - offset]
+            segment = self.segment_at(i.start)
+            offset = segment.file_offset - segment.start
+            return self.map[i.start + offset:i.stop + offset:i.step]
+        segment = self.segment_at(i)
+        return self.map[i + segment.file_offset - segment.start]
 
     def as_memory(self):
         return VMMemory(self)
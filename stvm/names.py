@@ -0,0 +1,48 @@
+from .heap import walk
+
+
+def symbol_table(memory):
+    """Text of the symbols -> address, read from the ByteSymbol instances of the heap"""
+    symbol_index = memory.handler.symbol_index
+    symbols = {}
+    for address, class_index, format, num_slots in walk(memory):
+        if class_index == symbol_index:
+            size = num_slots * 8 - (format - 16)
+            symbols.setdefault(str(memory[address + 8:address + 8 + size], "latin-1"), address)
+    return symbols
+
+
+def globals_table(memory):
+    """Name of the Smalltalk globals -> address of their binding"""
+    nil = memory.nil
+    bindings = {}
+    for binding in memory.smalltalk[0][1]:
+        if binding is not nil:
+            bindings[binding[0].as_text()] = binding.address
+    return bindings
+
+
+class NameIndex(object):
+    """
+    Resolves symbols and Smalltalk globals by name. Bindings are indexed
+    instead of their values, so a global assigned after the index is built
+    is still answered correctly.
+    """
+    def __init__(self, memory, image_cache=None):
+        self.memory = memory
+        self.symbols = dict(image_cache.symbols) if image_cache else symbol_table(memory)
+        self.globals = globals_table(memory)
+
+    def symbol(self, text):
+        address = self.symbols.get(text)
+        return None if address is None else self.memory.object_at(address)
+
+    def binding(self, name):
+        address = self.globals.get(name)
+        return None if address is None else self.memory.object_at(address)
+
+    def add_symbol(self, symbol):
+        self.symbols.setdefault(symbol.as_text(), symbol.address)
+
+    def add_binding(self, binding):
+        self.globals[binding[0].as_text()] = binding.address
@@ -1,40 +1,336 @@
+import numpy as np
 from ..spurobjects import ImmediateInteger as integer
-from ..utils import *
 from ..primitives import PrimitiveFail
 
 
+# instance variables of BitBlt
+(DEST_FORM, SOURCE_FORM, HALFTONE_FORM, COMBINATION_RULE, DEST_X, DEST_Y, WIDTH, HEIGHT,
+ SOURCE_X, SOURCE_Y, CLIP_X, CLIP_Y, CLIP_WIDTH, CLIP_HEIGHT, COLOR_MAP) = range(15)
 
-def primitiveCopyBits(self, context, vm):
-    print("Unexsting implementation of copybits")
-    try:
-        dst = self[0][0]
-        src = self[1][0]
-        destX = self[4].value
-        destY = self[5].value
-        width = self[6].value
-        height = self[7].value
-
-        # import pygame
-        # screen = vm.screen
-        # surface = pygame.Surface((width, height))
-        # pixelArray = pygame.PixelArray(surface)
-        #
-        # for y in range(height):
-        #     for x in range(width):
-        #         pixelArray[x, y] = src[y * height + x].value
-        #
-        # del pixelArray
-        # screen.blit(surface, (destX, destY))
-        # pygame.display.flip()
-    except Exception:
-        ...
-
-
-def primitiveDisplayString(component, string, start, stop, glyphMap, xTable, kern, context, vm):
-    import pygame
-    destX = component[6].value
-    screen = vm.screen
-    font = pygame.font.Font(None, 20)
-    text = font.render(string.as_text()[start.value-1:stop.value], True, (255, 0, 0))
-    screen.blit(text, (destX, 20))
-    pygame.display.flip()
+
+def int_value(obj):
+    if type(obj) is not integer:
+        raise PrimitiveFail("not a SmallInteger")
+    return obj.value
+
+
+def words_of(bitmap):
+    """32 bits words of a Bitmap, as a read-only numpy array sharing the memory of the object"""
+    if not 10 <= bitmap.object_format < 12:
+        raise PrimitiveFail("not a words object")
+    return np.frombuffer(bitmap.raw_slots, dtype="<u4", count=len(bitmap))
+
+
+class Form(object):
+    """
+    Pixels of a Form. Rows are made of 32 bits words, the first pixel of
+    a word is in its high bits, unless the depth is negative.
+    """
+    def __init__(self, form):
+        self.bits = form[0]
+        self.width = int_value(form[1])
+        self.height = int_value(form[2])
+        depth = int_value(form[3])
+        self.depth = abs(depth)
+        if self.depth not in (1, 2, 4, 8, 16, 32) or self.width < 0 or self.height < 0:
+            raise PrimitiveFail("unsupported form")
+        self.ppw = 32 // self.depth
+        self.pitch = (self.width + self.ppw - 1) // self.ppw
+        words = words_of(self.bits)
+        if len(words) < self.pitch * self.height:
+            raise PrimitiveFail("bits too small")
+        self.words = words[:self.pitch * self.height].reshape(self.height, self.pitch)
+        shifts = np.arange(self.ppw, dtype=np.uint32) * self.depth
+        self.shifts = shifts[::-1].copy() if depth > 0 else shifts
+        self.mask = np.uint32((1 << self.depth) - 1)
+
+    def unpack(self, words):
+        """One pixel per element for a 2 dimensional array of words"""
+        if self.ppw == 1:
+            return words.copy()
+        return ((words[:, :, None] >> self.shifts) & self.mask).reshape(len(words), -1)
+
+    def pack(self, pixels):
+        if self.ppw == 1:
+            return pixels
+        pixels = pixels.reshape(len(pixels), -1, self.ppw) << self.shifts
+        return np.bitwise_or.reduce(pixels, axis=2)
+
+    def words_range(self, x, w):
+        return x // self.ppw, (x + w - 1) // self.ppw + 1
+
+    def read(self, x, y, w, h):
+        first, last = self.words_range(x, w)
+        offset = x - first * self.ppw
+        return self.unpack(self.words[y:y + h, first:last])[:, offset:offset + w]
+
+    def update(self, x, y, w, h, merge):
+        """Replaces the pixels of the rectangle with merge(pixels), its rows are marked dirty"""
+        first, last = self.words_range(x, w)
+        offset = x - first * self.ppw
+        rows = self.bits.writable_slots(y * self.pitch * 4, (y + h) * self.pitch * 4)
+        words = np.frombuffer(rows, dtype="<u4").reshape(h, self.pitch)[:, first:last]
+        pixels = self.unpack(words)
+        pixels[:, offset:offset + w] = merge(pixels[:, offset:offset + w])
+        words[...] = self.pack(pixels)
+
+
+def rgb_16_to_32(pixels):
+    rgb = ((pixels & 0x7C00) << 9) | ((pixels & 0x3E0) << 6) | ((pixels & 0x1F) << 3)
+    # 0 is transparent, the other pixels are opaque
+    return np.where(pixels != 0, rgb | 0xFF000000, 0).astype(np.uint32)
+
+
+def rgb_32_to_16(pixels):
+    rgb = ((pixels >> 9) & 0x7C00) | ((pixels >> 6) & 0x3E0) | ((pixels >> 3) & 0x1F)
+    # black is not mapped to the transparent pixel
+    return np.where((rgb == 0) & ((pixels & 0xFFFFFF) != 0), 1, rgb).astype(np.uint32)
+
+
+def reduce_rgb(pixels, depth, bits):
+    """Keeps the high bits of each component, as an index in a color table"""
+    if depth == 16:
+        shifts = (10, 5, 0)
+        source_bits = 5
+    else:
+        shifts = (16, 8, 0)
+        source_bits = 8
+    index = np.zeros_like(pixels)
+    for i, shift in enumerate(shifts):
+        component = (pixels >> (shift + source_bits - bits)) & ((1 << bits) - 1)
+        index |= component << (bits * (2 - i))
+    return index
+
+
+class ColorMap(object):
+    """Bitmap used as a color table, or ColorMap with shifts, masks and colors"""
+    def __init__(self, color_map, source_depth, nil):
+        self.shifts = self.masks = self.colors = None
+        if 10 <= color_map.object_format < 12:
+            self.colors = words_of(color_map)
+        else:
+            shifts, masks, colors = color_map[0], color_map[1], color_map[2]
+            if shifts is not nil and masks is not nil:
+                self.shifts = words_of(shifts).view(np.int32)
+                self.masks = words_of(masks)
+            if colors is not nil:
+                self.colors = words_of(colors)
+        self.source_depth = source_depth
+        self.bits = None
+        if self.colors is not None and self.shifts is None and source_depth >= 16:
+            # tables indexed by the high bits of the color components
+            self.bits = {512: 3, 4096: 4, 32768: 5}.get(len(self.colors))
+            if self.bits is None:
+                raise PrimitiveFail("unsupported color map")
+
+    def __call__(self, pixels):
+        if self.shifts is not None:
+            mapped = np.zeros_like(pixels)
+            for shift, mask in zip(self.shifts, self.masks):
+                component = pixels & mask
+                shift = int(shift)
+                mapped |= component << shift if shift >= 0 else component >> -shift
+            pixels = mapped
+        elif self.bits is not None:
+            pixels = reduce_rgb(pixels, self.source_depth, self.bits)
+        if self.colors is not None:
+            if len(pixels) and pixels.max() >= len(self.colors):
+                raise PrimitiveFail("color map too small")
+            pixels = self.colors[pixels]
+        return pixels
+
+
+def alpha_blend(s, d):
+    """Rule 24, the source alpha is applied to each component of the destination"""
+    alpha = s >> 24
+    unalpha = 255 - alpha
+    result = np.zeros_like(d)
+    for shift in (0, 8, 16, 24):
+        # the source is opaque for the alpha component
+        sc = (s >> shift) & 0xFF if shift < 24 else np.uint32(255)
+        dc = (d >> shift) & 0xFF
+        blend = sc * alpha + dc * unalpha + 255
+        result |= (((blend + ((blend - 1) >> 8)) >> 8) & 0xFF) << shift
+    return result
+
+
+def alpha_blend_scaled(s, d):
+    """Rule 34, the source is premultiplied by its alpha"""
+    unalpha = 255 - (s >> 24)
+    result = np.zeros_like(d)
+    for shift in (0, 8, 16, 24):
+        blend = (((d >> shift) & 0xFF) * unalpha >> 8) + ((s >> shift) & 0xFF)
+        result |= np.minimum(blend, 255) << shift
+    return result
+
+
+RULES = {
+    0: lambda s, d, m: np.zeros_like(d),
+    1: lambda s, d, m: s & d,
+    2: lambda s, d, m: s & ~d & m,
+    3: lambda s, d, m: s,
+    4: lambda s, d, m: ~s & d & m,
+    5: lambda s, d, m: d,
+    6: lambda s, d, m: s ^ d,
+    7: lambda s, d, m: s | d,
+    8: lambda s, d, m: ~s & ~d & m,
+    9: lambda s, d, m: (~s ^ d) & m,
+    10: lambda s, d, m: ~d & m,
+    11: lambda s, d, m: (s | ~d) & m,
+    12: lambda s, d, m: ~s & m,
+    13: lambda s, d, m: (~s | d) & m,
+    14: lambda s, d, m: (~s | ~d) & m,
+    15: lambda s, d, m: np.full_like(d, m),
+    25: lambda s, d, m: np.where(s == 0, d, s),
+    26: lambda s, d, m: np.where(s == 0, d, 0).astype(np.uint32),
+}
+# rules combining the components of 32 bits pixels
+RGB_RULES = {24: alpha_blend, 34: alpha_blend_scaled}
+
+
+class BitBlt(object):
+    """Reads the state of a BitBlt, copy() transfers the bits"""
+    def __init__(self, bitblt, vm):
+        self.vm = vm
+        nil = vm.memory.nil
+        self.dest = Form(bitblt[DEST_FORM])
+        source = bitblt[SOURCE_FORM]
+        self.source = None if source is nil else Form(source)
+        self.halftone = self.halftone_words(bitblt[HALFTONE_FORM], nil)
+        self.rule = int_value(bitblt[COMBINATION_RULE])
+        if self.rule not in RULES and (self.rule not in RGB_RULES or self.dest.depth != 32):
+            raise PrimitiveFail(f"unsupported combination rule {self.rule}")
+        self.dest_x = int_value(bitblt[DEST_X])
+        self.dest_y = int_value(bitblt[DEST_Y])
+        self.width = int_value(bitblt[WIDTH])
+        self.height = int_value(bitblt[HEIGHT])
+        if self.source is not None:
+            self.source_x = int_value(bitblt[SOURCE_X])
+            self.source_y = int_value(bitblt[SOURCE_Y])
+        clip_x = int_value(bitblt[CLIP_X])
+        clip_y = int_value(bitblt[CLIP_Y])
+        clip_width = int_value(bitblt[CLIP_WIDTH])
+        clip_height = int_value(bitblt[CLIP_HEIGHT])
+        # the clipping rectangle is inside the destination form
+        if clip_x < 0:
+            clip_width += clip_x
+            clip_x = 0
+        if clip_y < 0:
+            clip_height += clip_y
+            clip_y = 0
+        self.clip = (clip_x, clip_y, min(clip_width, self.dest.width - clip_x),
+                     min(clip_height, self.dest.height - clip_y))
+        color_map = bitblt[COLOR_MAP] if len(bitblt) > COLOR_MAP else nil
+        self.color_map = None
+        if color_map is not nil and self.source is not None:
+            self.color_map = ColorMap(color_map, self.source.depth, nil)
+
+    @staticmethod
+    def halftone_words(halftone, nil):
+        if halftone is nil:
+            return None
+        if not 10 <= halftone.object_format < 12:
+            # a Form, its bits are the pattern
+            halftone = halftone[0]
+        words = words_of(halftone)
+        return words if len(words) else None
+
+    def clipped(self):
+        """Source and destination rectangles after clipping, as sx, sy, dx, dy, w, h"""
+        clip_x, clip_y, clip_width, clip_height = self.clip
+        dx, dy, w, h = self.dest_x, self.dest_y, self.width, self.height
+        sx = self.source_x if self.source is not None else 0
+        sy = self.source_y if self.source is not None else 0
+        if dx < clip_x:
+            sx += clip_x - dx
+            w -= clip_x - dx
+            dx = clip_x
+        w -= max(dx + w - (clip_x + clip_width), 0)
+        if dy < clip_y:
+            sy += clip_y - dy
+            h -= clip_y - dy
+            dy = clip_y
+        h -= max(dy + h - (clip_y + clip_height), 0)
+        if self.source is not None:
+            if sx < 0:
+                dx -= sx
+                w += sx
+                sx = 0
+            w -= max(sx + w - self.source.width, 0)
+            if sy < 0:
+                dy -= sy
+                h += sy
+                sy = 0
+            h -= max(sy + h - self.source.height, 0)
+        return sx, sy, dx, dy, w, h
+
+    def source_pixels(self, sx, sy, dx, dy, w, h):
+        """Source pixels at the depth of the destination, with the halftone applied"""
+        dest = self.dest
+        pixels = None
+        if self.source is not None:
+            source = self.source
+            pixels = source.read(sx, sy, w, h)
+            if self.color_map is not None:
+                pixels = self.color_map(pixels)
+            elif source.depth == 16 and dest.depth == 32:
+                pixels = rgb_16_to_32(pixels)
+            elif source.depth == 32 and dest.depth == 16:
+                pixels = rgb_32_to_16(pixels)
+            pixels = pixels & dest.mask
+        if self.halftone is not None:
+            # one word per row, repeated along the row
+            words = self.halftone[(dy + np.arange(h)) % len(self.halftone)]
+            pattern = dest.unpack(words[:, None])
+            pattern = pattern[:, (dx + np.arange(w)) % dest.ppw]
+            pixels = pattern if pixels is None else pixels & pattern
+        if pixels is None:
+            pixels = np.full((h, w), dest.mask, dtype=np.uint32)
+        return pixels
+
+    def copy(self):
+        """Transfers the bits, answers the affected rectangle or None"""
+        sx, sy, dx, dy, w, h = self.clipped()
+        if w <= 0 or h <= 0:
+            return None
+        dest = self.dest
+        s = self.source_pixels(sx, sy, dx, dy, w, h)
+        if self.rule in RGB_RULES:
+            rule = RGB_RULES[self.rule]
+            dest.update(dx, dy, w, h, lambda d: rule(s, d))
+        else:
+            rule = RULES[self.rule]
+            mask = dest.mask
+            dest.update(dx, dy, w, h, lambda d: rule(s, d, mask))
+        return dx, dy, w, h
+
+
+def primitiveCopyBits(bitblt, *factor, context, vm):
+    blit = BitBlt(bitblt, vm)
+    affected = blit.copy()
+    if affected is not None:
+        vm.display.blitted(blit.dest.bits, affected)
+
+
+def primitiveDisplayString(bitblt, string, start, stop, glyph_map, x_table, kern, context, vm):
+    if not 16 <= string.object_format < 24 or not 16 <= glyph_map.object_format < 24:
+        raise PrimitiveFail("not a bytes object")
+    start = int_value(start)
+    stop = int_value(stop)
+    kern = int_value(kern)
+    if start < 1 or stop > len(string) or len(glyph_map) != 256:
+        raise PrimitiveFail("out of bounds")
+    blit = BitBlt(bitblt, vm)
+    dest_x = blit.dest_x
+    glyphs = bytes(glyph_map.raw_slots[:256])
+    for char in bytes(string.raw_slots[start - 1:stop]):
+        glyph = glyphs[char]
+        source_x = int_value(x_table[glyph])
+        blit.source_x = source_x
+        blit.width = int_value(x_table[glyph + 1]) - source_x
+        blit.dest_x = dest_x
+        affected = blit.copy()
+        if affected is not None:
+            vm.display.blitted(blit.dest.bits, affected)
+        dest_x += blit.width + kern
+    bitblt[DEST_X] = integer.create(dest_x, vm.memory)
@@ -91,7 +91,7 @@ def primitiveFileRead(stream, fileno, dst, index, count, context, vm):
     count = count.value
     buffer = f.read(count * nb_bytes)
     nb_read = len(buffer) // nb_bytes
-    dst.raw_slots[:nb_read] = buffer
+    dst.writable_slots(0, len(buffer))[:] = buffer
     return integer.create(nb_read, vm.memory)
 
 
@@ -1,14 +1,146 @@
-import struct
+import numpy as np
+from ..spurobjects import ImmediateInteger as integer
 from ..primitives import PrimitiveFail
-from ..utils import *
+from ..utils import float_or_boxed
+
+
+def is_words(obj):
+    # immediates have no format
+    return getattr(obj, "object_format", None) in (10, 11)
+
+
+def float32s(obj):
+    """Elements of a FloatArray, as a read-only numpy array sharing the memory of the object"""
+    if not is_words(obj):
+        raise PrimitiveFail("not a words object")
+    return np.frombuffer(obj.raw_slots, dtype="<f4", count=len(obj))
+
+
+def writable(obj, start=0, stop=None):
+    """Elements start:stop of a FloatArray, writable and marked dirty"""
+    if not is_words(obj):
+        raise PrimitiveFail("not a words object")
+    if obj.is_immutable:
+        raise PrimitiveFail("immutable receiver")
+    stop = len(obj) if stop is None else stop
+    return np.frombuffer(obj.writable_slots(start * 4, stop * 4), dtype="<f4")
+
+
+def same_size(rcvr, arg):
+    b = float32s(arg)
+    if len(float32s(rcvr)) != len(b):
+        raise PrimitiveFail("sizes differ")
+    return writable(rcvr), b
+
+
+def float_value(obj, vm):
+    if obj.kind in (-1, -4) or obj.class_ is vm.memory.boxedfloat64:
+        return obj.as_float()
+    raise PrimitiveFail("not a number")
 
 
 def primitiveAt(self, index, context, vm):
-    v = self.raw_bytes_at(index.value - 1)
-    f = struct.unpack("<f", v)[0]
-    return float_or_boxed(f, vm)
+    a = float32s(self)
+    if type(index) is not integer or not 1 <= index.value <= len(a):
+        raise PrimitiveFail("out of bounds")
+    return float_or_boxed(float(a[index.value - 1]), vm)
 
 
 def primitiveAtPut(self, index, value, context, vm):
-    self[index.value - 1] = struct.pack("<f", value)
+    a = float32s(self)
+    if type(index) is not integer or not 1 <= index.value <= len(a):
+        raise PrimitiveFail("out of bounds")
+    value_float = float_value(value, vm)
+    writable(self, index.value - 1, index.value)[0] = value_float
     return value
+
+
+# the operations with a scalar are computed in double precision, as in
+# the C plugin, and rounded when they are stored
+
+def primitiveAddScalar(self, value, context, vm):
+    a = writable(self)
+    a[...] = a + np.float64(float_value(value, vm))
+
+
+def primitiveSubScalar(self, value, context, vm):
+    a = writable(self)
+    a[...] = a - np.float64(float_value(value, vm))
+
+
+def primitiveMulScalar(self, value, context, vm):
+    a = writable(self)
+    a[...] = a * np.float64(float_value(value, vm))
+
+
+def primitiveDivScalar(self, value, context, vm):
+    value = float_value(value, vm)
+    if value == 0:
+        raise PrimitiveFail("division by zero")
+    a = writable(self)
+    a[...] = a * np.float64(1.0 / value)
+
+
+def primitiveAddFloatArray(self, other, context, vm):
+    a, b = same_size(self, other)
+    np.add(a, b, out=a)
+
+
+def primitiveSubFloatArray(self, other, context, vm):
+    a, b = same_size(self, other)
+    np.subtract(a, b, out=a)
+
+
+def primitiveMulFloatArray(self, other, context, vm):
+    a, b = same_size(self, other)
+    np.multiply(a, b, out=a)
+
+
+def primitiveDivFloatArray(self, other, context, vm):
+    if not float32s(other).all():
+        raise PrimitiveFail("division by zero")
+    a, b = same_size(self, other)
+    np.divide(a, b, out=a)
+
+
+# products are float32, as in the C plugin, the sums are accumulated in
+# double precision
+
+def primitiveDotProduct(self, other, context, vm):
+    a = float32s(self)
+    b = float32s(other)
+    if len(a) != len(b):
+        raise PrimitiveFail("sizes differ")
+    return float_or_boxed(float((a * b).sum(dtype=np.float64)), vm)
+
+
+def primitiveSum(self, context, vm):
+    return float_or_boxed(float(float32s(self).sum(dtype=np.float64)), vm)
+
+
+def primitiveLength(self, context, vm):
+    a = float32s(self)
+    return float_or_boxed(float(np.sqrt((a * a).sum(dtype=np.float64))), vm)
+
+
+def primitiveNormalize(self, context, vm):
+    a = float32s(self)
+    length = np.sqrt((a * a).sum(dtype=np.float64))
+    if length == 0:
+        raise PrimitiveFail("zero length")
+    a = writable(self)
+    a[...] = a / length
+
+
+def primitiveEqual(self, other, context, vm):
+    a = float32s(self)
+    if not is_words(other):
+        return False
+    b = float32s(other)
+    return len(a) == len(b) and bool((a == b).all())
+
+
+def primitiveHashArray(self, context, vm):
+    # sum of the elements read as 32 bits integers
+    words = float32s(self).view("<i4")
+    return integer.create(int(words.sum(dtype=np.int64)) & 0x1FFFFFFF, vm.memory)
@@ -86,5 +86,5 @@ def large(r, neg, vm):
     else:
         result = vm.allocate(vm.memory.largepositiveint, data_len=length)
     rb = int.to_bytes(r, byteorder="little", length=length)
-    result.raw_slots[:length] = rb
+    result.writable_slots(0, length)[:] = rb
     return result
@@ -1,109 +1,198 @@
+import sys
+from array import array
+from itertools import groupby
 from ..spurobjects import ImmediateInteger as integer
 from ..primitives import PrimitiveFail
 
 
+def byte_data(obj):
+    """Bytes of a byte indexable object (ByteString, ByteSymbol, ByteArray...)"""
+    if not 16 <= obj.object_format < 24:
+        raise PrimitiveFail("not a bytes object")
+    return obj.raw_slots[:len(obj)]
+
+
+def table_data(table):
+    data = bytes(byte_data(table))
+    if len(data) != 256:
+        raise PrimitiveFail("table size is not 256")
+    return data
+
+
 def primitiveStringHash(*args, context, vm):
     *cls, string, species_hash = args
-    string = string.as_text()
-    species_hash = species_hash.value
-    hash_val = species_hash  & 0xFFFFFFF
-    for char in string:
-        hash_val += ord(char)
-        low = hash_val & 16383
-        hash_val = (0x260D * low + ((0x260D * (hash_val >> 14) + (0x0065 * low) & 16383) * 16384)) & 0x0FFFFFFF
+    hash_val = species_hash.value & 0xFFFFFFF
+    # (hash + char) * 1664525 truncated to 28 bits, as computed by the
+    # plugin with 14 bits halves
+    for char in bytes(byte_data(string)):
+        hash_val = (hash_val + char) * 1664525 & 0xFFFFFFF
     return integer.create(hash_val, vm.memory)
 
 
 def primitiveIndexOfAsciiInString(cls, byte, string, start, context, vm):
-    if start.value < 0:
+    if start.value < 1:
         return integer.create(0, vm.memory)
+    index = bytes(byte_data(string)).find(byte.value, start.value - 1)
+    return integer.create(index + 1, vm.memory)
 
-    try:
-        index = string.as_text().index(chr(byte))
-        return integer.create(index, vm.memory)
-    except Exception:
-        return integer.create(0, vm.memory)
+
+def word_data(obj):
+    """Raw bytes of a 32 bits words object (Bitmap)"""
+    if not 10 <= obj.object_format < 12:
+        raise PrimitiveFail("not a words object")
+    return obj.raw_slots[:len(obj) * 4]
+
+
+def big_endian(words):
+    """Bytes of words in the big endian order of the compressed bitmaps"""
+    data = array("I", words)
+    if sys.byteorder == "little":
+        data.byteswap()
+    return data.tobytes()
 
 
 def primitiveDecompressFromByteArray(cls, bm, ba, index, context, vm):
+    """
+    Decodes the runs S {N D}* of Bitmap>>compressToByteArray from index in
+    ba (S, the size, is already read) directly in the words of bm
+    """
+    # marked dirty at once, the whole bitmap is normally decoded
+    words = bm.writable_slots(0, len(word_data(bm)))
+    ba = bytes(byte_data(ba))
     i = index.value - 1
-    end = len(ba) - 1
+    end = len(ba)
+    if i < 0:
+        raise PrimitiveFail("out of bounds")
     k = 0
-    past_end = len(bm)
-    while i <= end:
-        v = ba[i].value
+    past_end = len(words) // 4
+    while i < end:
+        v = ba[i]
         i += 1
         if v > 223:
             if v <= 254:
-                v = (v - 224) * 256 + ba[i].value
+                if i + 1 > end:
+                    raise PrimitiveFail("truncated data")
+                v = (v - 224) * 256 + ba[i]
                 i += 1
             else:
-                v = 0
-                for _ in range(4):
-                    v = (v << 8) + ba[i].value
-                    i += 1
+                if i + 4 > end:
+                    raise PrimitiveFail("truncated data")
+                v = int.from_bytes(ba[i:i + 4], "big")
+                i += 4
         n = v >> 2
         if k + n > past_end:
-            raise PrimitiveFail
+            raise PrimitiveFail("past the end of the bitmap")
         code = v & 0b11
         if code == 3:
-            for _ in range(n):
-                data = 0
-                for _ in range(4):
-                    data = (data << 8) | ba[i].value
-                    i += 1
-                bm[k] = integer.create(data, vm.memory)
-                k += 1
+            # n words follow
+            if i + n * 4 > end:
+                raise PrimitiveFail("truncated data")
+            words[k * 4:(k + n) * 4] = big_endian(ba[i:i + n * 4])
+            i += n * 4
+            k += n
         elif code == 2:
-            data = 0
-            for _ in range(4):
-                data = (data << 8) | ba[i].value
-                i += 1
-            for _ in range(n):
-                bm[k] = integer.create(data, vm.memory)
-                k += 1
+            # n times the following word
+            if i + 4 > end:
+                raise PrimitiveFail("truncated data")
+            words[k * 4:(k + n) * 4] = big_endian(ba[i:i + 4]) * n
+            i += 4
+            k += n
         elif code == 1:
-            data = ba[i].value
+            # n words with their 4 bytes equal to the following byte
+            if i + 1 > end:
+                raise PrimitiveFail("truncated data")
+            words[k * 4:(k + n) * 4] = ba[i:i + 1] * (n * 4)
             i += 1
-            data = data | (data << 8)
-            data = data | (data << 16)
-            for _ in range(n):
-                bm[k] = integer.create(data, vm.memory)
-                k += 1
-        elif code == 0:
-            ...  # skip
+            k += n
+
+
+def encode_int(value, out):
+    if value <= 223:
+        out.append(value)
+    elif value <= 7935:
+        out += bytes((value // 256 + 224, value % 256))
+    else:
+        out.append(255)
+        out += value.to_bytes(4, "big")
+
+
+def compress_words(words):
+    """Run-length encoding of Bitmap>>compress:toByteArray:"""
+    out = bytearray()
+    encode_int(len(words), out)
+    runs = [(word, len(list(group))) for word, group in groupby(words)]
+    r = 0
+    while r < len(runs):
+        word, count = runs[r]
+        low = word & 0xFF
+        equal_bytes = word == low * 0x01010101
+        if count > 1 or equal_bytes:
+            if equal_bytes:
+                encode_int(count * 4 + 1, out)
+                out.append(low)
+            else:
+                encode_int(count * 4 + 2, out)
+                out += word.to_bytes(4, "big")
+            r += 1
+            continue
+        # unmatching words, up to the next run of equal words
+        junk = r
+        while junk < len(runs) and runs[junk][1] == 1:
+            junk += 1
+        encode_int((junk - r) * 4 + 3, out)
+        out += big_endian([word for word, _ in runs[r:junk]])
+        r = junk
+    return out
+
+
+def primitiveCompressToByteArray(cls, bm, ba, context, vm):
+    data = compress_words(word_data(bm).cast("I"))
+    target = byte_data(ba)
+    if len(data) > len(target) or ba.is_immutable:
+        raise PrimitiveFail("byte array too small")
+    ba.writable_slots(0, len(data))[:] = data
+    # last index stored
+    return integer.create(len(data), vm.memory)
 
 
 def primitiveFindSubstring(cls, key, body, start, match_table, context, vm):
-    # TODO Use the match_table?
-    try:
-        start = start.value - 1
-        index = body.as_text()[start:].index(key.as_text())
-        # we add 1 because the result go back to ST
-        return integer.create(index + start + 1, vm.memory)
-    except Exception:
+    key = bytes(byte_data(key))
+    if not key:
         return integer.create(0, vm.memory)
+    table = table_data(match_table)
+    body = bytes(byte_data(body)).translate(table)
+    index = body.find(key.translate(table), max(start.value, 1) - 1)
+    # we add 1 because the result go back to ST
+    return integer.create(index + 1, vm.memory)
 
 
 def primitiveCompareString(cls, s1, s2, order, context, vm):
-    s1 = s1.as_text()
-    s2 = s2.as_text()
-    len1 = len(s1)
-    len2 = len(s2)
-    for i in range(min(len1, len2)):
-        c1 = order.raw_at(ord(s1[i])) + 1
-        c2 = order.raw_at(ord(s2[i])) + 1
-        if c1 != c2:
-            if c1 < c2:
-                return integer.create(1, vm.memory)
-            else:
-                return integer.create(1, vm.memory)
-    if len1 == len2:
+    table = table_data(order)
+    s1 = bytes(byte_data(s1)).translate(table)
+    s2 = bytes(byte_data(s2)).translate(table)
+    # 1: s1 < s2, 2: equal, 3: s1 > s2
+    if s1 == s2:
         return integer.create(2, vm.memory)
-    if len1 < len2:
-        return integer.create(1, vm.memory)
-    return integer.create(3, vm.memory)
+    return integer.create(1 if s1 < s2 else 3, vm.memory)
+
+
+def primitiveFindFirstInString(cls, string, inclusion_map, start, context, vm):
+    inclusion = bytes(byte_data(inclusion_map))
+    if len(inclusion) != 256:
+        return integer.create(0, vm.memory)
+    if start.value < 1:
+        raise PrimitiveFail("out of bounds")
+    # included bytes are translated to 1, the others to 0
+    table = bytes(1 if included else 0 for included in inclusion)
+    index = bytes(byte_data(string)).translate(table).find(1, start.value - 1)
+    return integer.create(index + 1, vm.memory)
 
 
-def primitiveFindFirstInString(cls, string, inclusionMap, start, context, vm):
-    raise PrimitiveFail
+def primitiveTranslateStringWithTable(cls, string, start, stop, table, context, vm):
+    data = byte_data(string)
+    start = start.value - 1
+    stop = stop.value
+    if start < 0 or stop > len(data) or string.is_immutable:
+        raise PrimitiveFail("out of bounds")
+    if start < stop:
+        string.writable_slots(start, stop)[:] = bytes(data[start:stop]).translate(table_data(table))
@@ -2,7 +2,7 @@ from ..utils import *
 
 
 def primitiveCanWriteImage(*args, context, vm):
-    return False
+    return True
 
 
 def primitiveGetSecureUserDirectory(manager, context, vm):
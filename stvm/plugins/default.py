@@ -3,9 +3,7 @@ from ..primitives import PrimitiveFail
 
 
 def primitiveScreenDepth(rcvr, context, vm):
-    from Xlib.display import Display
-    root = Display().screen().root
-    return integer.create(root.get_geometry().depth, vm.memory)
+    return integer.create(vm.display.depth, vm.memory)
 
 
 def primitiveUtcWithOffset(*args, context, vm):
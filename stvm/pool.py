@@ -0,0 +1,115 @@
+import os
+import multiprocessing
+from multiprocessing.util import Finalize
+from .image64 import Image
+from .utils import to_python, from_python
+
+
+class Global(object):
+    """Refers to a global of the image (e.g: a class) by its name"""
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"Global({self.name!r})"
+
+
+class Limits(object):
+    """
+    Per-worker resource limits.
+    memory:    maximum address space of a worker in bytes (RLIMIT_AS)
+    cpu:       maximum CPU time of a worker in seconds (RLIMIT_CPU)
+    bytecodes: maximum number of bytecodes executed by a job
+    """
+    def __init__(self, memory=None, cpu=None, bytecodes=None):
+        self.memory = memory
+        self.cpu = cpu
+        self.bytecodes = bytecodes
+
+    def apply(self):
+        import resource
+        if self.memory:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+        if self.cpu:
+            resource.setrlimit(resource.RLIMIT_CPU, (self.cpu, self.cpu))
+
+
+# State inherited by the forked workers, it is never pickled
+_shared = {}
+_worker = {}
+
+
+def _init_worker():
+    from .vm import VM
+    _shared["limits"].apply()
+    vm = VM(_shared["image"], memory=_shared["memory"])
+    _worker["vm"] = vm
+    # run when the worker exits, after its last job
+    Finalize(vm, vm.close, exitpriority=10)
+
+
+def _run_job(receiver, selector, args):
+    vm = _worker["vm"]
+    try:
+        if isinstance(receiver, Global):
+            receiver = vm.lookup_global(receiver.name)
+        else:
+            receiver = from_python(receiver, vm)
+        args = [from_python(a, vm) for a in args]
+        result = vm.evaluate(receiver, selector, args, limit=_shared["limits"].bytecodes)
+        return to_python(result, vm)
+    except Exception as e:
+        # the exception and its arguments could be VM objects that cannot be pickled
+        raise RuntimeError(f"{e.__class__.__name__}: {e}") from None
+
+
+class VMPool(object):
+    """
+    Pool of VMs running in forked processes.
+    The image is loaded and turned into a VMMemory once, in the parent
+    process; workers are forked from it and share the memory pages
+    copy-on-write. If isolated is True, each worker runs a single job
+    and is then replaced by a fresh fork, so jobs never see the heap
+    modifications of a previous job.
+    """
+    def __init__(self, image_file, workers=None, limits=None, isolated=False):
+        if _shared:
+            raise RuntimeError("Only one VMPool can be active per process")
+        image = Image(image_file) if not isinstance(image_file, Image) else image_file
+        _shared["image"] = image
+        _shared["memory"] = image.as_memory()
+        _shared["limits"] = limits or Limits()
+        self.workers = workers or os.cpu_count()
+        context = multiprocessing.get_context("fork")
+        self.pool = context.Pool(self.workers, initializer=_init_worker,
+                                 maxtasksperchild=1 if isolated else None)
+
+    def submit(self, receiver, selector, *args):
+        """
+        Asynchronously sends selector to receiver, returns an AsyncResult.
+        receiver and args are python values (converted to objects in the
+        worker) or Global instances.
+        """
+        return self.pool.apply_async(_run_job, (receiver, selector, args))
+
+    def evaluate(self, receiver, selector, *args, timeout=None):
+        return self.submit(receiver, selector, *args).get(timeout)
+
+    def map(self, jobs):
+        """jobs is an iterable of (receiver, selector, args) tuples"""
+        return [r.get() for r in [self.submit(rcvr, sel, *args) for rcvr, sel, args in jobs]]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        _shared.clear()
+
+    def terminate(self):
+        self.pool.terminate()
+        _shared.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,11 +3,16 @@ from datetime import datetime as dt
 import math
 import struct
 import importlib
+from pathlib import Path
+import array as words
+from bisect import bisect_right
 from .utils import *
 from .spurobjects import ImmediateInteger as integer
-from .spurobjects import ImmediateFloat as smallfloat
+from .spurobjects.immediate import float_bits
 from .spurobjects import ImmediateChar as char
 from .utils import DoesNotUnderstand
+from .events import utc_microseconds
+from .scheduler import LinkNotFound
 
 
 nil = object()
@@ -38,7 +43,7 @@ def execute_primitive(number, context, vm, *args, **kwargs):
     except KeyError:
         unimpl.add(number)
         # print("** Unimplemented", sorted(unimpl))
-        if number in (19, 38, 65, 66, 77, 90, 91, 93, 94, 107, 108, 149, 159, 177, 195, 197, 198, 199):
+        if number in (19, 38, 65, 66, 90, 91, 93, 94, 107, 108, 149, 159, 195, 197, 198, 199):
             raise PrimitiveFail
         raise Exception(f"Missing primitive {number} called with [{', '.join(a.display() for a in args)}]")
     except PrimitiveFail as e:
@@ -258,12 +263,16 @@ primitive(33)(large_divRound)
 
 @primitive(38)
 def float_at(f, index, context, vm):
-    return f[index.value - 1]
+    if index.value not in (1, 2):
+        raise PrimitiveFail
+    # the high word first, as for the SmallFloat64
+    bits = float_bits(f.as_float())
+    return bits >> 32 if index.value == 1 else bits & 0xFFFFFFFF
 
 
 @primitive(40)
 def smallintAsFloat(self, context, vm):
-    return smallfloat.create(self, vm.memory)
+    return float_or_boxed(float(self.value), vm)
 
 
 @primitive(60)
@@ -314,7 +323,7 @@ def basicIdentityHash(self, context, vm):
     if self.identity_hash == 0:
         h = new_object_hash(vm) & 0x3FFFFF
         self.h2 = (self.h2 & 0xFFC00000) | h
-        self.header2[:] = struct.pack("I", self.h2)
+        vm.memory[self.address + 4:self.address + 8] = struct.pack("I", self.h2)
         self.identity_hash = h
     return integer.create(self.identity_hash, vm.memory)
 
@@ -342,6 +351,46 @@ def store_stackp(self, new_stackp, context, vm):
     else:
         self.stackp = new_stackp
 
+
+@primitive(77)
+def some_instance(cls, context, vm):
+    instances = vm.allocator.heap_index.instances_of(cls.identity_hash)
+    if not instances:
+        raise PrimitiveFail
+    return vm.memory.object_at(instances[0])
+
+
+@primitive(78)
+def next_instance(self, context, vm):
+    if self.address & 0x7:
+        raise PrimitiveFail
+    instances = vm.allocator.heap_index.instances_of(self.class_index)
+    i = bisect_right(instances, self.address)
+    if i >= len(instances):
+        raise PrimitiveFail
+    return vm.memory.object_at(instances[i])
+
+
+def addresses_to_array(addresses, vm):
+    # the addresses are copied before the array is allocated, so it does not
+    # appear in its own content
+    content = words.array("Q", addresses)
+    result = array(len(content), vm)
+    result.writable_slots()[:] = content.tobytes()
+    return result
+
+
+@primitive(177)
+def all_instances(cls, context, vm):
+    instances = vm.allocator.heap_index.instances_of(cls.identity_hash)
+    return addresses_to_array(instances, vm)
+
+
+@primitive(178)
+def all_objects(self, context, vm):
+    return addresses_to_array(vm.allocator.heap_index.all_objects(), vm)
+
+
 @primitive(83, activate=True)
 def perform(rcvr, selector, *args, context, vm):
     try:
@@ -384,15 +433,21 @@ def resume(process, context, vm):
 @primitive(88)
 def suspend(process, context, vm):
     if process is not vm.active_process:
-        raise PrimitiveFail("not the active process")
+        linkedlist = process[3]
+        if linkedlist is vm.memory.nil:
+            raise PrimitiveFail("process is not in a list")
+        try:
+            vm.process_scheduler.remove_link(process, linkedlist)
+        except LinkNotFound:
+            raise PrimitiveFail("process is not in its list")
+        return linkedlist
     context.push(vm.memory.nil)
     vm.suspend_active()
 
 
 @primitive(91)
 def test_display_depth(self, depth, context, vm):
-    print(f"[91] TODO test display depth {depth.value}, only return true")
-    return True
+    return abs(depth.value) in (1, 2, 4, 8, 16, 32)
 
 
 @primitive(93)
@@ -401,6 +456,22 @@ def register_input_semaphore(self, sema, context, vm):
     raise PrimitiveFail
 
 
+@primitive(97)
+def snapshot(self, context, vm):
+    from .snapshot import snapshot, store_active_context
+    # the saved image resumes as if the primitive answered true
+    sender = context.previous
+    sender.push(vm.memory.true)
+    store_active_context(vm, sender)
+    try:
+        snapshot(vm)
+    except OSError as e:
+        raise PrimitiveFail(e)
+    finally:
+        sender.pop()
+    return False
+
+
 @primitive(101)
 def be_cursor(self, mask_form, context, vm):
     # mask    cursor_effect
@@ -433,50 +504,51 @@ def be_cursor(self, mask_form, context, vm):
 def be_display(display, context, vm):
     # record object in special object array
     vm.memory.special_object_array[14] = display
+    vm.display.be_display(display)
 
-    # Create the display
-    displayBits = display[0]
-    width = display[1].value
-    height = display[2].value
-    depth = display[3].value
-    offset = display[4]
-    offsetX = offset[0].value
-    offsetY = offset[1].value
-
-    import pygame
-    pygame.init()
-    size = (width, height)
-    screen = pygame.display.set_mode(size)
-
-    # surface = pygame.Surface(size)
-    # pixelArray = pygame.PixelArray(surface)
-    # for y in range(height):
-    #     for x in range(width):
-    #         pixelArray[x, y] = displayBits[y * height + x].value
-    # del pixelArray
-    # screen.blit(surface, (offsetX, offsetY))
-    vm.screen = screen
 
-    # pygame.display.update()
+def indexable_memory(obj):
+    """Raw memory of the indexable part of an object and the size of its elements"""
+    if 2 <= obj.object_format <= 4:
+        pointers = getattr(obj, "array", obj.slots)
+        return pointers.raw_slots, pointers.address, 8
+    if 9 <= obj.object_format < 24:
+        return obj.raw_slots[:len(obj) * obj.nb_bits // 8], obj.address + 8, obj.nb_bits // 8
+    raise PrimitiveFail("not indexable")
 
 
 @primitive(105)
 def replacefrom_to_with_startingat(self, start, stop, other, start_other, context, vm):
+    if start.kind != -1 or stop.kind != -1 or start_other.kind != -1 or self.is_immutable:
+        raise PrimitiveFail
     start = start.value - 1
     stop = stop.value
     start_other = start_other.value - 1
-    for k, i in enumerate(range(start, stop), start=start_other):
-        self[i] = other[k]
+    count = stop - start
+    if self.object_format >= 24 or other.object_format >= 24:
+        # compiled methods mix literals and bytes
+        for k, i in enumerate(range(start, stop), start=start_other):
+            self[i] = other[k]
+        return self
+    mem, address, size = indexable_memory(self)
+    other_mem, _, other_size = indexable_memory(other)
+    if size != other_size or (self.object_format <= 4) != (other.object_format <= 4):
+        raise PrimitiveFail("incompatible formats")
+    if count < 0 or start < 0 or start_other < 0:
+        raise PrimitiveFail("out of bounds")
+    if stop * size > len(mem) or (start_other + count) * size > len(other_mem):
+        raise PrimitiveFail("out of bounds")
+    if count:
+        # slice assignment between memoryviews is a memmove, overlaps included
+        offset = address - self.address - 8
+        dest = self.writable_slots(offset + start * size, offset + stop * size)
+        dest[:] = other_mem[start_other * size:(start_other + count) * size]
     return self
 
 
 @primitive(106)
 def screen_size(rcvr, context, vm):
-    from Xlib.display import Display
-    display = Display()
-    geometry = display.screen().root.get_geometry()
-    width = geometry.width
-    height = geometry.height
+    width, height = vm.display.size
     point = vm.allocate(vm.memory.point)
     point.slots[0] = integer.create(width, vm.memory)
     point.slots[1] = integer.create(height, vm.memory)
@@ -516,15 +588,18 @@ def external_call(*args, context, vm):
 
 
 @primitive(121)
-def image_name(self, context, vm):
-    return to_bytestring(str(vm.image.file), vm)
+def image_name(self, *name, context, vm):
+    if name:
+        # the next snapshot will be saved under this name
+        vm.image_file = Path(name[0].as_text())
+        return
+    return to_bytestring(str(vm.image_file), vm)
 
 
 @primitive(125)
-def signal_at_byte_left(self, threasold, context, vm):
-    print("""Tell the interpreter the low-space threshold in bytes. When the free
-	space falls below this threshold, the interpreter will signal the low-space
-	semaphore, if one has been registered.""")
+def signal_at_byte_left(self, threshold, context, vm):
+    vm.events.low_space_threshold = threshold.value
+    vm.events.low_space_signaled = False
 
 
 @primitive(126)
@@ -537,11 +612,9 @@ def defer_screen_update(screen, defer, context, vm):
 
 @primitive(127)
 def show_display_rect(self, left, right, top, bottom, context, vm):
-    left = left.value
-    right = right.value
-    top = top.value
-    bottom = bottom.value
-    raise PrimitiveFail   # TODO ?
+    vm.display.show(left.value, top.value, right.value, bottom.value)
+    if not vm.defer_screen_update:
+        vm.display.flush()
 
 
 @primitive(129)
@@ -561,7 +634,8 @@ def interrupt_semaphore(sensor, sema, context, vm):
     index = memory.special_array["interrupt_semaphore"]
 
     if sema is memory.nil:
-        memory.special_object_oop[index] = nil
+        memory.special_object_array[index] = memory.nil
+        memory.interrupt_semaphore = memory.nil
         return
     # if sema.in_young_space:
     #   sema.is_remembered = True (+ change header, give a setter)
@@ -571,7 +645,7 @@ def interrupt_semaphore(sensor, sema, context, vm):
 
 @primitive(135)
 def millisecond_clock(self, context, vm):
-    ms = int(round(dt.now().timestamp() + 2177452800))
+    ms = int(time.monotonic() * 1000)
     return integer.create(ms & 0x1FFFFFFF, vm.memory)
 
 
@@ -585,8 +659,7 @@ def vm_paths(self, context, vm):
 def clone(self, context, vm):
     cls = self.class_
     new = vm.allocate(cls, array_size=len(self))
-    for i, v in enumerate(self.raw_slots):
-        new.raw_slots[i] = v
+    new.writable_slots(0, len(self.raw_slots))[:] = self.raw_slots
     return new
 
 
@@ -661,7 +734,7 @@ def enter_criticalsection(self, *args, context, vm):
         return False
     if owning_process == active_process:
         return True
-    vm.add_last_link(active_process, critical_section)
+    vm.add_last_link_list(active_process, critical_section)
     vm.suspend_active()
     return False
 
@@ -755,10 +828,14 @@ def context_at_put(ctx, at, val, context, vm):
     return val
 
 
+@primitive(230)
+def relinquish_processor(self, microseconds, context, vm):
+    vm.events.idle(microseconds.value / 1000000)
+
+
 @primitive(231)
 def force_display_update(self, context, vm):
-    # vm.screen.update()
-    ...
+    vm.display.flush()
 
 
 @primitive(240)
@@ -779,15 +856,25 @@ def signal_at_microseconds(self, sema, microsecs, context, vm):
     index = memory.special_array["timer_semaphore"]
 
     if sema is memory.nil:
-        memory.special_object_oop[index] = nil
-        vm.nextWakeupUsecs = 0
+        memory.special_object_array[index] = memory.nil
+        memory.timer_semaphore = memory.nil
+        vm.events.signal_at_utc_microseconds(None, 0)
         return
     memory.special_object_array[index] = sema
     memory.timer_semaphore = sema
-    vm.nextWakeupUsecs = microsecs.value
-
-
-primitive(136)(signal_at_microseconds)
+    vm.events.signal_at_utc_microseconds(sema, microsecs.value)
+
+
+@primitive(136)
+def signal_at_milliseconds(self, sema, milliseconds, context, vm):
+    now = int(time.monotonic() * 1000) & 0x1FFFFFFF
+    delay = (milliseconds.value - now) & 0x1FFFFFFF
+    if delay > 0x0FFFFFFF:
+        # the deadline is already in the past
+        delay = 0
+    usecs = utc_microseconds() + delay * 1000
+    microsecs = integer.create(usecs, vm.memory)
+    return signal_at_microseconds(self, sema, microsecs, context, vm)
 
 
 @primitive(254)
@@ -0,0 +1,300 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from .trace import class_index_of
+
+
+class MethodStats(object):
+    def __init__(self, method):
+        self.method = method
+        self.invocations = 0
+        self.self_bytecodes = 0
+        self.cumulative_bytecodes = 0
+        self.wall_time = 0.0
+        # number of activations on the stack, recursive calls are only
+        # accounted once in the cumulative counters
+        self.active = 0
+
+
+class Frame(object):
+    __slots__ = ("context", "stats", "start_bytecodes", "start_time")
+
+    def __init__(self, context, stats, start_bytecodes, start_time):
+        self.context = context
+        self.stats = stats
+        self.start_bytecodes = start_bytecodes
+        self.start_time = start_time
+
+
+def method_name(method):
+    """Returns Class>>selector for a compiled method"""
+    try:
+        cls = method.slots[method.num_literals][1]
+        return f"{cls.name}>>{method.selector.as_text()}"
+    except Exception:
+        return f"<method 0x{method.address:x}>"
+
+
+def frame_name(context):
+    try:
+        return f"{context.receiver.class_.name}>>{context.compiled_method.selector.as_text()}"
+    except Exception:
+        return f"<method 0x{context.compiled_method.address:x}>"
+
+
+def stack_of(context, frame_names):
+    """Frame names of a context chain, the bottom of the stack first"""
+    names = []
+    while hasattr(context, "compiled_method"):
+        key = (class_index_of(context.receiver), context.compiled_method.address)
+        try:
+            names.append(frame_names[key])
+        except KeyError:
+            name = frame_name(context)
+            frame_names[key] = name
+            names.append(name)
+        context = context.sender
+    names.reverse()
+    return names
+
+
+class BytecodeProfiler(object):
+    """
+    Profiles the interpreter bytecode by bytecode, installed as an execution
+    hook of the VM. Accumulates per method invocations, self and cumulative
+    bytecode counts and wall time, a histogram of the executed bytecode
+    classes, the primitive calls and failures, and the Smalltalk stack every
+    `sample_every` bytecodes as folded stacks (for flame graphs).
+    """
+    def __init__(self, sample_every=1000):
+        self.sample_every = sample_every
+        self.bytecodes = 0
+        self.methods = {}
+        self.histogram = Counter()
+        self.primitive_calls = Counter()
+        self.primitive_failures = Counter()
+        self.folded = Counter()
+        self.frame_names = {}
+        # one shadow stack per process
+        self.stacks = defaultdict(list)
+        self.stack = None
+        self.primitive = None
+
+    def stats(self, method):
+        try:
+            return self.methods[method.address]
+        except KeyError:
+            stats = MethodStats(method)
+            self.methods[method.address] = stats
+            return stats
+
+    def push(self, context):
+        stats = self.stats(context.compiled_method)
+        stats.invocations += 1
+        stats.active += 1
+        self.stack.append(Frame(context, stats, self.bytecodes, time.perf_counter()))
+
+    def pop(self):
+        frame = self.stack.pop()
+        stats = frame.stats
+        stats.active -= 1
+        if not stats.active:
+            stats.cumulative_bytecodes += self.bytecodes - frame.start_bytecodes
+            stats.wall_time += time.perf_counter() - frame.start_time
+
+    def before(self, vm, context, bytecode):
+        stack = self.stack
+        if not stack or stack[-1].context is not context:
+            self.switch_stack(vm, context)
+        self.bytecodes += 1
+        self.stack[-1].stats.self_bytecodes += 1
+        self.histogram[bytecode] += 1
+        if bytecode == 139:
+            self.primitive = context.compiled_method.primitive
+            self.primitive_calls[self.primitive] += 1
+        if self.bytecodes % self.sample_every == 0:
+            self.sample(context)
+
+    def after(self, vm, context, bytecode):
+        new_context = vm.current_context
+        if self.primitive is not None:
+            if new_context is context:
+                self.primitive_failures[self.primitive] += 1
+            self.primitive = None
+        if new_context is context:
+            return
+        if new_context.previous is context:
+            self.push(new_context)
+            return
+        # return (local or not): unwinds the shadow stack up to the context
+        stack = self.stack
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].context is new_context:
+                while len(stack) > i + 1:
+                    self.pop()
+                return
+
+    def switch_stack(self, vm, context):
+        """Another process is running, or the profiler started in the middle of a stack"""
+        self.stack = self.stacks[vm.active_process.address]
+        stack = self.stack
+        if stack and stack[-1].context is context:
+            return
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].context is context:
+                while len(stack) > i + 1:
+                    self.pop()
+                return
+        self.push(context)
+
+    def sample(self, context):
+        self.folded[";".join(stack_of(context, self.frame_names))] += 1
+
+    def finish(self):
+        """Closes the frames still on the shadow stacks"""
+        for stack in self.stacks.values():
+            self.stack = stack
+            while stack:
+                self.pop()
+
+    def bytecode_classes(self, vm):
+        classes = Counter()
+        for bytecode, count in self.histogram.items():
+            classes[vm.bytecodes_map.get(bytecode).__name__] += count
+        return classes
+
+    def report(self, vm, limit=20):
+        lines = [f"{self.bytecodes} bytecodes"]
+        lines.append(f"{'method':<50} {'calls':>10} {'self':>12} {'cumulative':>12} {'time (s)':>10}")
+        methods = sorted(self.methods.values(), key=lambda s: s.self_bytecodes, reverse=True)
+        for stats in methods[:limit]:
+            lines.append(f"{method_name(stats.method):<50} {stats.invocations:>10} {stats.self_bytecodes:>12} "
+                         f"{stats.cumulative_bytecodes:>12} {stats.wall_time:>10.4f}")
+        lines.append("")
+        lines.append(f"{'bytecode':<50} {'count':>10}")
+        for name, count in self.bytecode_classes(vm).most_common(limit):
+            lines.append(f"{name:<50} {count:>10}")
+        lines.append("")
+        lines.append(f"{'primitive':<50} {'calls':>10} {'failures':>10}")
+        for primitive, count in self.primitive_calls.most_common(limit):
+            lines.append(f"{primitive:<50} {count:>10} {self.primitive_failures[primitive]:>10}")
+        return "\n".join(lines)
+
+    def write_folded(self, path):
+        """Writes the sampled stacks in the folded format (flamegraph.pl, speedscope)"""
+        with open(path, mode="w") as f:
+            for stack, count in self.folded.items():
+                f.write(f"{stack} {count}\n")
+
+
+class SamplingProfiler(object):
+    """
+    Samples the Smalltalk stack of a running VM from a background thread
+    every `interval` seconds. The interpreter is not stopped nor instrumented,
+    a sample is dropped if the walk fails or if the interpreter moved to
+    another context while the stack was walked.
+    """
+    def __init__(self, vm, interval=0.005):
+        self.vm = vm
+        self.interval = interval
+        self.samples = Counter()
+        self.dropped = 0
+        self.frame_names = {}
+        self.thread = None
+        self.running = threading.Event()
+        self.started = 0.0
+        self.duration = 0.0
+
+    @property
+    def total(self):
+        return sum(self.samples.values())
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running.set()
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name="stvm-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.running.clear()
+        self.thread.join()
+        self.thread = None
+        self.duration += time.perf_counter() - self.started
+
+    def run(self):
+        while self.running.is_set():
+            time.sleep(self.interval)
+            context = self.vm.current_context
+            try:
+                stack = stack_of(context, self.frame_names)
+            except Exception:
+                self.dropped += 1
+                continue
+            if self.vm.current_context is not context:
+                self.dropped += 1
+                continue
+            if stack:
+                self.samples[tuple(stack)] += 1
+
+    def write_folded(self, path):
+        with open(path, mode="w") as f:
+            for stack, count in self.samples.items():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+    def write_speedscope(self, path):
+        """Writes the samples in the speedscope file format (https://www.speedscope.app)"""
+        frames = {}
+        samples, weights = [], []
+        for stack, count in self.samples.items():
+            samples.append([frames.setdefault(name, len(frames)) for name in stack])
+            weights.append(count * self.interval)
+        profile = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": [{"name": name} for name in frames]},
+            "profiles": [{
+                "type": "sampled",
+                "name": str(self.vm.image_file),
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+        with open(path, mode="w") as f:
+            json.dump(profile, f)
+
+    def write(self, path):
+        """Writes the samples, in the speedscope format for .json files, folded otherwise"""
+        if str(path).endswith(".json"):
+            self.write_speedscope(path)
+        else:
+            self.write_folded(path)
+
+
+def profile_from_environment(vm):
+    """
+    Starts a sampling profiler of vm when STVM_PROFILE is set to an output
+    file, the samples are written when the process exits.
+    STVM_PROFILE_INTERVAL gives the sampling period in milliseconds.
+    Called once by the entry point (debug.py), not for each VM.
+    """
+    path = os.environ.get("STVM_PROFILE")
+    if not path:
+        return None
+    interval = float(os.environ.get("STVM_PROFILE_INTERVAL", 5)) / 1000
+    profiler = SamplingProfiler(vm, interval)
+    profiler.start()
+
+    def write():
+        profiler.stop()
+        profiler.write(path)
+    atexit.register(write)
+    return profiler
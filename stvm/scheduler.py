@@ -0,0 +1,288 @@
+import time
+from collections import deque
+from .spurobjects import ImmediateInteger as integer
+
+
+class LinkNotFound(Exception):
+    """Raised when removing a link which is not in the list"""
+
+
+class RunQueue(object):
+    """
+    Native mirror of a LinkedList (run queue or semaphore).
+    The heap object is always written, the deque is only there to avoid
+    walking/reading the heap list on each operation.
+    The heap stays authoritative: if the image modified the list on its side,
+    the mirror is rebuilt from the heap. Only the ends are checked on each
+    operation, a link unlinked from the middle is found when it is removed.
+    """
+    def __init__(self, linkedlist, memory):
+        self.linkedlist = linkedlist
+        self.memory = memory
+        self.links = deque()
+        self.resync()
+
+    def resync(self):
+        nil = self.memory.nil
+        links = self.links
+        links.clear()
+        link = self.linkedlist[0]
+        while link is not nil:
+            links.append(link)
+            link = link[0]
+
+    def check(self):
+        linkedlist = self.linkedlist
+        links = self.links
+        if links:
+            in_sync = linkedlist[0] is links[0] and linkedlist[1] is links[-1]
+        else:
+            in_sync = linkedlist[0] is self.memory.nil
+        if not in_sync:
+            self.resync()
+
+    def is_empty(self):
+        self.check()
+        return not self.links
+
+    def add_last(self, link):
+        self.check()
+        linkedlist = self.linkedlist
+        links = self.links
+        if links:
+            links[-1].slots[0] = link
+        else:
+            linkedlist.slots[0] = link
+        linkedlist.slots[1] = link
+        link.slots[3] = linkedlist
+        links.append(link)
+
+    def add_first(self, link):
+        self.check()
+        linkedlist = self.linkedlist
+        links = self.links
+        link.slots[0] = links[0] if links else self.memory.nil
+        if not links:
+            linkedlist.slots[1] = link
+        linkedlist.slots[0] = link
+        link.slots[3] = linkedlist
+        links.appendleft(link)
+
+    def remove_first(self):
+        self.check()
+        nil = self.memory.nil
+        linkedlist = self.linkedlist
+        links = self.links
+        first = links.popleft()
+        next_link = first[0]
+        if next_link is nil:
+            linkedlist.slots[0] = nil
+            linkedlist.slots[1] = nil
+            if links:
+                links.clear()
+        else:
+            linkedlist.slots[0] = next_link
+            if not links or links[0] is not next_link:
+                self.resync()
+        first.slots[0] = nil
+        first.slots[3] = nil
+        return first
+
+    def find(self, link):
+        """Position of link in the mirror, if the heap list has it there too"""
+        links = self.links
+        try:
+            index = links.index(link)
+        except ValueError:
+            return None
+        previous = links[index - 1][0] if index else self.linkedlist[0]
+        return index if previous is link else None
+
+    def remove(self, link):
+        self.check()
+        index = self.find(link)
+        if index is None:
+            self.resync()
+            index = self.find(link)
+            if index is None:
+                raise LinkNotFound(link)
+        if index == 0:
+            return self.remove_first()
+        nil = self.memory.nil
+        linkedlist = self.linkedlist
+        links = self.links
+        previous = links[index - 1]
+        del links[index]
+        next_link = link[0]
+        previous.slots[0] = next_link
+        if next_link is nil:
+            linkedlist.slots[1] = previous
+        link.slots[0] = nil
+        link.slots[3] = nil
+        return link
+
+    def __len__(self):
+        self.check()
+        return len(self.links)
+
+
+class ProcessStats(object):
+    def __init__(self):
+        self.cpu_time = 0.0
+        self.switches = 0
+
+    def __repr__(self):
+        return f"<cpu={self.cpu_time:.6f}s switches={self.switches}>"
+
+
+class ProcessScheduler(object):
+    """
+    Native view over the image ProcessorScheduler.
+    Keeps a bitmap of the non-empty priorities and RunQueue mirrors of
+    the heap LinkedLists so resume/suspend/wait/signal do not scan the
+    priorities or walk the lists.
+    """
+    def __init__(self, vm):
+        self.vm = vm
+        self.memory = vm.memory
+        self.queues = {}
+        self.stats = {}
+        self.last_switch = time.perf_counter()
+        self.rescan()
+
+    @property
+    def scheduler(self):
+        return self.memory.special_object_array[3][1]
+
+    def rescan(self):
+        self.process_lists = self.scheduler[0]
+        self.priorities = [None]
+        self.priority_of = {}
+        self.ready = 0
+        for priority, linkedlist in enumerate(self.process_lists, start=1):
+            queue = self.queue(linkedlist)
+            self.priorities.append(queue)
+            self.priority_of[linkedlist.address] = priority
+            if not queue.is_empty():
+                self.ready |= 1 << priority
+
+    def queue(self, linkedlist):
+        try:
+            return self.queues[linkedlist.address]
+        except KeyError:
+            queue = RunQueue(linkedlist, self.memory)
+            self.queues[linkedlist.address] = queue
+            return queue
+
+    def is_empty_list(self, linkedlist):
+        return self.queue(linkedlist).is_empty()
+
+    def add_last_link(self, link, linkedlist):
+        self.queue(linkedlist).add_last(link)
+
+    def add_first_link(self, link, linkedlist):
+        self.queue(linkedlist).add_first(link)
+
+    def remove_first_link(self, linkedlist):
+        queue = self.queue(linkedlist)
+        first = queue.remove_first()
+        self.update_ready(queue)
+        return first
+
+    def remove_link(self, link, linkedlist):
+        queue = self.queue(linkedlist)
+        queue.remove(link)
+        self.update_ready(queue)
+        return link
+
+    def update_ready(self, queue):
+        priority = self.priority_of.get(queue.linkedlist.address)
+        if priority is None:
+            return
+        if queue.links:
+            self.ready |= 1 << priority
+        else:
+            self.ready &= ~(1 << priority)
+
+    def wake_highest_priority(self):
+        if self.scheduler[0] is not self.process_lists:
+            self.rescan()
+        for _ in range(2):
+            ready = self.ready
+            while ready:
+                priority = ready.bit_length() - 1
+                queue = self.priorities[priority]
+                if not queue.is_empty():
+                    process = queue.remove_first()
+                    if not queue.links:
+                        self.ready &= ~(1 << priority)
+                    return process
+                ready &= ~(1 << priority)
+                self.ready = ready
+            # the image touched the run queues directly, the bitmap is stale
+            self.rescan()
+        raise Exception("No runnable process")
+
+    def sleep(self, process):
+        priority = process[2].value
+        self.priorities[priority].add_last(process)
+        self.ready |= 1 << priority
+
+    def sleep_first(self, process):
+        """Puts process back at the head of its run queue"""
+        priority = process[2].value
+        self.priorities[priority].add_first(process)
+        self.ready |= 1 << priority
+
+    def suspend_active(self):
+        vm = self.vm
+        vm.transfer_to(self.wake_highest_priority())
+
+    def resume(self, process):
+        vm = self.vm
+        active = vm.active_process
+        if process[2].value > active[2].value:
+            if vm.debug:
+                print(f"<$> Sleep asked for {active.display()} by {process.display()}")
+            self.sleep(active)
+            vm.transfer_to(process)
+        else:
+            self.sleep(process)
+
+    def wait(self, semaphore):
+        excess_signals = semaphore[2].value
+        if excess_signals > 0:
+            semaphore.slots[2] = integer.create(excess_signals - 1, self.memory)
+            return
+        self.add_last_link(self.vm.active_process, semaphore)
+        self.suspend_active()
+
+    def signal(self, semaphore):
+        queue = self.queue(semaphore)
+        if queue.is_empty():
+            excess_signals = semaphore[2].value
+            semaphore.slots[2] = integer.create(excess_signals + 1, self.memory)
+            return
+        self.resume(queue.remove_first())
+
+    def process_stats(self, process):
+        try:
+            return self.stats[process.address]
+        except KeyError:
+            stats = ProcessStats()
+            self.stats[process.address] = stats
+            return stats
+
+    def account_switch(self, old, new):
+        now = time.perf_counter()
+        self.process_stats(old).cpu_time += now - self.last_switch
+        self.process_stats(new).switches += 1
+        self.last_switch = now
+
+    def report(self):
+        memory = self.memory
+        lines = []
+        for address, stats in sorted(self.stats.items(), key=lambda e: -e[1].cpu_time):
+            process = memory.object_at(address)
+            lines.append(f"{process.display()} priority={process[2].value} {stats}")
+        return lines
@@ -0,0 +1,145 @@
+import os
+import shutil
+import struct
+from pathlib import Path
+from .image64 import ImageHeader, Segment, PAGE_SIZE
+from .vm import VMContext
+
+
+BRIDGE = struct.Struct("<QQ")
+# Linux refuses more than IOV_MAX buffers in a writev call
+MAX_BUFFERS = 1024
+
+
+def write_all(fd, buffers):
+    """Writes all the buffers with as few writev calls as possible"""
+    buffers = [memoryview(b).cast("B") for b in buffers if len(b)]
+    while buffers:
+        written = os.writev(fd, buffers[:MAX_BUFFERS])
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers.pop(0))
+        if written:
+            buffers[0] = buffers[0][written:]
+
+
+def store_active_context(vm, context):
+    """
+    Writes the native contexts of the chain of context in the heap (senders
+    first) and makes it the suspended context of the active process.
+    """
+    chain = []
+    while isinstance(context, VMContext):
+        chain.append(context)
+        context = context.previous
+    for native in reversed(chain):
+        native.to_smalltalk_context(vm)
+    vm.active_process.slots[1] = chain[0].stcontext
+
+
+class SnapshotWriter(object):
+    """
+    Writes the memory of a VM as a 64-bit Spur image.
+    The image segments keep their addresses and their position in the file,
+    the used part of the allocation segment is appended as a new segment.
+    Objects are never serialized one by one, segments are streamed as they
+    are in memory.
+    """
+    def __init__(self, vm):
+        self.vm = vm
+        self.memory = vm.memory
+        self.image = vm.image
+
+    def layout(self):
+        """Returns (memory segment, objects size) for each segment to write"""
+        layout = []
+        for segment in self.memory.segments:
+            size = segment.top - segment.start
+            if size:
+                layout.append((segment, size))
+        return layout
+
+    def bridges(self, layout):
+        bridges = []
+        for i, (segment, size) in enumerate(layout):
+            end = segment.start + size + Segment.bridge_size
+            if i + 1 < len(layout):
+                next_segment, next_size = layout[i + 1]
+                span = next_segment.start - end
+                next_size += Segment.bridge_size
+            else:
+                span = next_size = 0
+            bridges.append(BRIDGE.pack((span // 8) | (0xFF << 56), next_size))
+        return bridges
+
+    def header(self, layout):
+        header = ImageHeader(bytearray(self.image.header))
+        header.data_size = sum(size + Segment.bridge_size for _, size in layout)
+        header.special_object_oop = self.memory.special_object_array.address
+        header.last_hash = self.vm.last_hash
+        header.first_seg_size = layout[0][1] + Segment.bridge_size
+        header.free_old_space = 0
+        return header.header
+
+    def write(self, path, incremental=False):
+        """
+        Writes the image in path. The file is written next to its destination
+        and then moved. If incremental is True, the original image is copied
+        and only the pages written since the memory was loaded are written.
+        """
+        path = Path(path)
+        layout = self.layout()
+        bridges = self.bridges(layout)
+        header = self.header(layout)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            if incremental:
+                self.write_incremental(tmp, layout, bridges, header)
+            else:
+                self.write_full(tmp, layout, bridges, header)
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    def write_full(self, path, layout, bridges, header):
+        buffers = [header]
+        for (segment, size), bridge in zip(layout, bridges):
+            buffers.append(segment.mem[:size])
+            buffers.append(bridge)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            write_all(fd, buffers)
+        finally:
+            os.close(fd)
+
+    def write_incremental(self, path, layout, bridges, header):
+        shutil.copyfile(self.image.file, path)
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, header, 0)
+            offset = len(header)
+            for (segment, size), bridge in zip(layout, bridges):
+                if segment.segment is not None:
+                    self.write_changed_pages(fd, segment, size, offset)
+                else:
+                    os.pwrite(fd, segment.mem[:size], offset)
+                os.pwrite(fd, bridge, offset + size)
+                offset += size + Segment.bridge_size
+            os.ftruncate(fd, offset)
+        finally:
+            os.close(fd)
+
+    def changed_pages(self, segment, size):
+        for start in segment.dirty_pages():
+            if start >= size:
+                break
+            yield start, min(start + PAGE_SIZE, size)
+
+    def write_changed_pages(self, fd, segment, size, offset):
+        mem = segment.mem
+        for start, end in self.changed_pages(segment, size):
+            os.pwrite(fd, mem[start:end], offset + start)
+
+
+def snapshot(vm, path=None, incremental=False):
+    SnapshotWriter(vm).write(path or vm.image_file, incremental=incremental)
@@ -1,6 +1,41 @@
 from .objects import SpurObject
 import struct
 
+DOUBLE = struct.Struct("<d")
+MASK64 = 0xFFFFFFFFFFFFFFFF
+SIGN_MASK = 1 << 63
+# SmallFloat64 keep the 8 low bits of the exponent, rotated with the sign
+# in the low bit of the value and offset by 896
+EXPONENT_OFFSET = 896 << 53
+MIN_EXPONENT = 897
+MAX_EXPONENT = 896 + 255
+
+
+def float_bits(value):
+    return int.from_bytes(DOUBLE.pack(value), "little")
+
+
+def bits_float(bits):
+    return DOUBLE.unpack(bits.to_bytes(8, "little"))[0]
+
+
+def smallfloat_oop(bits):
+    """Oop of the SmallFloat64 for the bits of a double, None if it must be boxed"""
+    if MIN_EXPONENT <= (bits >> 52) & 0x7FF <= MAX_EXPONENT:
+        rotated = ((bits << 1) & MASK64) | (bits >> 63)
+        return ((rotated - EXPONENT_OFFSET) << 3) | 0b100
+    if not bits & ~SIGN_MASK:
+        # +0.0 and -0.0 are not offset
+        return (bits >> 63 << 3) | 0b100
+    return None
+
+
+def smallfloat_bits(oop):
+    value = oop >> 3
+    if value > 1:
+        value += EXPONENT_OFFSET
+    return (value >> 1) | ((value & 1) << 63)
+
 class ImmediateInteger(SpurObject):
     class_ = None
     number_of_slots = 0
@@ -81,39 +116,22 @@ class ImmediateFloat(SpurObject):
         super().__init__(*args, **kwargs)
         self.kind = -4
 
-    @staticmethod
-    def ror(n, rotations, width):
-        return (2**width-1)&(n>>rotations|n<<(width-rotations))
-
-    @staticmethod
-    def rol(n, rotations, width):
-        return (2**width-1)&(n<<rotations|n>>(width-rotations))
-
     def update(self, new_address):
-        value = new_address >> 3
-        if value > 1:
-            value = value + 0x7000000000000000
-        value = self.ror(value, 1, 64)
-        value = struct.unpack(">d", struct.pack(">Q", value))[0]
-        self.value = value
+        self.value = bits_float(smallfloat_bits(new_address))
         self.class_ = self.memory.smallfloat64
-        self.tab_repr = None
 
     @classmethod
     def create(cls, i, memory):
-        addr = struct.unpack(">Q", struct.pack(">d", i))[0]
-        addr = cls.rol(addr, 1, 64)
-        if addr > 1:
-            addr = addr - 0x7000000000000000
-        addr = (addr << 3) | 0b100
-        return memory.object_at(addr)
+        """SmallFloat64 of a value in the immediate range (see float_or_boxed)"""
+        oop = smallfloat_oop(float_bits(i))
+        if oop is None:
+            raise ValueError(f"{i} is not in the SmallFloat64 range")
+        return memory.object_at(oop)
 
     def __getitem__(self, index):
-        try:
-            return ImmediateInteger.create(self.tab_repr[index], self.memory)
-        except Exception:
-            self.tab_repr = struct.unpack(">II", struct.pack(">d", self.value))
-            return ImmediateInteger.create(self.tab_repr[index], self.memory)
+        # the high word first, as Float>>basicAt:
+        bits = float_bits(self.value)
+        return ImmediateInteger.create(bits >> 32 if index == 0 else bits & 0xFFFFFFFF, self.memory)
 
     def __repr__(self):
         return f"{super().__repr__()}({self.value})"
@@ -121,6 +139,16 @@ class ImmediateFloat(SpurObject):
     def __float__(self):
         return self.value
 
+    def __eq__(self, other):
+        # the proxies are not unique (see SpurMemoryHandler.float_at), the
+        # same float has the same oop
+        if isinstance(other, SpurObject):
+            return self.address == other.address
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.address)
+
     def as_text(self):
         return f"{self.value}"
 
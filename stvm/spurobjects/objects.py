@@ -12,19 +12,26 @@ def spurobject(o):
 
 
 class SubList(Sequence):
-    def __init__(self, raw_slots, memory):
-        self.raw_slots = raw_slots
+    def __init__(self, raw_slots, memory, address):
+        self._raw = raw_slots
         self.memory = memory
+        self.address = address
+
+    @property
+    def raw_slots(self):
+        # read-only, the writes go through __setitem__ and are marked dirty
+        return self._raw.toreadonly()
 
     def __getitem__(self, i):
         if isinstance(i, slice):
             s = i.start and i.start * 8
             e = i.stop and i.stop * 8
-            return self.__class__(self.raw_slots[s:e:i.step], self.memory)
+            start, _, _ = i.indices(len(self))
+            return self.__class__(self._raw[s:e:i.step], self.memory, self.address + start * 8)
         if i < 0:
             i = len(self) + i
         i = i * 8
-        return self.memory.object_at(self.raw_slots[i:i + 8].cast("Q")[0])
+        return self.memory.object_at(self._raw[i:i + 8].cast("Q")[0])
 
     def __setitem__(self, i, val):
         if isinstance(i, slice):
@@ -33,12 +40,13 @@ class SubList(Sequence):
             i = len(self) + i
         i = i * 8
         if isinstance(val, SpurObject):
-            self.raw_slots[i:i + 8] = struct.pack("Q", val.address)
+            self._raw[i:i + 8] = struct.pack("Q", val.address)
+            self.memory.mark_dirty(self.address + i)
         else:
             raise TypeError("Non spur object in slot like?", val)
 
     def __len__(self):
-        return len(self.raw_slots) // 8
+        return len(self._raw) // 8
 
 
 class SpurObject(object):
@@ -77,14 +85,17 @@ class SpurObject(object):
 
         self.number_of_slots = nb_slots
         self.class_index = cls_index
-        self.raw_object = mem[address:address + self.header_size + (nb_slots * 8)]
+        # the views of the object are read-only, so a write cannot skip the
+        # dirty tracking of the checkpoints, see writable_slots()
+        self._raw = mem[address:address + self.header_size + (nb_slots * 8)]
+        self.raw_object = self._raw.toreadonly()
         self.header = self.raw_object[:8]
         self.header1 = self.header[:4]
         self.h1 = self.header1.cast("I")[0]
         self.header2 = self.header[4:8]
         self.h2 = self.header2.cast("I")[0]
         self.raw_slots = self.raw_object[8:]
-        self.slots = SubList(self.raw_slots, mem)
+        self.slots = SubList(self._raw[8:], mem, address + 8)
         self.object_format = (self.h1 & 0x1F000000) >> 24
         self.is_immutable = (self.h1 & 0x600000) > 0
         self.is_remembered = (self.h1 & 0x20000000) > 0
@@ -113,13 +124,11 @@ class SpurObject(object):
 
     @property
     def next_object(self):
-        new_object_address = self.end_address + 8
-        address = self.address
-        header = self.memory[address:address + 8]
-        _, nb_slots, _ = self.decode_basicinfo(header)
-        if nb_slots == 0xFF:
-            return self.memory.object_at(new_object_address)
-        return self.memory.object_at(self.end_address)
+        address = self.end_address
+        if self.memory[address + 7] == 0xFF:
+            # overflow word, the header of the next object follows it
+            address += 8
+        return self.memory.object_at(address)
 
     @staticmethod
     def decode_basicinfo(header):
@@ -135,6 +144,14 @@ class SpurObject(object):
     def __setitem__(self, index, value):
         self.slots[index] = value
 
+    def writable_slots(self, start=0, stop=None):
+        """Writable view of the bytes start:stop of the slots, marked dirty"""
+        if stop is None:
+            stop = len(self.raw_slots)
+        if stop > start:
+            self.memory.mark_dirty(self.address + 8 + start, stop - start)
+        return self._raw[8 + start:8 + stop]
+
     def basic_at(self, index):
         return self[index]
 
@@ -234,6 +251,7 @@ class Indexable(SpurObject):
         self.nb_empty_cases = self._shift[shift]
         self.format = self._formats[shift]
         self.slots = self.raw_slots.cast(self.format)
+        self._slots = self._raw[8:].cast(self.format)
 
     def raw_at(self, index):
         return self.slots[index]
@@ -253,11 +271,32 @@ class Indexable(SpurObject):
             value = value.value
         elif t is char:
             value = ord(value.value)
-        self.slots[index] = value
+        self._slots[index] = value
+        self.memory.mark_dirty(self.address + 8 + index * self.nb_bits // 8, self.nb_bits // 8)
 
     def as_text(self):
+        handler = self.memory.handler
+        if self.class_index != handler.symbol_index:
+            return self.decode_text()
+        # symbols do not change, their text is decoded once
+        try:
+            return handler.texts[self.address]
+        except KeyError:
+            text = handler.texts[self.address] = self.decode_text()
+            return text
+
+    def decode_text(self):
+        size = len(self)
+        if self.nb_bits == 8:
+            return str(self.raw_slots[:size], "latin-1")
+        if self.nb_bits == 32:
+            # WideString
+            try:
+                return str(self.slots[:size], "utf-32-le")
+            except UnicodeDecodeError:
+                ...
         raw_at = self.raw_at
-        return "".join(chr(raw_at(i)) for i in range(len(self)))
+        return "".join(chr(raw_at(i)) for i in range(size))
 
     def as_int(self):
         result = 0
@@ -269,9 +308,8 @@ class Indexable(SpurObject):
         return self.as_int()
 
     def as_float(self):
-        val = self.raw_at(1) << self.nb_bits | self.raw_at(0)
-        val = struct.unpack(">d", struct.pack(">Q", val))[0]
-        return val
+        # BoxedFloat64 keep the double in the native order
+        return DOUBLE.unpack_from(self.raw_slots)[0]
 
     def __repr__(self):
         try:
@@ -315,7 +353,7 @@ class CompiledMethod(SpurObject):
         self.frame_size = 56 if method_format & 0x20000 else 16
         self.literals = self.slots[1:num_literals]
         # self.trailer_byte = raw[-1]
-        self.trailer = MethodTrailer(raw[-1], self)
+        self.trailer = MethodTrailer(raw[-1], self, self.memory.method_trailers.get(self.address))
         self.bytecodes = raw[num_literals * 8 + 8:-self.trailer.size]
 
     def __getitem__(self, i):
@@ -325,7 +363,7 @@ class CompiledMethod(SpurObject):
 
     def __setitem__(self, i, value):
         if not isinstance(i, slice) and i >= self.initial_pc:
-            self.raw_data[i] = value.value
+            self.writable_slots(i, i + 1)[0] = value.value
             return
         super().__setitem__(i, value)
 
@@ -341,10 +379,14 @@ class CompiledMethod(SpurObject):
 
 
 class MethodTrailer(object):
-    def __init__(self, trailer_byte, compiled_method):
+    def __init__(self, trailer_byte, compiled_method, size=None):
         self.compiled_method = compiled_method
         self.trailer_byte = trailer_byte
-        self.decode()
+        if size is None:
+            self.decode()
+        else:
+            self.data = None
+            self.size = size
 
     def decode_length(self):
         num_bytes = self.trailer_byte & 0x03
@@ -409,3 +451,4 @@ class MethodTrailer(object):
 
 from .immediate import ImmediateInteger as integer
 from .immediate import ImmediateChar as char
+from .immediate import DOUBLE
@@ -0,0 +1,410 @@
+import struct
+
+SMALLINT_INDEX = 1
+CHARACTER_INDEX = 2
+SMALLFLOAT_INDEX = 4
+LARGENEG_INDEX = 32
+LARGEPOS_INDEX = 33
+BOXEDFLOAT_INDEX = 34
+MESSAGE_INDEX = 35
+CONTEXT_INDEX = 36
+CLOSURE_INDEX = 37
+SEMAPHORE_INDEX = 48
+METACLASS_PAGE = 1024
+
+SPECIAL_SELECTORS = [
+    ("+", 1), ("-", 1), ("<", 1), (">", 1), ("<=", 1), (">=", 1), ("=", 1), ("~=", 1),
+    ("*", 1), ("/", 1), ("\\\\", 1), ("@", 1), ("bitShift:", 1), ("//", 1), ("bitAnd:", 1), ("bitOr:", 1),
+    ("at:", 1), ("at:put:", 2), ("size", 0), ("next", 0), ("nextPut:", 1), ("atEnd", 0), ("==", 1), ("class", 0),
+    ("blockCopy:", 1), ("value", 0), ("value:", 1), ("do:", 1), ("new", 0), ("new:", 1), ("x", 0), ("y", 0),
+]
+
+
+def smallint(i):
+    return ((i << 3) | 1) & 0xFFFFFFFFFFFFFFFF
+
+
+class HeapObject(object):
+    def __init__(self, oop, class_index, format, nb_slots, hash=0):
+        self.oop = oop
+        self.class_index = class_index
+        self.format = format
+        self.nb_slots = nb_slots
+        self.hash = hash
+        self.body = bytearray(max(nb_slots, 1) * 8)
+
+    def __setitem__(self, i, value):
+        if isinstance(value, HeapObject):
+            value = value.oop
+        struct.pack_into("<Q", self.body, i * 8, value)
+
+    def header(self):
+        h1 = (self.class_index & 0x3FFFFF) | ((self.format & 0x1F) << 24)
+        h2 = (self.hash & 0x3FFFFF) | (min(self.nb_slots, 255) << 24)
+        return struct.pack("<Q", (h2 << 32) | h1)
+
+
+class SegmentBuilder(object):
+    def __init__(self, base):
+        self.base = base
+        self.cursor = base
+        self.objects = []
+
+    def new(self, class_index, format, nb_slots, hash=0):
+        oop = self.cursor + 8 if nb_slots >= 255 else self.cursor
+        obj = HeapObject(oop, class_index, format, nb_slots, hash)
+        self.objects.append(obj)
+        self.cursor = oop + 8 + max(nb_slots, 1) * 8
+        return obj
+
+    def serialize(self, next_segment_size=0, bridge_span=0):
+        out = bytearray()
+        for obj in self.objects:
+            if obj.nb_slots >= 255:
+                out += struct.pack("<Q", obj.nb_slots | (0xFF << 56))
+            out += obj.header()
+            out += obj.body
+        out += struct.pack("<QQ", (bridge_span // 8) | (0xFF << 56), next_segment_size)
+        return bytes(out)
+
+
+class Assembler(object):
+    """Tiny V3PlusClosures assembler, labels are resolved on build"""
+
+    def __init__(self):
+        self.code = []
+        self.labels = {}
+
+    def emit(self, *bytes):
+        self.code.extend(bytes)
+        return self
+
+    def label(self, name):
+        self.labels[name] = len(self.code)
+        return self
+
+    def push_temp(self, i): return self.emit(16 + i)
+    def pop_temp(self, i): return self.emit(104 + i)
+    def push_rcvr_var(self, i): return self.emit(i)
+    def pop_rcvr_var(self, i): return self.emit(96 + i)
+    def push_literal(self, i): return self.emit(32 + i)
+    def push_literal_var(self, i): return self.emit(64 + i)
+    def push_self(self): return self.emit(112)
+    def push_true(self): return self.emit(113)
+    def push_false(self): return self.emit(114)
+    def push_nil(self): return self.emit(115)
+    def push_int(self, i): return self.emit(117 + i)
+    def pop(self): return self.emit(135)
+    def dup(self): return self.emit(136)
+    def return_self(self): return self.emit(120)
+    def return_top(self): return self.emit(124)
+    def block_return(self): return self.emit(125)
+    def special_send(self, selector):
+        index = [s for s, _ in SPECIAL_SELECTORS].index(selector)
+        return self.emit(176 + index)
+
+    def send(self, literal, nb_args):
+        if nb_args > 2 or literal > 15:
+            return self.emit(131, (nb_args << 5) | literal)
+        return self.emit((208, 224, 240)[nb_args] + literal)
+
+    def super_send(self, literal, nb_args):
+        return self.emit(133, (nb_args << 5) | literal)
+
+    def jump(self, label):
+        self.code.append(("jump", label))
+        self.code.extend([None])
+        return self
+
+    def jump_false(self, label):
+        self.code.append(("jump_false", label))
+        self.code.extend([None])
+        return self
+
+    def jump_true(self, label):
+        self.code.append(("jump_true", label))
+        self.code.extend([None])
+        return self
+
+    def closure(self, nb_args, nb_copied, body):
+        self.emit(143, (nb_copied << 4) | nb_args, len(body) >> 8, len(body) & 0xFF)
+        return self.emit(*body)
+
+    def build(self):
+        out = []
+        for pos, b in enumerate(self.code):
+            if isinstance(b, tuple):
+                kind, label = b
+                target = self.labels[label]
+                delta = target - (pos + 2)
+                if kind == "jump":
+                    out.extend([164 + (delta >> 8), delta & 0xFF])
+                else:
+                    assert 0 <= delta < 1024
+                    base = 168 if kind == "jump_true" else 172
+                    out.extend([base + (delta >> 8), delta & 0xFF])
+            elif b is not None:
+                out.append(b)
+        return bytes(out)
+
+
+class SyntheticImage(object):
+    """Builds a minimal 64-bit Spur image with a handful of classes"""
+
+    old_base = 0x1000000
+
+    def __init__(self):
+        self.heap = SegmentBuilder(self.old_base)
+        self.symbols = {}
+        self.classes = {}
+        self.globals = {}
+        self.next_index = 50
+        heap = self.heap
+        self.nil = heap.new(0, 0, 0)
+        self.false = heap.new(0, 0, 0)
+        self.true = heap.new(0, 0, 0)
+        self.free_list = heap.new(0, 9, 64)
+        self.class_table = heap.new(0, 2, 4096)
+        self.pages = [heap.new(0, 2, 1024) for _ in range(2)]
+        for i in range(4096):
+            self.class_table[i] = self.pages[i] if i < len(self.pages) else self.nil
+        for page in self.pages:
+            for i in range(1024):
+                page[i] = self.nil
+        self.define_kernel()
+
+    def define_kernel(self):
+        c = self.define_class
+        c("Metaclass", None, 1, 6)
+        c("Object", None, 1, 0)
+        c("UndefinedObject", "Object", 0, 0)
+        c("Boolean", "Object", 0, 0)
+        c("True", "Boolean", 0, 0)
+        c("False", "Boolean", 0, 0)
+        c("Magnitude", "Object", 0, 0)
+        c("Number", "Magnitude", 0, 0)
+        c("Integer", "Number", 0, 0)
+        c("SmallInteger", "Integer", 0, 0, index=SMALLINT_INDEX)
+        c("Character", "Magnitude", 0, 0, index=CHARACTER_INDEX)
+        c("Float", "Number", 10, 0)
+        c("SmallFloat64", "Float", 0, 0, index=SMALLFLOAT_INDEX)
+        c("BoxedFloat64", "Float", 10, 0, index=BOXEDFLOAT_INDEX)
+        c("LargePositiveInteger", "Integer", 16, 0, index=LARGEPOS_INDEX)
+        c("LargeNegativeInteger", "LargePositiveInteger", 16, 0, index=LARGENEG_INDEX)
+        c("Message", "Object", 1, 3, index=MESSAGE_INDEX)
+        c("Context", "Object", 3, 6, index=CONTEXT_INDEX)
+        c("BlockClosure", "Object", 3, 3, index=CLOSURE_INDEX)
+        c("Semaphore", "Object", 1, 3, index=SEMAPHORE_INDEX)
+        c("Array", "Object", 2, 0)
+        c("ByteString", "Object", 16, 0)
+        c("ByteSymbol", "ByteString", 16, 0)
+        c("ByteArray", "Object", 16, 0)
+        c("Bitmap", "Object", 10, 0)
+        c("CompiledMethod", "Object", 24, 0)
+        c("MethodDictionary", "Object", 3, 2)
+        c("Association", "Object", 1, 2)
+        c("LinkedList", "Object", 1, 2)
+        c("Process", "Object", 1, 5)
+        c("ProcessorScheduler", "Object", 1, 2)
+        c("Point", "Object", 1, 2)
+        c("SystemDictionary", "Object", 1, 2)
+        c("SmalltalkImage", "Object", 1, 1)
+        for cls in self.classes.values():
+            cls[6] = self.symbol(cls.name)
+            cls.meta[0] = self.nil
+
+    def index_of(self, name):
+        return self.classes[name].hash
+
+    def define_class(self, name, superclass, spec, size, index=None):
+        heap = self.heap
+        if index is None:
+            index = self.next_index
+            self.next_index += 1
+        meta_index = METACLASS_PAGE + index
+        meta = heap.new(self.classes["Metaclass"].hash if "Metaclass" in self.classes else index,
+                        1, 6, hash=meta_index)
+        cls = heap.new(meta_index, 1, 7, hash=index)
+        cls.name = name
+        cls.meta = meta
+        cls.selectors = []
+        cls.methods = []
+        for i in range(7):
+            cls[i] = self.nil
+        for i in range(6):
+            meta[i] = self.nil
+        cls[0] = self.classes[superclass] if superclass else self.nil
+        cls[2] = smallint((spec << 16) | size)
+        meta[2] = smallint((1 << 16) | 7)
+        meta[5] = cls
+        self.pages[0][index] = cls
+        self.pages[1][index] = meta
+        self.classes[name] = cls
+        return cls
+
+    def new(self, class_name, nb_slots=None, data=None):
+        cls = self.classes[class_name]
+        spec = (smallint_value(cls) >> 16) & 0x1F
+        size = smallint_value(cls) & 0xFFFF
+        if data is not None:
+            unit = {9: 8, 10: 4, 12: 2, 16: 1, 24: 1}[spec]
+            nb_slots = -(-len(data) // 8)
+            format = spec + (nb_slots * 8 - len(data)) // unit
+            obj = self.heap.new(cls.hash, format, nb_slots)
+            obj.body[:len(data)] = data
+            return obj
+        nb_slots = size + (nb_slots or 0)
+        obj = self.heap.new(cls.hash, spec, nb_slots)
+        for i in range(nb_slots):
+            obj[i] = self.nil
+        return obj
+
+    def symbol(self, text):
+        if text not in self.symbols:
+            self.symbols[text] = self.new("ByteSymbol", data=text.encode("latin-1"))
+        return self.symbols[text]
+
+    def string(self, text):
+        return self.new("ByteString", data=text.encode("latin-1"))
+
+    def array(self, values):
+        array = self.new("Array", len(values))
+        for i, v in enumerate(values):
+            array[i] = v
+        return array
+
+    def association(self, key, value):
+        assoc = self.new("Association")
+        assoc[0] = key
+        assoc[1] = value
+        return assoc
+
+    def binding(self, class_name):
+        if class_name not in self.globals:
+            cls = self.classes[class_name]
+            self.globals[class_name] = self.association(self.symbol(class_name), cls)
+        return self.globals[class_name]
+
+    def method(self, class_name, selector, code, literals=(), nb_args=0, nb_temps=0,
+               primitive=0, meta=False):
+        cls = self.classes[class_name]
+        if primitive:
+            code = bytes([139, primitive & 0xFF, primitive >> 8]) + code
+        literals = [*literals, self.symbol(selector), self.binding(class_name)]
+        header = len(literals) | (primitive and 0x10000) | (nb_temps + nb_args) << 18 | nb_args << 24
+        data = bytearray(8 * (len(literals) + 1))
+        struct.pack_into("<Q", data, 0, smallint(header))
+        for i, lit in enumerate(literals):
+            lit = lit.oop if isinstance(lit, HeapObject) else lit
+            struct.pack_into("<Q", data, 8 * (i + 1), lit)
+        data += code + b"\x00"
+        method = self.new("CompiledMethod", data=bytes(data))
+        method.initial_pc = 8 * (len(literals) + 1)
+        target = cls.meta if meta else cls
+        target.selectors = getattr(target, "selectors", [])
+        target.methods = getattr(target, "methods", [])
+        target.selectors.append(self.symbol(selector))
+        target.methods.append(method)
+        return method
+
+    def install_method_dictionaries(self):
+        for cls in self.classes.values():
+            for target in (cls, cls.meta):
+                selectors = getattr(target, "selectors", [])
+                methods = getattr(target, "methods", [])
+                size = max(len(selectors), 1)
+                mdict = self.new("MethodDictionary", size)
+                values = self.array(methods + [self.nil] * (size - len(methods)))
+                mdict[0] = smallint(len(selectors))
+                mdict[1] = values
+                for i, sel in enumerate(selectors):
+                    mdict[2 + i] = sel
+                target[1] = mdict
+
+    def special_selectors(self):
+        values = []
+        for selector, nb_args in SPECIAL_SELECTORS:
+            values.extend([self.symbol(selector), smallint(nb_args)])
+        return self.array(values)
+
+    def process(self, context, priority):
+        process = self.new("Process")
+        process[1] = context if context is not None else self.nil
+        process[2] = smallint(priority)
+        return process
+
+    def context(self, receiver, method, frame_size=16):
+        ctx = self.new("Context", frame_size)
+        ctx[1] = smallint(method.initial_pc - 1)
+        ctx[2] = smallint(0)
+        ctx[3] = method
+        ctx[5] = receiver
+        return ctx
+
+    def build(self, main_receiver=None, main_method=None):
+        """Returns the image bytes"""
+        if main_method is None:
+            main_method = self.method("UndefinedObject", "main", bytes([123]))
+        self.install_method_dictionaries()
+        lists = self.array([self.new("LinkedList") for _ in range(80)])
+        main_ctx = self.context(main_receiver or self.nil, main_method)
+        active = self.process(main_ctx, 40)
+        idle = self.process(self.context(self.nil, main_method), 10)
+        idle_list = struct.unpack_from("<Q", lists.body, 9 * 8)[0]
+        idle[3] = idle_list
+        for obj in self.heap.objects:
+            if obj.oop == idle_list:
+                obj[0] = idle
+                obj[1] = idle
+        scheduler = self.new("ProcessorScheduler")
+        scheduler[0] = lists
+        scheduler[1] = active
+        globals_ = self.new("SystemDictionary")
+        smalltalk = self.new("SmalltalkImage")
+        bindings = [self.binding(name) for name in self.classes]
+        globals_[0] = smallint(len(bindings))
+        globals_[1] = self.array(bindings)
+        smalltalk[0] = globals_
+        processor = self.association(self.symbol("Processor"), scheduler)
+        c = self.classes
+        soa = self.array([self.nil] * 60)
+        soa[0] = self.nil
+        soa[1] = self.false
+        soa[2] = self.true
+        soa[3] = processor
+        soa[5] = c["SmallInteger"]
+        soa[6] = c["ByteString"]
+        soa[7] = c["Array"]
+        soa[8] = smalltalk
+        soa[9] = c["BoxedFloat64"]
+        soa[10] = c["Context"]
+        soa[12] = c["Point"]
+        soa[13] = c["LargePositiveInteger"]
+        soa[15] = c["Message"]
+        soa[16] = c["CompiledMethod"]
+        soa[18] = c["Semaphore"]
+        soa[19] = c["Character"]
+        soa[20] = self.symbol("doesNotUnderstand:")
+        soa[21] = self.symbol("cannotReturn:")
+        soa[23] = self.special_selectors()
+        soa[25] = self.symbol("mustBeBoolean")
+        soa[26] = c["ByteArray"]
+        soa[27] = c["Process"]
+        soa[36] = c["BlockClosure"]
+        soa[42] = c["LargeNegativeInteger"]
+        for name in ("nil", "false", "true"):
+            obj = getattr(self, name)
+            obj.class_index = {"nil": "UndefinedObject", "false": "False", "true": "True"}[name]
+            obj.class_index = self.index_of(obj.class_index)
+        for cls in self.classes.values():
+            cls.meta.class_index = self.index_of("Metaclass")
+        segment = self.heap.serialize()
+        header = bytearray(128)
+        struct.pack_into("<IIQQQQQQ", header, 0, 68021, 128, len(segment), self.old_base,
+                         soa.oop, 1000, 0, 0)
+        struct.pack_into("<Q", header, 72, len(segment))
+        return bytes(header) + segment
+
+
+def smallint_value(cls):
+    return struct.unpack_from("<Q", cls.body, 16)[0] >> 3
@@ -0,0 +1,163 @@
+import struct
+import zlib
+from collections import deque, namedtuple
+
+
+MAGIC = b"STVMTRACE1\n"
+# method oop, pc, bytecode, receiver class index, send target (method oop or 0)
+RECORD = struct.Struct("<QHBIQ")
+# codec, number of records, size of the compressed data
+BLOCK = struct.Struct("<BII")
+RAW, ZLIB, ZSTD = 0, 1, 2
+
+TraceRecord = namedtuple("TraceRecord", "method pc bytecode receiver_class target")
+
+
+def class_index_of(obj):
+    # immediates class index is their tag
+    return obj.address & 0x7 or obj.class_index
+
+
+class Compressor(object):
+    def __init__(self, codec, level):
+        self.codec = codec
+        self.level = level
+        if codec == ZSTD:
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(level=level)
+
+    def compress(self, data):
+        if self.codec == ZLIB:
+            return zlib.compress(data, self.level)
+        if self.codec == ZSTD:
+            return self.compressor.compress(data)
+        return bytes(data)
+
+
+def decompress(codec, data):
+    if codec == ZLIB:
+        return zlib.decompress(data)
+    if codec == ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class TraceRecorder(object):
+    """
+    Records every executed bytecode in blocks of struct packed records.
+    Blocks are compressed (zlib by default, zstd if the zstandard module is
+    installed and asked for) and written to a file, or kept in a ring of
+    `ring_blocks` blocks in memory when no file is given.
+    The recorder is installed as an execution hook of the VM and has no
+    cost when it is not installed.
+    """
+    def __init__(self, path=None, block_records=65536, codec=ZLIB, level=1, ring_blocks=16):
+        self.path = path
+        self.block_records = block_records
+        self.compressor = Compressor(codec, level)
+        self.file = None
+        if path is not None:
+            self.file = open(path, mode="wb")
+            self.file.write(MAGIC)
+        self.ring = deque(maxlen=ring_blocks)
+        self.buffer = bytearray()
+        self.count = 0
+        self.total = 0
+        self.pending = None
+
+    def before(self, vm, context, bytecode):
+        if self.pending is not None:
+            self.flush_pending(0)
+        self.pending = (context.compiled_method.address, context.pc, bytecode,
+                        class_index_of(context.receiver))
+
+    def after(self, vm, context, bytecode):
+        new_context = vm.current_context
+        target = 0
+        if new_context is not context and new_context.previous is context:
+            target = new_context.compiled_method.address
+        self.flush_pending(target)
+
+    def flush_pending(self, target):
+        method, pc, bytecode, receiver_class = self.pending
+        self.pending = None
+        self.buffer += RECORD.pack(method, pc, bytecode, receiver_class, target)
+        self.count += 1
+        self.total += 1
+        if self.count >= self.block_records:
+            self.flush_block()
+
+    def flush_block(self):
+        if not self.count:
+            return
+        data = self.compressor.compress(self.buffer)
+        block = BLOCK.pack(self.compressor.codec, self.count, len(data)) + data
+        if self.file is not None:
+            self.file.write(block)
+        else:
+            self.ring.append(block)
+        self.buffer = bytearray()
+        self.count = 0
+
+    def close(self):
+        if self.pending is not None:
+            self.flush_pending(0)
+        self.flush_block()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def records(self):
+        """Records kept in the in-memory ring, followed by the current block"""
+        for block in self.ring:
+            yield from read_block(memoryview(block))
+        for fields in RECORD.iter_unpack(bytes(self.buffer)):
+            yield TraceRecord(*fields)
+
+    def dump(self, path):
+        """Writes the in-memory ring in a trace file"""
+        with open(path, mode="wb") as f:
+            f.write(MAGIC)
+            for block in self.ring:
+                f.write(block)
+
+
+def read_block(data):
+    codec, count, size = BLOCK.unpack_from(data)
+    raw = decompress(codec, data[BLOCK.size:BLOCK.size + size])
+    for fields in RECORD.iter_unpack(raw):
+        yield TraceRecord(*fields)
+
+
+class TraceReader(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, mode="rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a trace file")
+            while True:
+                header = f.read(BLOCK.size)
+                if len(header) < BLOCK.size:
+                    return
+                codec, count, size = BLOCK.unpack(header)
+                yield from read_block(header + f.read(size))
+
+
+def diff(trace_a, trace_b):
+    """
+    Returns (index, record a, record b) for the first record which differs in
+    two traces, or None if they are the same. A missing record is None.
+    """
+    index = 0
+    iter_a, iter_b = iter(trace_a), iter(trace_b)
+    while True:
+        a = next(iter_a, None)
+        b = next(iter_b, None)
+        if a is None and b is None:
+            return None
+        if a != b:
+            return index, a, b
+        index += 1
@@ -1,7 +1,7 @@
 import struct
 from math import ceil
 from .spurobjects import ImmediateInteger as integer
-from .spurobjects import ImmediateFloat as smallfloat
+from .spurobjects.immediate import float_bits, smallfloat_oop
 
 LargeNegativeIntClass = 32
 LargePositiveIntClass = 33
@@ -22,7 +22,7 @@ def large_or_small(r, vm):
         result = vm.allocate(vm.memory.largenegativeint, array_size=length)
     else:
         result = vm.allocate(vm.memory.largepositiveint, array_size=length)
-    result.raw_slots[:length] = rb
+    result.writable_slots(0, length)[:] = rb
     return result
 
 
@@ -38,10 +38,14 @@ def to_int(e):
 
 
 def to_bytestring(e, vm):
+    try:
+        data = bytes(e, encoding="latin-1")
+    except UnicodeEncodeError:
+        # not representable in a ByteString, kept utf-8 encoded
+        data = bytes(e, encoding="utf-8")
     cls = vm.memory.bytestring
-    s = vm.allocate(cls, data_len=len(e))
-    mem = s.raw_slots.cast("B")
-    mem[:len(e)] = bytes(e, encoding="utf-8")
+    s = vm.allocate(cls, data_len=len(data))
+    s.writable_slots(0, len(data))[:] = data
     return s
 
 
@@ -51,14 +55,69 @@ def array(size, vm):
 
 
 def float_or_boxed(i, vm):
-    value = struct.unpack(">Q", struct.pack(">d", i))[0]
-    exp = (value >> 52) & 0x7FF
-    if 127 <= exp <= 1023:
-        return smallfloat.create(i, vm.memory)
-    cls = vm.memory.boxedfloat64
-    instance = vm.allocate(cls, data_len=2)
-    part0 = value & 0xFFFFFFFF
-    part1 = value >> instance.nb_bits
-    instance[0] = part0
-    instance[1] = part1
+    bits = float_bits(i)
+    oop = smallfloat_oop(bits)
+    if oop is not None:
+        return vm.memory.object_at(oop)
+    instance = vm.allocate(vm.memory.boxedfloat64, data_len=2)
+    # the double in the native order
+    instance.writable_slots(0, 8)[:] = bits.to_bytes(8, "little")
     return instance
+
+
+def is_string(e, vm):
+    memory = vm.memory
+    cls = e.class_
+    return cls is memory.bytestring or cls is memory.special_symbols[0].class_
+
+
+def to_python(e, vm):
+    memory = vm.memory
+    if e is memory.nil:
+        return None
+    if e is memory.true:
+        return True
+    if e is memory.false:
+        return False
+    kind = e.kind
+    if kind == -1:
+        return e.value
+    if kind in (-2, -4):
+        return e.value
+    if e.class_index in (LargePositiveIntClass, LargeNegativeIntClass):
+        return to_int(e)
+    if e.class_ is memory.boxedfloat64:
+        return e.as_float()
+    if kind in range(16, 24):
+        if is_string(e, vm):
+            return e.as_text()
+        return bytes(e.raw_slots[:len(e)])
+    if e.class_ is memory.array:
+        return [to_python(x, vm) for x in e.slots]
+    return e.display()
+
+
+def from_python(e, vm):
+    memory = vm.memory
+    if e is None:
+        return memory.nil
+    if e is True:
+        return memory.true
+    if e is False:
+        return memory.false
+    if isinstance(e, int):
+        return large_or_small(e, vm)
+    if isinstance(e, float):
+        return float_or_boxed(e, vm)
+    if isinstance(e, str):
+        return to_bytestring(e, vm)
+    if isinstance(e, (bytes, bytearray)):
+        result = vm.allocate(memory.bytearray, data_len=len(e))
+        result.writable_slots(0, len(e))[:] = e
+        return result
+    if isinstance(e, (list, tuple)):
+        result = array(len(e), vm)
+        for i, x in enumerate(e):
+            result[i] = from_python(x, vm)
+        return result
+    return e
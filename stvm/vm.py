@@ -5,21 +5,35 @@ from .image64 import Image
 from .spurobjects.objects import *
 from .spurobjects import ImmediateInteger as integer
 from .bytecodes import ByteCodeMap
+from .scheduler import ProcessScheduler
+from .events import EventQueue
+from .heap import HeapIndex
+from .cache import ImageCache
+from .names import NameIndex
+from .breakpoints import Breakpoints
+from .display import HeadlessDisplay
+from . import checkpoint as checkpoints
 from .utils import DoesNotUnderstand
 
 
 class VM(object):
 
-    def __init__(self, image, bytecodes_map=ByteCodeMap, debug=False):
+    def __init__(self, image, bytecodes_map=ByteCodeMap, debug=False, memory=None, cache=False):
         self.image = image
-        self.memory = image.as_memory()
+        self.image_file = image.file
+        self.memory = memory if memory is not None else image.as_memory()
+        self.image_cache = None
+        if cache:
+            self.image_cache = ImageCache.for_image(image, self.memory)
+            self.image_cache.install(self.memory)
         self.allocator = MemoryAllocator(self.memory)
+        self.process_scheduler = ProcessScheduler(self)
+        self.events = EventQueue(self)
+        self.interrupt_countdown = self.events.check_every
         self.debug = debug
         self.bytecodes_map = bytecodes_map()
         self.new_process_waiting = False
         self.new_process = None
-        self.semaphores = []
-        self.semaphore_index = -1
         self.params = {
             40: integer.create(8, self.memory),  # word size
             44: integer.create(6854880, self.memory),  # edenSize
@@ -27,37 +41,30 @@ class VM(object):
         }
         self.current_context = self.initial_context()
         self.current_context.pc += 1
-        self.nextWakeupUsecs = 0
         self.method_cache = {}
         self.opened_files = {}
         self.last_hash = image.last_hash
         self.interrupt_keycode = 0
         self.defer_screen_update = False
-        self.screen = None
+        self.display = HeadlessDisplay(self)
+        self.checkpoints = []
+        # checkpoint the memory started from, and the generation of the
+        # writes it includes
+        self.checkpoint_base = (None, 0)
+        self.execute_hooks = []
+        self._names = None
+        self.breakpoints = Breakpoints()
+        self.sent_breakpoints = None
+        self.sampler = None
 
     def add_last_link_list(self, link, linkedlist):
-        if self.is_empty_list(linkedlist):
-            linkedlist.slots[0] = link
-        else:
-            last_link = linkedlist.slots[1]
-            last_link.slots[0] = link
-        linkedlist.slots[1] = link
-        link.slots[3] = linkedlist
+        self.process_scheduler.add_last_link(link, linkedlist)
 
     def is_empty_list(self, linkedlist):
-        return linkedlist[0] is self.memory.nil
+        return self.process_scheduler.is_empty_list(linkedlist)
 
     def remove_first_link_list(self, linkedlist):
-        nil = self.memory.nil
-        first = linkedlist[0]
-        last = first
-        if last is first:
-            linkedlist.slots[0] = nil
-            linkedlist.slots[1] = nil
-        else:
-            linkedlist.slots[0] = first[0]
-        first.slots[0] = nil
-        return first
+        return self.process_scheduler.remove_first_link(linkedlist)
 
     @property
     def scheduler(self):
@@ -72,105 +79,165 @@ class VM(object):
     def transfer_to(self, process):
         self.new_process_waiting = True
         self.new_process = process
+        self.force_interrupt_check()
 
     def asynchronous_signal(self, semaphore):
-        self.semaphore_index += 1
-        self.semaphores.append(semaphore)
+        self.events.signal(semaphore)
+
+    def force_interrupt_check(self):
+        self.interrupt_countdown = 0
 
     def synchronous_signal(self, sem):
-        if self.is_empty_list(sem):
-            excessSignals = sem.slots[2].value
-            sem.slots[2] = integer.create(excessSignals + 1, self.memory)
-            return
-        self.resume(self.remove_first_link_list(sem))
+        self.process_scheduler.signal(sem)
 
     def wake_highest_priority(self):
-        process_lists = self.scheduler[0]
-        priority = len(process_lists)
-        process_list = process_lists[priority - 1]
-        while self.is_empty_list(process_list):
-            priority -= 1
-            process_list = process_lists[priority]
-        return self.remove_first_link_list(process_list)
+        return self.process_scheduler.wake_highest_priority()
 
     def suspend_active(self):
-        print(f"<$> Suspend active context")
-        self.transfer_to(self.wake_highest_priority())
+        if self.debug:
+            print(f"<$> Suspend active context")
+        self.process_scheduler.suspend_active()
 
     def resume(self, process):
-        active = self.active_process
-        active_priority = active[2].value
-        new_priority = process[2].value
-        if new_priority > active_priority:
-            print(f"<$> Sleep asked for {active.display()} by {process.display()}")
-            self.sleep(active)
-            self.transfer_to(process)
-        else:
-            # print(f"<$> Sleep asked by {process.display()}")
-            self.sleep(process)
+        self.process_scheduler.resume(process)
 
     def wait(self, sem):
-        excessSignals = sem[2].value
-        if excessSignals > 0:
-            sem.slots[2] = integer.create(excessSignals - 1, self.memory)
-            return
-        self.add_last_link_list(self.active_process, sem)
-        self.suspend_active()
+        self.process_scheduler.wait(sem)
 
     def sleep(self, process):
-        print(f"<*> Process sleep  {process.display()}")
-        priority = process[2].value
-        process_lists = self.scheduler[0]
-        process_list = process_lists[priority - 1]
-        self.add_last_link_list(process, process_list)
+        if self.debug:
+            print(f"<*> Process sleep  {process.display()}")
+        self.process_scheduler.sleep(process)
+
+    def cancel_process_switch(self):
+        """
+        Undoes a pending transfer: the active process stays active and the
+        process it was leaving for is put back at the head of its run queue.
+        """
+        if not self.new_process_waiting:
+            return
+        self.new_process_waiting = False
+        active = self.scheduler[1]
+        if active[3] is not self.memory.nil:
+            self.process_scheduler.remove_link(active, active[3])
+        self.process_scheduler.sleep_first(self.new_process)
+        self.new_process = None
 
     def check_process_switch(self):
-        while self.semaphore_index >= 0:
-            self.synchronous_signal(self.semaphores[self.semaphore_index])
-            self.semaphore_index -= 1
         if self.new_process_waiting:
             self.new_process_waiting = False
             active = self.active_process
             print(f"<*> Process switch {active.display()} to {self.new_process.display()}")
+            self.process_scheduler.account_switch(active, self.new_process)
             active.slots[1] = self.current_context.to_smalltalk_context(self)
             self.scheduler.slots[1] = self.new_process
             self.current_context = self.new_process[1].adapt_context()
 
     @classmethod
-    def new(cls, file_name):
-        return cls(Image(file_name))
-
-    def run(self):
-        ...
+    def new(cls, file_name, cache=False):
+        return cls(Image(file_name), cache=cache)
+
+    def run(self, limit=None):
+        """
+        Runs the interpreter until a breakpoint is hit or `limit` bytecodes
+        are executed. Returns the breakpoint (or None) and the number of
+        executed bytecodes.
+        """
+        breakpoints = self.breakpoints
+        pcs = breakpoints.pcs
+        self.sent_breakpoints = None
+        count = 0
+        while limit is None or count < limit:
+            self.decode_execute(self.fetch())
+            count += 1
+            if self.sent_breakpoints is not None:
+                candidates, self.sent_breakpoints = self.sent_breakpoints, None
+                hit = breakpoints.first_hit(self, candidates)
+                if hit is not None:
+                    return hit, count
+            if pcs:
+                candidates = breakpoints.reached(self.current_context)
+                if candidates:
+                    hit = breakpoints.first_hit(self, candidates)
+                    if hit is not None:
+                        return hit, count
+        return None, count
+
+    def close(self):
+        """Releases the descriptors of the VM (event pipe, display viewer)"""
+        self.events.close()
+        self.display.close()
+
+    def add_breakpoint(self, breakpoint):
+        self.breakpoints.add(breakpoint)
+        if self.breakpoints.on_send:
+            self.lookup = self.breakpoint_lookup
+        return breakpoint
+
+    def remove_breakpoint(self, breakpoint):
+        self.breakpoints.remove(breakpoint)
+        if not self.breakpoints.on_send:
+            self.__dict__.pop("lookup", None)
+
+    def breakpoint_lookup(self, cls, selector):
+        """lookup() while breakpoints are checked on the activations"""
+        method = VM.lookup(self, cls, selector)
+        breakpoints = self.breakpoints
+        if (method.address in breakpoints.methods or selector.address in breakpoints.selectors
+                or method.primitive in breakpoints.primitives):
+            self.sent_breakpoints = breakpoints.sent(selector, method)
+        return method
 
     def initial_context(self):
         process = self.active_process
         context = process[1]
         return context.adapt_context()
 
+    def check_events(self):
+        self.interrupt_countdown = self.events.check_every
+        self.events.check()
+
     def check_interrupts(self):
-        memory = self.memory
-        if self.nextWakeupUsecs != 0:
-            now = int(round(time.time() * 1000000))
-            if now >= self.nextWakeupUsecs:
-                self.nextWakeupUsecs = 0
-                sema = memory.timer_semaphore
-                if sema is not memory.nil:
-                    self.asynchronous_signal(sema)
-                    print(f"<*> Signal timer semaphore {sema.display()}")
+        self.check_events()
+        self.check_process_switch()
 
     def low_fetch(self):
         return self.current_context.fetch_bytecode()
 
     def fetch(self):
-        # self.check_process_switch()
-        # self.check_interrupts()
+        self.interrupt_countdown -= 1
+        if self.interrupt_countdown <= 0:
+            self.check_interrupts()
         return self.low_fetch()
 
     def decode_execute(self, bytecode):
         result = self.bytecodes_map.execute(bytecode, self.current_context, self)
         return result
 
+    def hooked_decode_execute(self, bytecode):
+        context = self.current_context
+        hooks = self.execute_hooks
+        for hook in hooks:
+            hook.before(self, context, bytecode)
+        result = self.bytecodes_map.execute(bytecode, context, self)
+        for hook in hooks:
+            hook.after(self, context, bytecode)
+        return result
+
+    def add_execute_hook(self, hook):
+        """
+        hook.before(vm, context, bytecode) and hook.after(vm, context, bytecode)
+        are called around the execution of each bytecode. Without hooks,
+        decode_execute is not slowed down.
+        """
+        self.execute_hooks.append(hook)
+        self.decode_execute = self.hooked_decode_execute
+
+    def remove_execute_hook(self, hook):
+        self.execute_hooks.remove(hook)
+        if not self.execute_hooks:
+            del self.decode_execute
+
     def activate_context(self, context):
         self.current_context = context
 
@@ -180,8 +247,28 @@ class VM(object):
             return self.method_cache[cple]
         nil = self.memory.nil
         original_class = cls
+        cached_methods = self.image_cache.methods if self.image_cache else {}
         while cls != nil:
             method_dict = cls[1]
+            cached = cached_methods.get(cls.address)
+            if cached and cached[0] == method_dict.address:
+                # the image can modify the dictionary in place, the entries
+                # are checked against its slots before being used
+                selectors = method_dict.array
+                entry = cached[1].get(selector.address)
+                if entry is None:
+                    if selector.address not in selectors.raw_slots.cast("Q"):
+                        cls = cls[0]
+                        continue
+                else:
+                    index, method_address = entry
+                    if (index < len(selectors) and selectors[index] is selector
+                            and method_dict.instvars[1][index].address == method_address):
+                        method = self.memory.object_at(method_address)
+                        self.method_cache[cple] = method
+                        self.method_cache[(cls, selector)] = method
+                        return method
+                del cached_methods[cls.address]
             try:
                 index = method_dict.array.index(selector)
                 method = method_dict.instvars[1][index]
@@ -193,6 +280,98 @@ class VM(object):
                 cls = cls[0]
         raise DoesNotUnderstand(f"Method {selector.as_text()} not found in {original_class.display()}")
 
+    @property
+    def names(self):
+        """Index of the symbols and globals by name, built on first use"""
+        if self._names is None:
+            self._names = NameIndex(self.memory, self.image_cache)
+        return self._names
+
+    def find_selector(self, cls, text):
+        nil = self.memory.nil
+        original_class = cls
+        selector = self.names.symbol(text)
+        if selector is not None:
+            return selector
+        while cls is not nil:
+            for selector in cls[1].array:
+                if selector is not nil and selector.as_text() == text:
+                    self.names.add_symbol(selector)
+                    return selector
+            cls = cls[0]
+        raise DoesNotUnderstand(f"Method {text} not found in {original_class.display()}")
+
+    def lookup_global(self, name):
+        nil = self.memory.nil
+        binding = self.names.binding(name)
+        if binding is not None:
+            return binding[1]
+        # defined after the index was built
+        smalltalk_globals = self.memory.smalltalk[0]
+        for binding in smalltalk_globals[1]:
+            if binding is not nil and binding[0].as_text() == name:
+                self.names.add_binding(binding)
+                return binding[1]
+        raise KeyError(name)
+
+    def checkpoint(self, label=None):
+        """
+        Captures the heap, the native contexts, the scheduler state, the
+        allocation pointer and last_hash. Timers and opened files are not
+        part of the checkpoint.
+        """
+        previous, since = self.checkpoint_base
+        cp = checkpoints.take(self, label, previous, since)
+        self.checkpoints.append(cp)
+        self.checkpoint_base = (cp, self.memory.new_generation())
+        return cp
+
+    def restore(self, cp):
+        checkpoints.restore(self, cp)
+        self.checkpoint_base = (cp, self.memory.new_generation())
+
+    def evaluate(self, receiver, selector, args=(), limit=None):
+        """
+        Sends selector to receiver and runs the interpreter until the
+        method returns. The selector can be a symbol or its text.
+        The evaluation runs in the active process: if it would switch to
+        another process (a wait on a semaphore, a resumed process of
+        higher priority, ...), the switch is undone and ProcessSwitched
+        is raised. EvaluationLimitExceeded is raised after `limit`
+        bytecodes.
+        """
+        memory = self.memory
+        cls = receiver.class_
+        if isinstance(selector, str):
+            selector = self.find_selector(cls, selector)
+        method = self.lookup(cls, selector)
+        base = VMContext(memory.nil, method, memory)
+        base.stack = []
+        base._previous = memory.nil
+        context = VMContext(receiver, method, memory)
+        context.stack[:len(args)] = args
+        context._previous = base
+        previous_context = self.current_context
+        self.current_context = context
+        count = 0
+        try:
+            while self.current_context is not base:
+                # as fetch, the process switches are checked here
+                self.interrupt_countdown -= 1
+                if self.interrupt_countdown <= 0:
+                    self.check_events()
+                if self.new_process_waiting:
+                    process = self.new_process
+                    self.cancel_process_switch()
+                    raise ProcessSwitched(f"Evaluation would switch to {process.display()}")
+                self.decode_execute(self.low_fetch())
+                count += 1
+                if limit and count > limit:
+                    raise EvaluationLimitExceeded(f"Evaluation stopped after {limit} bytecodes")
+        finally:
+            self.current_context = previous_context
+        return base.pop()
+
     def dnu_context(self, rcvr, cls, selector, args):
         dnu = self.lookup(cls, self.memory.dnuSelector)
         memory = self.memory
@@ -223,26 +402,55 @@ class DebugException(Exception):
     ...
 
 
+class EvaluationError(Exception):
+    ...
+
+
+class EvaluationLimitExceeded(EvaluationError):
+    ...
+
+
+class ProcessSwitched(EvaluationError):
+    ...
+
+
 class MemoryAllocator(object):
     def __init__(self, memory):
         self.memory = memory
-        self.start = 1 << 3
+        self.segment = memory.allocation_segment
+        self.start = self.segment.start
         self.current = self.start
-        self.limit = self.memory.special_object_array.address
+        self.limit = self.segment.end
+        self.allocations = 0
+        self._heap_index = None
+
+    @property
+    def heap_index(self):
+        """Index of the instances per class, built on first use"""
+        if self._heap_index is None:
+            self._heap_index = HeapIndex(self.memory)
+        return self._heap_index
 
     def allocate(self, stclass, array_size=0, data_len=0):
-        addr = self.current
+        start = addr = self.current
         header, nb_slots = self.create_header(stclass, array_size, data_len)
+        if addr + 16 + nb_slots * 8 > self.limit:
+            raise MemoryError("Allocation segment is full")
         if nb_slots >= 255:
             addr = addr + 8
-            self.memory[addr-8:addr-4] = struct.pack("I", nb_slots)
+            self.memory[addr-8:addr] = struct.pack("<Q", nb_slots | (0xFF << 56))
         self.memory[addr:addr + 8] = header
         # set all the mem to nil first
         self.init_rawslots(self.memory, addr, nb_slots)
         instance = self.memory.object_at(addr)
         if instance.kind in range(9, 24):
             self.init_zero(instance)
-        self.current = instance.next_object.end_address + 8
+        self.current = instance.end_address
+        self.segment.top = self.current
+        self.allocations += 1
+        self.memory.mark_dirty(start, self.current - start)
+        if self._heap_index is not None:
+            self._heap_index.add(addr, stclass.identity_hash, nb_slots)
         return instance
 
     @staticmethod
@@ -257,7 +465,7 @@ class MemoryAllocator(object):
     def init_zero(instance):
         memory = instance.memory
         nb_values = len(instance.raw_slots)
-        instance.raw_slots[:] = b'\x00' * nb_values
+        instance.writable_slots()[:] = b'\x00' * nb_values
 
     def create_header(self, stclass, array_size=0, data_len=0):
         format = stclass.inst_format
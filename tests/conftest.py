@@ -0,0 +1,20 @@
+import pytest
+from stvm.image64 import Image
+from stvm.synthetic import SyntheticImage
+from stvm.vm import VM
+
+
+@pytest.fixture(scope="session")
+def image_bytes():
+    """Synthetic image with the kernel classes, a FloatArray and a Form class"""
+    s = SyntheticImage()
+    s.define_class("FloatArray", "Object", 10, 0)
+    s.define_class("Form", "Object", 1, 5)
+    return s.build()
+
+
+@pytest.fixture
+def vm(image_bytes):
+    vm = VM(Image.from_bytes(image_bytes, "test.image"))
+    yield vm
+    vm.close()
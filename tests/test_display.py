@@ -0,0 +1,128 @@
+import struct
+import zlib
+import pytest
+from stvm.display import Damage
+from stvm.primitives import be_display, defer_screen_update, show_display_rect, force_display_update
+from stvm.utils import from_python
+
+
+def display_form(vm, width, height, depth=32, pixel=0):
+    bits = vm.allocate(vm.lookup_global("Bitmap"), data_len=width * height)
+    bits.writable_slots(0, width * height * 4)[:] = struct.pack("<I", pixel) * (width * height)
+    form = vm.allocate(vm.lookup_global("Form"))
+    form[0] = bits
+    for i, value in enumerate((width, height, depth), start=1):
+        form[i] = from_python(value, vm)
+    return form
+
+
+@pytest.fixture
+def display(vm):
+    """Display of the vm on a 64x48 Form, without damage"""
+    be_display(display_form(vm, 64, 48), context=None, vm=vm)
+    vm.display.damage.take()
+    return vm.display
+
+
+def show(vm, left, top, right, bottom):
+    args = (from_python(v, vm) for v in (left, right, top, bottom))
+    show_display_rect(vm.memory.nil, *args, context=None, vm=vm)
+
+
+def test_damage_merges_overlapping_and_touching_rectangles():
+    damage = Damage()
+    damage.add(0, 0, 10, 10)
+    damage.add(5, 5, 20, 20)
+    damage.add(30, 30, 40, 40)
+    damage.add(40, 35, 50, 45)
+    assert sorted(damage.take()) == [(0, 0, 20, 20), (30, 30, 50, 45)]
+    assert not damage
+
+
+def test_damage_merges_rectangles_joined_by_a_new_one():
+    damage = Damage()
+    damage.add(0, 0, 10, 10)
+    damage.add(20, 0, 30, 10)
+    damage.add(8, 2, 22, 4)
+    assert damage.take() == [(0, 0, 30, 10)]
+
+
+def test_damage_ignores_empty_rectangles():
+    damage = Damage()
+    damage.add(5, 5, 5, 10)
+    damage.add(5, 10, 8, 2)
+    assert not damage and damage.take() == []
+
+
+def test_damage_switches_to_the_bounding_box():
+    damage = Damage(max_rects=3)
+    for i in range(3):
+        damage.add(i * 10, 0, i * 10 + 5, 5)
+    assert len(damage.rects) == 3
+    damage.add(0, 20, 5, 25)
+    assert damage.take() == [(0, 0, 25, 25)]
+
+
+def test_show_flushes_when_not_deferred(vm, display):
+    show(vm, 0, 0, 10, 10)
+    assert not display.damage
+    assert display.stats["flushes"] == 1 and display.stats["pixels"] == 100
+
+
+def test_show_is_clipped_to_the_screen(vm, display):
+    defer_screen_update(vm.memory.nil, vm.memory.true, context=None, vm=vm)
+    show(vm, -10, 40, 100, 100)
+    assert display.flush() == [(0, 40, 64, 48)]
+
+
+def test_deferred_updates_are_flushed_by_force_display_update(vm, display):
+    defer_screen_update(vm.memory.nil, vm.memory.true, context=None, vm=vm)
+    show(vm, 0, 0, 10, 10)
+    show(vm, 5, 5, 15, 15)
+    show(vm, 30, 30, 40, 40)
+    assert display.stats["flushes"] == 0
+    force_display_update(vm.memory.nil, context=None, vm=vm)
+    assert display.stats["flushes"] == 1 and display.stats["rects"] == 2
+    assert not display.damage
+    assert display.flush() == []
+
+
+def test_blitted_records_the_display_writes(vm, display):
+    bits = display.form[0]
+    display.blitted(bits, (2, 3, 4, 5))
+    other = vm.allocate(vm.lookup_global("Bitmap"), data_len=16)
+    display.blitted(other, (20, 20, 4, 4))
+    assert display.flush() == [(2, 3, 6, 8)]
+
+
+def test_blitted_is_ignored_while_updates_are_deferred(vm, display):
+    defer_screen_update(vm.memory.nil, vm.memory.true, context=None, vm=vm)
+    display.blitted(display.form[0], (2, 3, 4, 5))
+    assert not display.damage
+    defer_screen_update(vm.memory.nil, vm.memory.false, context=None, vm=vm)
+    display.blitted(display.form[0], (2, 3, 4, 5))
+    assert display.flush() == [(2, 3, 6, 8)]
+
+
+def chunks(png):
+    i = 8
+    while i < len(png):
+        length, = struct.unpack(">I", png[i:i + 4])
+        kind, data = png[i + 4:i + 8], png[i + 8:i + 8 + length]
+        crc, = struct.unpack(">I", png[i + 8 + length:i + 12 + length])
+        assert crc == zlib.crc32(kind + data) & 0xFFFFFFFF
+        yield kind, data
+        i += 12 + length
+
+
+def test_frame_is_a_png_of_the_display(vm):
+    pytest.importorskip("numpy")
+    be_display(display_form(vm, 64, 48, pixel=0xFF102030), context=None, vm=vm)
+    png = vm.display.frame()
+    assert png.startswith(b"\x89PNG\r\n\x1a\n")
+    found = dict(chunks(png))
+    assert list(found) == [b"IHDR", b"IDAT", b"IEND"]
+    assert struct.unpack(">IIBBBBB", found[b"IHDR"]) == (64, 48, 8, 2, 0, 0, 0)
+    rows = zlib.decompress(found[b"IDAT"])
+    assert rows == (b"\x00" + b"\x10\x20\x30" * 64) * 48
+    assert struct.unpack(">II", vm.display.frame((4, 8, 14, 28))[16:24]) == (10, 20)
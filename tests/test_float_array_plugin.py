@@ -0,0 +1,189 @@
+import pytest
+from stvm.primitives import PrimitiveFail
+from stvm.utils import from_python, to_python
+
+np = pytest.importorskip("numpy")
+plugin = pytest.importorskip("stvm.plugins.FloatArrayPlugin")
+
+A = np.array([1.5, -2.25, 3.1, 0.1, 1e-3, 42.0, -7.75], dtype=np.float32)
+B = np.array([0.5, 4.0, -1.3, 2.2, 1e3, -0.125, 3.0], dtype=np.float32)
+
+
+def float_array(vm, values):
+    values = np.asarray(values, dtype="<f4")
+    array = vm.allocate(vm.lookup_global("FloatArray"), data_len=len(values))
+    array.writable_slots(0, values.nbytes)[:] = values.tobytes()
+    return array
+
+
+def values_of(array):
+    return np.frombuffer(array.raw_slots, dtype="<f4", count=len(array)).copy()
+
+
+def call(vm, name, rcvr, *args):
+    args = [from_python(a, vm) if isinstance(a, (int, float)) else a for a in args]
+    return getattr(plugin, name)(rcvr, *args, context=None, vm=vm)
+
+
+def test_add_float_array(vm):
+    a = float_array(vm, A)
+    call(vm, "primitiveAddFloatArray", a, float_array(vm, B))
+    assert np.array_equal(values_of(a), A + B)
+
+
+def test_sub_float_array(vm):
+    a = float_array(vm, A)
+    call(vm, "primitiveSubFloatArray", a, float_array(vm, B))
+    assert np.array_equal(values_of(a), A - B)
+
+
+def test_mul_float_array(vm):
+    a = float_array(vm, A)
+    call(vm, "primitiveMulFloatArray", a, float_array(vm, B))
+    assert np.array_equal(values_of(a), A * B)
+
+
+def test_div_float_array(vm):
+    a = float_array(vm, A)
+    call(vm, "primitiveDivFloatArray", a, float_array(vm, B))
+    assert np.array_equal(values_of(a), A / B)
+
+
+def test_div_float_array_by_zero(vm):
+    a = float_array(vm, A)
+    divisor = B.copy()
+    divisor[3] = 0
+    with pytest.raises(PrimitiveFail):
+        call(vm, "primitiveDivFloatArray", a, float_array(vm, divisor))
+    assert np.array_equal(values_of(a), A)
+
+
+@pytest.mark.parametrize("scalar", [2, 0.1, -3.5])
+def test_add_scalar(vm, scalar):
+    a = float_array(vm, A)
+    call(vm, "primitiveAddScalar", a, scalar)
+    assert np.array_equal(values_of(a), (A.astype(np.float64) + scalar).astype(np.float32))
+
+
+@pytest.mark.parametrize("scalar", [2, 0.1, -3.5])
+def test_sub_scalar(vm, scalar):
+    # computed in double precision, rounded when stored
+    a = float_array(vm, A)
+    call(vm, "primitiveSubScalar", a, scalar)
+    assert np.array_equal(values_of(a), (A.astype(np.float64) - scalar).astype(np.float32))
+
+
+@pytest.mark.parametrize("scalar", [2, 0.1, -3.5])
+def test_mul_scalar(vm, scalar):
+    a = float_array(vm, A)
+    call(vm, "primitiveMulScalar", a, scalar)
+    assert np.array_equal(values_of(a), (A.astype(np.float64) * scalar).astype(np.float32))
+
+
+@pytest.mark.parametrize("scalar", [2, 0.1, -3.5])
+def test_div_scalar(vm, scalar):
+    # multiplied by the inverse of the scalar, as in the C plugin
+    a = float_array(vm, A)
+    call(vm, "primitiveDivScalar", a, scalar)
+    assert np.array_equal(values_of(a), (A.astype(np.float64) * (1.0 / scalar)).astype(np.float32))
+
+
+@pytest.mark.parametrize("scalar", [0, 0.0])
+def test_div_scalar_by_zero(vm, scalar):
+    a = float_array(vm, A)
+    with pytest.raises(PrimitiveFail):
+        call(vm, "primitiveDivScalar", a, scalar)
+    assert np.array_equal(values_of(a), A)
+
+
+def test_dot_product(vm):
+    result = call(vm, "primitiveDotProduct", float_array(vm, A), float_array(vm, B))
+    assert to_python(result, vm) == float((A * B).sum(dtype=np.float64))
+
+
+def test_sum(vm):
+    result = call(vm, "primitiveSum", float_array(vm, A))
+    assert to_python(result, vm) == float(A.sum(dtype=np.float64))
+
+
+def test_length(vm):
+    result = call(vm, "primitiveLength", float_array(vm, A))
+    assert to_python(result, vm) == pytest.approx(float(np.linalg.norm(A.astype(np.float64))))
+
+
+def test_normalize(vm):
+    a = float_array(vm, A)
+    call(vm, "primitiveNormalize", a)
+    expected = (A / np.sqrt((A * A).sum(dtype=np.float64))).astype(np.float32)
+    assert np.array_equal(values_of(a), expected)
+    assert np.linalg.norm(values_of(a)) == pytest.approx(1.0, rel=1e-6)
+
+
+def test_normalize_zero_length(vm):
+    a = float_array(vm, np.zeros(5))
+    with pytest.raises(PrimitiveFail):
+        call(vm, "primitiveNormalize", a)
+    assert not values_of(a).any()
+
+
+def test_equal(vm):
+    a = float_array(vm, A)
+    assert call(vm, "primitiveEqual", a, float_array(vm, A)) is True
+    changed = A.copy()
+    changed[-1] += 1
+    assert call(vm, "primitiveEqual", a, float_array(vm, changed)) is False
+    assert call(vm, "primitiveEqual", a, float_array(vm, A[:-1])) is False
+
+
+def test_equal_to_a_non_words_object(vm):
+    a = float_array(vm, A)
+    assert call(vm, "primitiveEqual", a, from_python(A.tobytes(), vm)) is False
+    assert call(vm, "primitiveEqual", a, 3) is False
+
+
+def test_hash_array(vm):
+    expected = int(A.view("<i4").sum(dtype=np.int64)) & 0x1FFFFFFF
+    assert to_python(call(vm, "primitiveHashArray", float_array(vm, A)), vm) == expected
+
+
+def test_at(vm):
+    a = float_array(vm, A)
+    for i, value in enumerate(A, start=1):
+        assert to_python(call(vm, "primitiveAt", a, i), vm) == float(value)
+
+
+@pytest.mark.parametrize("value", [0.1, 7, -1e30])
+def test_at_put(vm, value):
+    a = float_array(vm, A)
+    call(vm, "primitiveAtPut", a, 3, value)
+    expected = A.copy()
+    expected[2] = value
+    assert np.array_equal(values_of(a), expected)
+
+
+@pytest.mark.parametrize("index", [0, len(A) + 1, -1, 1000])
+def test_at_out_of_bounds(vm, index):
+    a = float_array(vm, A)
+    with pytest.raises(PrimitiveFail):
+        call(vm, "primitiveAt", a, index)
+    with pytest.raises(PrimitiveFail):
+        call(vm, "primitiveAtPut", a, index, 1.0)
+    assert np.array_equal(values_of(a), A)
+
+
+@pytest.mark.parametrize("name", ["primitiveAddFloatArray", "primitiveMulFloatArray",
+                                  "primitiveSubFloatArray", "primitiveDotProduct"])
+def test_size_mismatch(vm, name):
+    a = float_array(vm, A)
+    with pytest.raises(PrimitiveFail):
+        call(vm, name, a, float_array(vm, B[:-1]))
+    assert np.array_equal(values_of(a), A)
+
+
+def test_writes_are_marked_dirty(vm):
+    a = float_array(vm, A)
+    b = float_array(vm, B)
+    memory = vm.memory
+    memory.clear_dirty()
+    call(vm, "primitiveAddFloatArray", a, b)
+    assert a.address >> 12 << 12 in set(memory.dirty_pages())
@@ -0,0 +1,42 @@
+import math
+import pytest
+from stvm.image64 import FLOAT_CACHE_SIZE
+from stvm.primitives import identity, not_identical
+from stvm.spurobjects import ImmediateFloat
+from stvm.utils import from_python, to_python
+
+
+def test_proxies_of_the_same_float_are_equal(vm):
+    memory = vm.memory
+    first = ImmediateFloat.create(1.5, memory)
+    for i in range(FLOAT_CACHE_SIZE):
+        ImmediateFloat.create(2.0 + i, memory)
+    second = ImmediateFloat.create(1.5, memory)
+    # the first proxy was evicted from the cache
+    assert second is not first
+    assert second == first and hash(second) == hash(first)
+    assert {first: True}.get(second)
+    assert identity(first, second, context=None, vm=vm)
+    assert not not_identical(first, second, context=None, vm=vm)
+
+
+def test_different_floats_are_not_equal(vm):
+    memory = vm.memory
+    a, b = ImmediateFloat.create(1.5, memory), ImmediateFloat.create(2.5, memory)
+    assert a != b
+    assert not identity(a, b, context=None, vm=vm)
+    assert ImmediateFloat.create(0.0, memory) != ImmediateFloat.create(-0.0, memory)
+
+
+@pytest.mark.parametrize("value", [1.5, -2.75, 0.0, -0.0, 1e300, -1e-300, 5e-324, math.inf, 2.0 ** -126])
+def test_round_trip(vm, value):
+    result = to_python(from_python(value, vm), vm)
+    assert result == value and math.copysign(1, result) == math.copysign(1, value)
+
+
+def test_immediate_range(vm):
+    memory = vm.memory
+    assert from_python(1.5, vm).kind == -4
+    assert from_python(1e300, vm).class_ is memory.boxedfloat64
+    with pytest.raises(ValueError):
+        ImmediateFloat.create(1e300, memory)
@@ -0,0 +1,236 @@
+import random
+from array import array
+import pytest
+from stvm.plugins import MiscPrimitivePlugin as misc
+from stvm.primitives import PrimitiveFail
+from stvm.utils import from_python, to_python, to_bytestring
+
+IDENTITY = bytes(range(256))
+UPPERCASE = bytes.maketrans(bytes(range(97, 123)), bytes(range(65, 91)))
+CASE_INSENSITIVE = bytes.maketrans(bytes(range(65, 91)), bytes(range(97, 123)))
+REVERSED = bytes(range(255, -1, -1))
+
+
+def call(vm, name, *args):
+    """Calls a primitive of the plugin as the image does, with python arguments"""
+    args = [to_bytestring(a, vm) if isinstance(a, str) else from_python(a, vm) for a in args]
+    cls = vm.memory.bytestring
+    return to_python(getattr(misc, name)(cls, *args, context=None, vm=vm), vm)
+
+
+def string_hash(text, initial_hash):
+    # String class>>stringHash:initialHash:, multiplying by 1664525 on
+    # 14 bits halves as the Smalltalk code does
+    h = initial_hash & 0xFFFFFFF
+    for c in text.encode("latin-1"):
+        h += c
+        low = h & 16383
+        h = (0x260D * low + ((0x260D * (h >> 14) + 0x0065 * low) & 16383) * 16384) & 0xFFFFFFF
+    return h
+
+
+@pytest.mark.parametrize("text, initial_hash", [
+    ("", 0),
+    ("hello world", 0),
+    ("hello world", 0x2A3B4C),
+    ("a", 0x3FFFFFFF),
+    ("\xe9t\xe9", 17),
+    ("Pharo" * 200, 0xFFFFFFF),
+])
+def test_string_hash(vm, text, initial_hash):
+    assert call(vm, "primitiveStringHash", text, initial_hash) == string_hash(text, initial_hash)
+
+
+@pytest.mark.parametrize("text, initial_hash, expected", [
+    ("hello world", 0, 84542588),
+    ("abc", 17, 200058387),
+    ("", 5, 5),
+])
+def test_string_hash_known_values(vm, text, initial_hash, expected):
+    assert call(vm, "primitiveStringHash", text, initial_hash) == expected
+
+
+def test_string_hash_depends_on_initial_hash(vm):
+    assert call(vm, "primitiveStringHash", "abc", 0) != call(vm, "primitiveStringHash", "abc", 1)
+
+
+@pytest.mark.parametrize("start, expected", [(1, 3), (3, 3), (4, 4), (5, 0), (6, 0), (100, 0), (0, 0)])
+def test_index_of_ascii_in_string(vm, start, expected):
+    assert call(vm, "primitiveIndexOfAsciiInString", ord("l"), "hello", start) == expected
+
+
+@pytest.mark.parametrize("key, start, table, expected", [
+    ("world", 1, IDENTITY, 7),
+    ("World", 1, IDENTITY, 0),
+    ("World", 1, CASE_INSENSITIVE, 7),
+    ("o", 6, IDENTITY, 8),
+    ("world", 8, IDENTITY, 0),
+    ("d", 11, IDENTITY, 11),
+    ("d", 12, IDENTITY, 0),
+    ("world", 50, IDENTITY, 0),
+    ("", 1, IDENTITY, 0),
+    ("hello", 0, IDENTITY, 1),
+])
+def test_find_substring(vm, key, start, table, expected):
+    assert call(vm, "primitiveFindSubstring", key, "hello world", start, table) == expected
+
+
+def test_find_substring_needs_a_full_table(vm):
+    with pytest.raises(PrimitiveFail):
+        call(vm, "primitiveFindSubstring", "o", "hello", 1, IDENTITY[:128])
+
+
+@pytest.mark.parametrize("s1, s2, order, expected", [
+    ("abc", "abd", IDENTITY, 1),
+    ("abc", "abc", IDENTITY, 2),
+    ("b", "a", IDENTITY, 3),
+    ("ab", "abc", IDENTITY, 1),
+    ("", "", IDENTITY, 2),
+    ("ABC", "abc", IDENTITY, 1),
+    ("ABC", "abc", CASE_INSENSITIVE, 2),
+    ("abc", "abd", REVERSED, 3),
+    ("ab", "abc", REVERSED, 1),
+])
+def test_compare_string(vm, s1, s2, order, expected):
+    assert call(vm, "primitiveCompareString", s1, s2, order) == expected
+
+
+def inclusion_map(chars):
+    return bytes(1 if chr(i) in chars else 0 for i in range(256))
+
+
+@pytest.mark.parametrize("start, expected", [(1, 2), (2, 2), (3, 5), (9, 0), (11, 0), (12, 0), (100, 0)])
+def test_find_first_in_string(vm, start, expected):
+    vowels = inclusion_map("aeiou")
+    assert call(vm, "primitiveFindFirstInString", "hello world", vowels, start) == expected
+
+
+def test_find_first_in_string_map_size(vm):
+    assert call(vm, "primitiveFindFirstInString", "hello", inclusion_map("e")[:255], 1) == 0
+
+
+def test_find_first_in_string_start_before_the_string(vm):
+    with pytest.raises(PrimitiveFail):
+        call(vm, "primitiveFindFirstInString", "hello", inclusion_map("e"), 0)
+
+
+def translate(vm, text, start, stop, table):
+    string = to_bytestring(text, vm)
+    misc.primitiveTranslateStringWithTable(vm.memory.bytestring, string, from_python(start, vm),
+                                          from_python(stop, vm), from_python(table, vm),
+                                          context=None, vm=vm)
+    return string.as_text()
+
+
+@pytest.mark.parametrize("start, stop, expected", [
+    (1, 5, "HELLO world"),
+    (7, 11, "hello WORLD"),
+    (1, 11, "HELLO WORLD"),
+    (5, 4, "hello world"),
+    (12, 11, "hello world"),
+])
+def test_translate_string_with_table(vm, start, stop, expected):
+    assert translate(vm, "hello world", start, stop, UPPERCASE) == expected
+
+
+@pytest.mark.parametrize("start, stop", [(0, 5), (1, 12), (20, 30)])
+def test_translate_string_out_of_bounds(vm, start, stop):
+    with pytest.raises(PrimitiveFail):
+        translate(vm, "hello world", start, stop, UPPERCASE)
+
+
+def test_translate_string_marks_the_string_dirty(vm):
+    string = to_bytestring("hello world", vm)
+    memory = vm.memory
+    memory.clear_dirty()
+    misc.primitiveTranslateStringWithTable(memory.bytestring, string, from_python(1, vm),
+                                          from_python(5, vm), from_python(UPPERCASE, vm),
+                                          context=None, vm=vm)
+    page = string.address >> 12 << 12
+    assert page in set(memory.dirty_pages())
+
+
+def bitmap(vm, words):
+    bm = vm.allocate(vm.lookup_global("Bitmap"), data_len=len(words))
+    bm.writable_slots(0, len(words) * 4)[:] = array("I", words).tobytes()
+    return bm
+
+
+def words_of(bm):
+    return list(array("I", bytes(bm.raw_slots[:len(bm) * 4])))
+
+
+def compress(vm, words, size=None):
+    data = bytearray(size if size is not None else len(words) * 4 + 10)
+    ba = from_python(bytes(data), vm)
+    n = misc.primitiveCompressToByteArray(vm.memory.nil, bitmap(vm, words), ba, context=None, vm=vm)
+    return bytes(to_python(ba, vm)[:n.value])
+
+
+def decompress(vm, data, size, index=1):
+    bm = bitmap(vm, [0] * size)
+    misc.primitiveDecompressFromByteArray(vm.memory.nil, bm, from_python(data, vm),
+                                          from_python(index, vm), context=None, vm=vm)
+    return words_of(bm)
+
+
+def size_length(data):
+    """Length of the encoded size S in front of the runs"""
+    return 1 if data[0] <= 223 else 2 if data[0] <= 254 else 5
+
+
+def random_words(rng):
+    words = []
+    for _ in range(rng.randrange(0, 40)):
+        kind = rng.random()
+        if kind < 0.3:
+            words += [rng.choice([0, 0xFFFFFFFF, 0x7F7F7F7F, 0x12345678])] * rng.randrange(1, 20)
+        elif kind < 0.5:
+            words.append(rng.randrange(256) * 0x01010101)
+        else:
+            words += [rng.randrange(1 << 32) for _ in range(rng.randrange(1, 5))]
+    return words
+
+
+def test_compress_known_bitmap(vm):
+    words = [0, 0, 0, 0x12345678, 5, 5, 0x01010101]
+    assert compress(vm, words) == bytes.fromhex("07" "0d00" "0712345678" "0a00000005" "0501")
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_compress_round_trip(vm, seed):
+    words = random_words(random.Random(seed))
+    data = compress(vm, words)
+    assert decompress(vm, data, len(words), index=size_length(data) + 1) == words
+
+
+@pytest.mark.parametrize("words", [[0] * 3000, [7] * 2500 + [1, 2] * 1500, list(range(2100))])
+def test_compress_round_trip_long_runs(vm, words):
+    # sizes and run lengths encoded on 2 and 5 bytes
+    data = compress(vm, words)
+    assert decompress(vm, data, len(words), index=size_length(data) + 1) == words
+
+
+def test_compress_target_too_small(vm):
+    words = [1, 2, 3, 4]
+    with pytest.raises(PrimitiveFail):
+        compress(vm, words, size=len(compress(vm, words)) - 1)
+
+
+def test_decompress_past_the_end_of_the_bitmap(vm):
+    data = compress(vm, [0, 0, 0, 0x12345678, 5, 5, 0x01010101])
+    with pytest.raises(PrimitiveFail):
+        decompress(vm, data, 6, index=2)
+
+
+@pytest.mark.parametrize("data", [
+    b"\xff\x00",
+    b"\xff\x00\x00\x00",
+    b"\xe0",
+    b"\x0b\x12\x34\x56\x78",
+    b"\x0a\x00\x00",
+    b"\x05",
+])
+def test_decompress_truncated_data(vm, data):
+    with pytest.raises(PrimitiveFail):
+        decompress(vm, data, 4)
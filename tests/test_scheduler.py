@@ -0,0 +1,33 @@
+from stvm.utils import from_python
+
+
+def processes(vm, priority, count):
+    cls = vm.lookup_global("Process")
+    result = [vm.allocate(cls) for _ in range(count)]
+    for process in result:
+        process[2] = from_python(priority, vm)
+    return result
+
+
+def test_sleep_first_puts_the_process_at_the_head(vm):
+    scheduler = vm.process_scheduler
+    a, b, c = processes(vm, 80, 3)
+    scheduler.sleep(b)
+    scheduler.sleep(c)
+    scheduler.sleep_first(a)
+    linkedlist = scheduler.priorities[80].linkedlist
+    assert linkedlist[0] is a and linkedlist[1] is c and a[0] is b and a[3] is linkedlist
+    assert [scheduler.wake_highest_priority() for _ in range(3)] == [a, b, c]
+
+
+def test_cancelled_switch_keeps_the_run_queue_order(vm):
+    scheduler = vm.process_scheduler
+    a, b = processes(vm, 80, 2)
+    scheduler.sleep(a)
+    scheduler.sleep(b)
+    active = vm.active_process
+    scheduler.suspend_active()
+    assert vm.new_process is a
+    vm.cancel_process_switch()
+    assert vm.active_process is active
+    assert [scheduler.wake_highest_priority() for _ in range(2)] == [a, b]